@@ -25,6 +25,7 @@ DOWNLOAD_URL = (
 
 REQUIRES = [
     'numpy',
+    'scipy',
     'lockfile',
     'future',
     'scikit-learn',
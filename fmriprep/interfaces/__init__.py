@@ -2,6 +2,11 @@
 # -*- coding: utf-8 -*-
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
-from fmriprep.interfaces.bids import ReadSidecarJSON, DerivativesDataSink, BIDSDataGrabber
+from fmriprep.interfaces.bids import (ReadSidecarJSON, DerivativesDataSink, DerivativesBatchSink,
+                                      BIDSDataGrabber)
 from fmriprep.interfaces.images import ImageDataSink
+from fmriprep.interfaces.hmc import (NativeMotionCorr, AntsMotionParameters, HarmonizeMotion,
+                                    CompareMotion)
 from fmriprep.interfaces.utils import FormatHMCParam, IntraModalMerge
+from fmriprep.interfaces.confounds import (MotionConfounds, ResampleTPMs, TissueROIs,
+                                          CombinedCompCor, RegionSignals)
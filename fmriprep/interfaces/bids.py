@@ -11,16 +11,18 @@ import os
 import os.path as op
 import pkg_resources as pkgr
 import re
-import simplejson as json
-from shutil import copy
+from multiprocessing.pool import ThreadPool
 
 from nipype import logging
 from nipype.interfaces.base import (
     traits, isdefined, TraitedSpec, BaseInterface, BaseInterfaceInputSpec,
-    File, InputMultiPath, OutputMultiPath
+    File, InputMultiPath, OutputMultiPath, DynamicTraitedSpec
 )
+from nipype.interfaces.io import add_traits
 
+from fmriprep.utils.layout import get_metadata
 from fmriprep.utils.misc import collect_bids_data, make_folder
+from fmriprep.utils.publish import publish_file, PUBLISH_MODES
 
 LOGGER = logging.getLogger('interface')
 
@@ -85,6 +87,9 @@ class DerivativesDataSinkInputSpec(BaseInterfaceInputSpec):
     source_file = File(exists=False, mandatory=True, desc='the input func file')
     suffix = traits.Str('', mandatory=True, desc='suffix appended to source_file')
     extra_values = traits.List(traits.Str)
+    publish_mode = traits.Enum(*PUBLISH_MODES, usedefault=True,
+                               desc='hardlink or reflink the files if possible, or copy them')
+    compress = traits.Bool(True, usedefault=True, desc='gzip uncompressed NIfTI files')
 
 class DerivativesDataSinkOutputSpec(TraitedSpec):
     out_file = OutputMultiPath(File(exists=True, desc='written file path'))
@@ -102,38 +107,16 @@ class DerivativesDataSink(BaseInterface):
         super(DerivativesDataSink, self).__init__(**inputs)
 
     def _run_interface(self, runtime):
-        fname, _ = _splitext(self.inputs.source_file)
         _, ext = _splitext(self.inputs.in_file[0])
-
-        m = re.search(
-            '^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?'
-            '(_(?P<task_id>task-[a-zA-Z0-9]+))?(_(?P<acq_id>acq-[a-zA-Z0-9]+))?'
-            '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?(_(?P<run_id>run-[a-zA-Z0-9]+))?',
-            fname
-        )
-
-        # TODO this quick and dirty modality detection needs to be implemented
-        # correctly
-        mod = 'func'
-        if 'anat' in op.dirname(self.inputs.source_file):
-            mod = 'anat'
-        elif 'dwi' in op.dirname(self.inputs.source_file):
-            mod = 'dwi'
+        if ext == '.nii' and self.inputs.compress:
+            ext += '.gz'
 
         base_directory = os.getcwd()
         if isdefined(self.inputs.base_directory):
             base_directory = op.abspath(self.inputs.base_directory)
 
-        out_path = '{}/{subject_id}'.format(self.out_path_base, **m.groupdict())
-        if m.groupdict().get('ses_id') is not None:
-            out_path += '/{ses_id}'.format(**m.groupdict())
-        out_path += '/{}'.format(mod)
-
-        out_path = op.join(base_directory, out_path)
-
-        make_folder(out_path)
-
-        base_fname = op.join(out_path, fname)
+        base_fname = derivatives_base(self.inputs.source_file, base_directory,
+                                      self.out_path_base)
 
         formatstr = '{bname}_{suffix}{ext}'
         if len(self.inputs.in_file) > 1 and not isdefined(self.inputs.extra_values):
@@ -149,7 +132,9 @@ class DerivativesDataSink(BaseInterface):
             if isdefined(self.inputs.extra_values):
                 out_file = out_file.format(extra_value=self.inputs.extra_values[i])
             self._results['out_file'].append(out_file)
-            copy(self.inputs.in_file[i], out_file)
+            method = publish_file(self.inputs.in_file[i], out_file,
+                                  mode=self.inputs.publish_mode)
+            LOGGER.debug('Published %s (%s)', out_file, method)
 
         return runtime
 
@@ -157,6 +142,89 @@ class DerivativesDataSink(BaseInterface):
         return self._results
 
 
+class DerivativesBatchSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+    base_directory = traits.Directory(
+        desc='Path to the base directory for storing data.')
+    source_file = File(exists=False, mandatory=True, desc='the input func file')
+    in_images = InputMultiPath(File(exists=True),
+                               desc='images to be saved as ImageDataSink does')
+    publish_mode = traits.Enum(*PUBLISH_MODES, usedefault=True,
+                               desc='hardlink or reflink the files if possible, or copy them')
+    compress = traits.Bool(True, usedefault=True, desc='gzip uncompressed NIfTI files')
+    num_threads = traits.Int(4, usedefault=True, desc='files published concurrently')
+
+class DerivativesBatchSinkOutputSpec(TraitedSpec):
+    out_file = OutputMultiPath(File(exists=True, desc='written file path'))
+
+class DerivativesBatchSink(BaseInterface):
+    '''
+    Saves all the derivatives of one source file in a single job. Each
+    suffix is an input field, taking the file (or files) to be saved with
+    that suffix as DerivativesDataSink would. Suffixes left undefined are
+    skipped.
+
+    >>> sink = DerivativesBatchSink(suffixes=['ants_hmc', 'ants_par'])
+    >>> sink.inputs.ants_hmc = 'epi_hmc.nii.gz' # doctest: +SKIP
+    '''
+    input_spec = DerivativesBatchSinkInputSpec
+    output_spec = DerivativesBatchSinkOutputSpec
+    out_path_base = "derivatives"
+    _always_run = True
+
+    def __init__(self, suffixes=None, out_path_base=None, **inputs):
+        self._results = {'out_file': []}
+        self._suffixes = suffixes or []
+        if out_path_base:
+            self.out_path_base = out_path_base
+        super(DerivativesBatchSink, self).__init__(**inputs)
+        add_traits(self.inputs, self._suffixes)
+        # adding traits resets the inputs set above
+        self.inputs.trait_set(**inputs)
+
+    def _run_interface(self, runtime):
+        base_directory = os.getcwd()
+        if isdefined(self.inputs.base_directory):
+            base_directory = op.abspath(self.inputs.base_directory)
+
+        base_fname = derivatives_base(self.inputs.source_file, base_directory,
+                                      self.out_path_base)
+
+        jobs = []
+        for suffix in self._suffixes:
+            in_files = getattr(self.inputs, suffix)
+            if not isdefined(in_files):
+                continue
+            if not isinstance(in_files, (list, tuple)):
+                in_files = [in_files]
+            _, ext = _splitext(in_files[0])
+            if ext == '.nii' and self.inputs.compress:
+                ext += '.gz'
+            formatstr = '{bname}_{suffix}{ext}'
+            if len(in_files) > 1:
+                formatstr = '{bname}_{suffix}{i:04d}{ext}'
+            jobs += [(in_file, formatstr.format(bname=base_fname, suffix=suffix, i=i, ext=ext))
+                     for i, in_file in enumerate(in_files)]
+
+        if isdefined(self.inputs.in_images):
+            from fmriprep.interfaces.images import image_path
+            for in_file in self.inputs.in_images:
+                jobs.append((in_file, image_path(in_file, self.inputs.source_file,
+                                                 base_directory,
+                                                 {'origin_file': self.inputs.source_file})))
+
+        pool = ThreadPool(max(1, min(self.inputs.num_threads, len(jobs))))
+        try:
+            pool.map(lambda job: publish_file(job[0], job[1], mode=self.inputs.publish_mode),
+                     jobs)
+        finally:
+            pool.close()
+        self._results['out_file'] = [out_file for _, out_file in jobs]
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
 class ReadSidecarJSONInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc='the input nifti file')
     fields = traits.List(traits.Str, desc='get only certain fields')
@@ -206,61 +274,40 @@ class ReadSidecarJSON(BaseInterface):
         return runtime
 
 
-def get_metadata_for_nifti(in_file):
-    """Fetchs metadata for a given nifi file"""
-    in_file = op.abspath(in_file)
+def derivatives_base(source_file, base_directory, out_path_base='derivatives'):
+    ''' Creates the output folder of the derivatives of a source file, and
+    returns the path of their common prefix in it '''
+    fname, _ = _splitext(source_file)
 
-    fname, ext = op.splitext(in_file)
-    if ext == '.gz':
-        fname, ext2 = op.splitext(fname)
-        ext = ext2 + ext
+    m = re.search(
+        '^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?'
+        '(_(?P<task_id>task-[a-zA-Z0-9]+))?(_(?P<acq_id>acq-[a-zA-Z0-9]+))?'
+        '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?(_(?P<run_id>run-[a-zA-Z0-9]+))?',
+        fname
+    )
+
+    # TODO this quick and dirty modality detection needs to be implemented
+    # correctly
+    mod = 'func'
+    if 'anat' in op.dirname(source_file):
+        mod = 'anat'
+    elif 'dwi' in op.dirname(source_file):
+        mod = 'dwi'
+
+    out_path = '{}/{subject_id}'.format(out_path_base, **m.groupdict())
+    if m.groupdict().get('ses_id') is not None:
+        out_path += '/{ses_id}'.format(**m.groupdict())
+    out_path += '/{}'.format(mod)
+
+    out_path = op.join(base_directory, out_path)
 
-    side_json = fname + '.json'
-    fname_comps = op.basename(side_json).split("_")
-
-    session_comp_list = []
-    subject_comp_list = []
-    top_comp_list = []
-    ses = None
-    sub = None
-
-    for comp in fname_comps:
-        if comp[:3] != "run":
-            session_comp_list.append(comp)
-            if comp[:3] == "ses":
-                ses = comp
-            else:
-                subject_comp_list.append(comp)
-                if comp[:3] == "sub":
-                    sub = comp
-                else:
-                    top_comp_list.append(comp)
-
-    if any([comp.startswith('ses') for comp in fname_comps]):
-        bids_dir = '/'.join(op.dirname(in_file).split('/')[:-3])
-    else:
-        bids_dir = '/'.join(op.dirname(in_file).split('/')[:-2])
-
-    top_json = op.join(bids_dir, "_".join(top_comp_list))
-    potential_json = [top_json]
-
-    subject_json = op.join(bids_dir, sub, "_".join(subject_comp_list))
-    potential_json.append(subject_json)
-
-    if ses:
-        session_json = op.join(bids_dir, sub, ses, "_".join(session_comp_list))
-        potential_json.append(session_json)
-
-    potential_json.append(side_json)
-
-    merged_param_dict = {}
-    for json_file_path in potential_json:
-        if op.isfile(json_file_path):
-            with open(json_file_path, 'r') as jsonfile:
-                param_dict = json.load(jsonfile)
-                merged_param_dict.update(param_dict)
-
-    return merged_param_dict
+    make_folder(out_path)
+
+    return op.join(out_path, fname)
+
+def get_metadata_for_nifti(in_file):
+    """Fetchs metadata for a given nifi file"""
+    return get_metadata(in_file)
 
 def _splitext(fname):
     fname, ext = op.splitext(op.basename(fname))
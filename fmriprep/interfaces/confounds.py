@@ -0,0 +1,641 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Interfaces computing confound time series, and the ROIs they are drawn
+from, in-process.
+'''
+import os
+import os.path as op
+
+import numpy as np
+
+from nipype import logging
+from nipype.interfaces.base import (traits, isdefined, TraitedSpec, BaseInterface,
+                                    BaseInterfaceInputSpec, File, InputMultiPath,
+                                    OutputMultiPath)
+
+from fmriprep.utils.motion import framewise_displacement, load_parameters, fsl_voxel_matrix
+from fmriprep.utils.nifti import iter_volumes, load_data, load_header
+
+LOGGER = logging.getLogger('interface')
+
+DVARS_COLUMNS = ['stdDVARS', 'non-stdDVARS', 'vx-wisestdDVARS']
+
+# Interpolation -> spline order
+INTERP_ORDERS = {'sinc': 5, 'cubic': 3, 'linear': 1}
+
+
+class MotionConfoundsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='head-motion corrected 4D series')
+    in_mask = File(exists=True, mandatory=True, desc='brain mask')
+    in_plots = File(exists=True, mandatory=True, desc='motion parameters file')
+    parameter_source = traits.Enum('FSL', 'SPM', usedefault=True,
+                                   desc='layout of the motion parameters: FSL puts '
+                                   'rotations first, SPM translations first')
+    radius = traits.Float(50, usedefault=True,
+                          desc='radius in mm to calculate angular FDs')
+    remove_zerovariance = traits.Bool(True, usedefault=True,
+                                      desc='remove voxels with zero variance')
+    intensity_normalization = traits.Float(
+        1000.0, usedefault=True,
+        desc='divide the data by the median across voxels and timepoints and '
+        'multiply by this value. Set to 0 to disable')
+    out_file = File('confounds.tsv', usedefault=True, desc='output file name')
+
+
+class MotionConfoundsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='standardized, non-standardized and voxelwise '
+                    'standardized DVARS and framewise displacement')
+    avg_std = traits.Float(desc='average standardized DVARS')
+    avg_nstd = traits.Float(desc='average non-standardized DVARS')
+    avg_vxstd = traits.Float(desc='average voxelwise standardized DVARS')
+    fd_average = traits.Float(desc='average FD')
+
+
+class MotionConfounds(BaseInterface):
+    '''
+    Computes the three flavors of DVARS of nipype's ``ComputeDVARS`` and the
+    framewise displacement of ``FramewiseDisplacement`` in one pass, writing
+    them into a single confounds file.
+
+    The series is streamed volume by volume: the masked voxels of each volume
+    are appended to a disk-backed buffer (the robust standard deviation needs
+    the full time course of every voxel), while the lag-1 autocorrelation is
+    accumulated on the fly. Resident memory is therefore bounded by a few
+    volumes instead of several copies of the run.
+    '''
+    input_spec = MotionConfoundsInputSpec
+    output_spec = MotionConfoundsOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(MotionConfounds, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        import pandas as pd
+
+        mask = load_data(self.inputs.in_mask) > 0
+        if mask.ndim > 3:
+            mask = mask[..., 0]
+        dvars = streaming_dvars(self.inputs.in_file, mask,
+                                remove_zerovariance=self.inputs.remove_zerovariance,
+                                intensity_normalization=self.inputs.intensity_normalization)
+
+        params = load_parameters(self.inputs.in_plots)[:, :6]
+        if self.inputs.parameter_source == 'SPM':
+            params = params[:, [3, 4, 5, 0, 1, 2]]
+        fdisp = framewise_displacement(params, radius=self.inputs.radius)
+
+        confounds = pd.DataFrame(np.vstack(dvars).T, columns=DVARS_COLUMNS)
+        confounds['FramewiseDisplacement'] = fdisp
+
+        out_file = op.abspath(self.inputs.out_file)
+        confounds.to_csv(out_file, sep=str('\t'), index=False, na_rep='n/a')
+
+        self._results = {
+            'out_file': out_file,
+            'avg_std': float(dvars[0].mean()),
+            'avg_nstd': float(dvars[1].mean()),
+            'avg_vxstd': float(dvars[2].mean()),
+            'fd_average': float(fdisp.mean()),
+        }
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class ResampleTPMsInputSpec(BaseInterfaceInputSpec):
+    in_tpms = InputMultiPath(File(exists=True), mandatory=True,
+                             desc='tissue probability maps in T1w space')
+    reference = File(exists=True, mandatory=True, desc='image defining the output grid')
+    in_matrix_file = File(exists=True, mandatory=True,
+                          desc='FSL (FLIRT) matrix from the T1w image to the reference')
+    indices = traits.List(traits.Int, [0, 2], usedefault=True,
+                          desc='indices of the maps to resample (default: CSF and WM)')
+    interp = traits.Enum('sinc', 'cubic', 'linear', usedefault=True,
+                         desc='interpolation: "sinc" uses 5th order splines')
+
+
+class ResampleTPMsOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True),
+                                desc='resampled maps, in the order of indices')
+
+
+class ResampleTPMs(BaseInterface):
+    '''
+    Resamples some tissue probability maps onto the grid of a reference
+    image, applying a FLIRT matrix in-process as ``ApplyXFM`` does.
+
+    The sampling coordinates are computed once and shared by all the maps,
+    and only the maps listed in ``indices`` are read. FLIRT's windowed sinc
+    interpolation is approximated by a 5th order spline, which has a similar
+    (slightly narrower) kernel and is much cheaper.
+    '''
+    input_spec = ResampleTPMsInputSpec
+    output_spec = ResampleTPMsOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(ResampleTPMs, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        from scipy.ndimage import map_coordinates
+        from fmriprep.interfaces.bids import _splitext
+        from fmriprep.utils.nifti import image_like, save_nifti, work_file
+
+        order = INTERP_ORDERS[self.inputs.interp]
+        ref_shape = load_header(self.inputs.reference).get_data_shape()[:3]
+        coords = None
+
+        self._results['out_files'] = []
+        for index in self.inputs.indices:
+            in_file = self.inputs.in_tpms[index]
+            if coords is None:
+                # all the maps share the T1w grid
+                vox_matrix = fsl_voxel_matrix(np.loadtxt(self.inputs.in_matrix_file),
+                                              load_header(in_file),
+                                              load_header(self.inputs.reference))
+                coords = grid_coordinates(vox_matrix, ref_shape)
+
+            data = np.asarray(load_data(in_file), dtype=np.float32)
+            resampled = map_coordinates(data, coords, order=order, mode='constant',
+                                        cval=0., prefilter=order > 1)
+
+            out_nii = image_like(resampled.reshape(ref_shape), self.inputs.reference)
+            out_nii.set_data_dtype(np.float32)
+            out_file = work_file('{}_resampled.nii.gz'.format(_splitext(in_file)[0]))
+            self._results['out_files'].append(op.abspath(save_nifti(out_nii, out_file)))
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def grid_coordinates(vox_matrix, shape):
+    ''' Coordinates (3 x voxels) in the input image of every voxel of a grid '''
+    grid = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    return vox_matrix[:3, :3].dot(grid) + vox_matrix[:3, 3:]
+
+
+class TissueROIsInputSpec(BaseInterfaceInputSpec):
+    in_tpms = InputMultiPath(File(exists=True), mandatory=True,
+                             desc='tissue probability maps resampled to the EPI grid')
+    in_mask = File(exists=True, mandatory=True, desc='EPI brain mask')
+    ref_header = File(exists=True, desc='image whose header is given to the outputs '
+                      '(defaults to the brain mask)')
+    csf_index = traits.Int(0, usedefault=True, desc='index of the CSF map in in_tpms')
+    wm_index = traits.Int(2, usedefault=True, desc='index of the WM map in in_tpms')
+    threshold = traits.Float(0.95, usedefault=True,
+                             desc='minimum probability of the voxels of a tissue ROI')
+    csf_erosion_mm = traits.Float(0, usedefault=True, desc='erosion of the CSF ROI')
+    csf_mask_erosion_mm = traits.Float(30, usedefault=True,
+                                       desc='erosion of the brain mask the CSF ROI lies in')
+    wm_erosion_mm = traits.Float(6, usedefault=True, desc='erosion of the WM ROI')
+    wm_mask_erosion_mm = traits.Float(10, usedefault=True,
+                                      desc='erosion of the brain mask the WM ROI lies in')
+
+
+class TissueROIsOutputSpec(TraitedSpec):
+    csf_roi = File(exists=True, desc='CSF ROI')
+    wm_roi = File(exists=True, desc='WM ROI')
+    combined_roi = File(exists=True, desc='union of the CSF and WM ROIs (for aCompCor)')
+    label_file = File(exists=True, desc='4D file with the WM ROI and the brain mask '
+                      '(for the WhiteMatter and GlobalSignal regressors)')
+    eroded_mask = File(exists=True, desc='brain mask eroded as for the CSF ROI (for tCompCor)')
+
+
+class TissueROIs(BaseInterface):
+    '''
+    Builds all the ROIs of the anatomical confounds from the tissue maps,
+    loading them and the brain mask once.
+
+    A tissue ROI holds the voxels above ``threshold`` in its map, inside the
+    brain mask eroded by ``<tissue>_mask_erosion_mm``, and is then eroded by
+    ``<tissue>_erosion_mm``. Erosions are distance thresholds on Euclidean
+    distance transforms in mm, so their cost does not depend on their depth
+    and they are isotropic on anisotropic grids.
+    '''
+    input_spec = TissueROIsInputSpec
+    output_spec = TissueROIsOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(TissueROIs, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        from fmriprep.utils.nifti import image_like, save_nifti, work_file
+
+        mask = _load_mask(self.inputs.in_mask)
+        zooms = load_header(self.inputs.in_mask).get_zooms()[:3]
+        ref_file = self.inputs.ref_header if isdefined(self.inputs.ref_header) \
+            else self.inputs.in_mask
+        mask_depth = mask_distance(mask, zooms)
+
+        def _tissue_roi(index, erosion_mm, mask_erosion_mm):
+            tpm = load_data(self.inputs.in_tpms[index])
+            roi = (tpm >= self.inputs.threshold) & (mask_depth > mask_erosion_mm)
+            if erosion_mm:
+                roi = mask_distance(roi, zooms) > erosion_mm
+            return roi
+
+        csf_roi = _tissue_roi(self.inputs.csf_index, self.inputs.csf_erosion_mm,
+                              self.inputs.csf_mask_erosion_mm)
+        wm_roi = _tissue_roi(self.inputs.wm_index, self.inputs.wm_erosion_mm,
+                             self.inputs.wm_mask_erosion_mm)
+        outputs = {
+            'csf_roi': csf_roi,
+            'wm_roi': wm_roi,
+            'combined_roi': csf_roi | wm_roi,
+            'label_file': np.stack((wm_roi, mask), axis=-1),
+            'eroded_mask': mask_depth > self.inputs.csf_mask_erosion_mm,
+        }
+
+        for name, data in outputs.items():
+            # the header of the reference prevents qform mismatches downstream
+            out_nii = image_like(data.astype(np.uint8), ref_file)
+            out_nii.set_data_dtype(np.uint8)
+            self._results[name] = op.abspath(save_nifti(out_nii, work_file(name + '.nii.gz')))
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def mask_distance(mask, zooms):
+    '''
+    Distance (in mm) of every voxel of a mask to the closest voxel outside it,
+    0 outside the mask. Voxels beyond the edges of the grid are outside, so a
+    mask eroded by ``d`` mm is ``mask_distance(mask, zooms) > d``.
+    '''
+    from scipy.ndimage import distance_transform_edt
+
+    padded = np.pad(mask, 1, mode='constant', constant_values=False)
+    distance = distance_transform_edt(padded, sampling=zooms)
+    return distance[(slice(1, -1),) * mask.ndim]
+
+
+class CombinedCompCorInputSpec(BaseInterfaceInputSpec):
+    realigned_file = File(exists=True, mandatory=True, desc='head-motion corrected 4D series')
+    acompcor_mask = File(exists=True, mandatory=True, desc='aCompCor ROI')
+    tcompcor_mask = File(exists=True, mandatory=True,
+                         desc='mask the tCompCor high variance voxels are picked in')
+    num_components = traits.Int(6, usedefault=True,
+                                desc='number of components of each CompCor')
+    percentile_threshold = traits.Range(low=0., high=1., value=.02, exclude_low=True,
+                                        usedefault=True,
+                                        desc='fraction of the voxels of tcompcor_mask with '
+                                        'the highest temporal standard deviation')
+    use_regress_poly = traits.Bool(True, usedefault=True,
+                                   desc='remove polynomial trends before the decomposition')
+    regress_poly_degree = traits.Range(low=1, value=1, usedefault=True,
+                                       desc='degree of the polynomial trends')
+    svd_method = traits.Enum('randomized', 'full', usedefault=True,
+                             desc='compute only the leading components (randomized) '
+                             'or the full SVD')
+    acompcor_file = File('acompcor.tsv', usedefault=True, desc='aCompCor components file')
+    tcompcor_file = File('tcompcor.tsv', usedefault=True, desc='tCompCor components file')
+    generate_report = traits.Bool(False, usedefault=True,
+                                  desc='plot the ROIs over the mean of the series')
+
+
+class CombinedCompCorOutputSpec(TraitedSpec):
+    acompcor_file = File(exists=True, desc='aCompCor components')
+    tcompcor_file = File(exists=True, desc='tCompCor components')
+    high_variance_mask = File(exists=True, desc='tCompCor ROI')
+    acompcor_report = File(desc='aCompCor ROI plot')
+    tcompcor_report = File(desc='tCompCor ROI plot')
+
+
+class CombinedCompCor(BaseInterface):
+    '''
+    Computes the aCompCor and tCompCor components as nipype's ``ACompCor``
+    and ``TCompCor`` do, reading the series once.
+
+    Only the voxels of the union of the masks are kept in memory (float32,
+    time by voxels). The tCompCor ROI holds the voxels of ``tcompcor_mask``
+    whose temporal standard deviation, after removing quadratic trends, is
+    in the top ``percentile_threshold``. With the ``randomized`` SVD method,
+    only the leading components are computed (Halko et al., 2011), which
+    costs a few products of the data by thin matrices instead of a full SVD.
+    Components are signed so that their largest absolute value is positive.
+    '''
+    input_spec = CombinedCompCorInputSpec
+    output_spec = CombinedCompCorOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(CombinedCompCor, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        from fmriprep.utils.nifti import image_like, save_nifti, work_file
+
+        acompcor_mask = _load_mask(self.inputs.acompcor_mask)
+        tcompcor_mask = _load_mask(self.inputs.tcompcor_mask)
+        union = acompcor_mask | tcompcor_mask
+
+        nvols = load_header(self.inputs.realigned_file).get_data_shape()[3]
+        series = np.zeros((nvols, int(union.sum())), dtype=np.float32)
+        mean = np.zeros(union.shape)
+        for i, volume in enumerate(iter_volumes(self.inputs.realigned_file)):
+            series[i] = volume[union]
+            if self.inputs.generate_report:
+                mean += volume
+        series[:, np.isnan(series.sum(axis=0))] = 0
+
+        # tCompCor ROI: the most variable voxels of its mask, after removing quadratic trends
+        in_tmask = np.flatnonzero(tcompcor_mask[union])
+        tstd = regress_poly(2, series[:, in_tmask]).std(axis=0)
+        threshold = np.percentile(tstd, 100. * (1. - self.inputs.percentile_threshold))
+        high_variance = np.zeros(series.shape[1], dtype=bool)
+        high_variance[in_tmask[tstd >= threshold]] = True
+
+        degree = self.inputs.regress_poly_degree if self.inputs.use_regress_poly else 0
+        for name, columns, header in [
+                ('acompcor', acompcor_mask[union], 'aCompCor'),
+                ('tcompcor', high_variance, 'tCompCor')]:
+            components = noise_components(series[:, columns], self.inputs.num_components,
+                                          degree=degree, method=self.inputs.svd_method)
+            out_file = op.abspath(getattr(self.inputs, name + '_file'))
+            np.savetxt(out_file, components, fmt=str('%.10f'), delimiter=str('\t'),
+                       comments='', header='\t'.join(
+                           ['{}{:02d}'.format(header, i) for i in range(components.shape[1])]))
+            self._results[name + '_file'] = out_file
+
+        mask_data = np.zeros(union.shape, dtype=np.uint8)
+        mask_data[union] = high_variance
+        out_nii = image_like(mask_data, self.inputs.tcompcor_mask)
+        out_nii.set_data_dtype(np.uint8)
+        self._results['high_variance_mask'] = op.abspath(
+            save_nifti(out_nii, work_file('high_variance_mask.nii.gz')))
+
+        if self.inputs.generate_report:
+            from fmriprep.viz.pipeline_reports import roi_overlay
+            mean_nii = image_like((mean / nvols).astype(np.float32), self.inputs.tcompcor_mask)
+            mean_nii.set_data_dtype(np.float32)
+            mean_file = save_nifti(mean_nii, work_file('mean.nii.gz'))
+            for name, roi_file, title in [
+                    ('acompcor', self.inputs.acompcor_mask, 'aCompCor ROI'),
+                    ('tcompcor', self._results['high_variance_mask'], 'tCompCor ROI')]:
+                self._results[name + '_report'] = roi_overlay(
+                    mean_file, roi_file, '{}_report.svg'.format(name), title=title)
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class RegionSignalsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D series')
+    label_files = InputMultiPath(File(exists=True), mandatory=True,
+                                 desc='a 3D image of integer labels (1 for the first '
+                                 'class), or binary masks (3D files or the volumes of a '
+                                 '4D file), one per class, which may overlap')
+    class_labels = traits.List(traits.Str, mandatory=True,
+                               desc='names of the regions, in the order of the labels')
+    detrend = traits.Bool(False, usedefault=True,
+                          desc='remove the mean and linear trend of the signals')
+    out_file = File('signals.tsv', usedefault=True, desc='output file name')
+
+
+class RegionSignalsOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='mean signal of each region, one column per region')
+
+
+class RegionSignals(BaseInterface):
+    '''
+    Mean signals of several regions, computed while streaming the series
+    once, as nipype's ``SignalExtraction`` computes them for binary maps
+    (with ``incl_shared_variance``).
+
+    Every voxel is coded by the set of regions it belongs to, so the sums of
+    all the regions of a volume come from a single ``bincount`` over the
+    voxels of any region, whether the regions overlap or not.
+    '''
+    input_spec = RegionSignalsInputSpec
+    output_spec = RegionSignalsOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(RegionSignals, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        import pandas as pd
+
+        nclasses = len(self.inputs.class_labels)
+        in_regions, sets, membership = region_codes(self.inputs.label_files, nclasses)
+        counts = np.bincount(sets, minlength=len(membership)).dot(membership)
+
+        signals = []
+        for volume in iter_volumes(self.inputs.in_file):
+            sums = np.bincount(sets, weights=volume[in_regions], minlength=len(membership))
+            signals.append(sums.dot(membership))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            signals = np.array(signals) / counts
+        if self.inputs.detrend:
+            signals = regress_poly(1, signals)
+
+        out_file = op.abspath(self.inputs.out_file)
+        pd.DataFrame(signals, columns=self.inputs.class_labels).to_csv(
+            out_file, sep=str('\t'), index=False, na_rep='n/a')
+        self._results['out_file'] = out_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def region_codes(label_files, nclasses):
+    '''
+    Boolean mask of the voxels of any region; for each voxel of the mask,
+    the index of the set of regions it belongs to; and the membership matrix
+    (sets by regions) of those sets.
+    '''
+    data = [load_data(label_file) for label_file in label_files]
+    classes = np.arange(nclasses, dtype=np.int64)
+    labeled = len(data) == 1 and data[0].ndim == 3 and nclasses > 1
+    if labeled:
+        # integer labels: each set is a single region
+        codes = np.rint(data[0]).astype(np.int64)
+        codes[(codes < 0) | (codes > nclasses)] = 0
+    else:
+        masks = np.concatenate([mask.reshape(mask.shape[:3] + (-1,)) for mask in data],
+                               axis=-1) != 0
+        if masks.shape[-1] != nclasses:
+            raise ValueError('{} masks given for {} classes'.format(masks.shape[-1],
+                                                                    nclasses))
+        # bit i of the code is set for the voxels of region i
+        codes = masks.dot(1 << classes)
+
+    in_regions = codes != 0
+    unique, inverse = np.unique(codes[in_regions], return_inverse=True)
+    if labeled:
+        membership = unique[:, np.newaxis] == classes + 1
+    else:
+        membership = (unique[:, np.newaxis] >> classes) & 1 == 1
+    return in_regions, inverse.ravel(), membership.astype(np.float64)
+
+def _load_mask(in_file):
+    mask = load_data(in_file) > 0
+    return mask[..., 0] if mask.ndim > 3 else mask
+
+
+def regress_poly(degree, data):
+    ''' Residuals of the columns of ``data`` (time by voxels) after removing
+    Legendre polynomials of up to ``degree`` (0 removes the mean) '''
+    from numpy.polynomial import Legendre
+
+    timepoints = np.linspace(-1, 1, data.shape[0])
+    design = np.column_stack([Legendre.basis(i)(timepoints) for i in range(degree + 1)])
+    betas = np.linalg.pinv(design).dot(data)
+    return data - design.dot(betas)
+
+
+def noise_components(data, num_components, degree=1, method='randomized'):
+    '''
+    Leading left singular vectors of the detrended and variance normalized
+    columns of ``data`` (time by voxels), signed so that their largest
+    absolute value is positive.
+    '''
+    data = regress_poly(degree, data.astype(np.float64))
+    stdev = data.std(axis=0)
+    stdev[(stdev == 0) | np.isnan(stdev)] = 1.
+    data /= stdev
+
+    if method == 'randomized':
+        components = randomized_components(data, num_components)
+    else:
+        components = np.linalg.svd(data, full_matrices=False)[0][:, :num_components]
+
+    signs = np.sign(components[np.abs(components).argmax(axis=0),
+                               np.arange(components.shape[1])])
+    signs[signs == 0] = 1
+    return components * signs
+
+
+def randomized_components(data, num_components, oversamples=10, n_iter=4, seed=0):
+    ''' Leading left singular vectors of ``data`` by randomized subspace
+    iteration; the full SVD is used when it is not more expensive '''
+    size = num_components + oversamples
+    if size >= min(data.shape):
+        return np.linalg.svd(data, full_matrices=False)[0][:, :num_components]
+
+    rng = np.random.RandomState(seed)
+    basis = np.linalg.qr(data.dot(rng.standard_normal((data.shape[1], size))))[0]
+    for _ in range(n_iter):
+        basis = np.linalg.qr(data.T.dot(basis))[0]
+        basis = np.linalg.qr(data.dot(basis))[0]
+    left = np.linalg.svd(basis.T.dot(data), full_matrices=False)[0]
+    return basis.dot(left)[:, :num_components]
+
+
+def streaming_dvars(in_file, mask, remove_zerovariance=True, intensity_normalization=1000.,
+                    buffer_file='dvars_buffer.dat', chunk_size=50000):
+    '''
+    Standardized, non-standardized and voxelwise-standardized DVARS, following
+    the definitions of ``nipype.algorithms.confounds.compute_dvars``.
+
+    The intensity normalization is a global scaling, so it only affects the
+    non-standardized DVARS and is applied at the end.
+    '''
+    nvox = int(mask.sum())
+    nvols = load_header(in_file).get_data_shape()[3]
+    buffer_file = op.abspath(buffer_file)
+    series = np.memmap(buffer_file, dtype=np.float32, mode='w+', shape=(nvols, nvox))
+
+    # Lag-1 autocovariance accumulators, relative to the first volume for stability
+    first = None
+    total = np.zeros(nvox)
+    squares = np.zeros(nvox)
+    lagged = np.zeros(nvox)
+    previous = None
+    for i, volume in enumerate(iter_volumes(in_file)):
+        series[i] = volume[mask]
+        if first is None:
+            first = series[i].astype(np.float64)
+        current = series[i] - first
+        total += current
+        squares += current ** 2
+        if previous is not None:
+            lagged += previous * current
+        previous = current
+    series.flush()
+
+    mean = total / nvols
+    # sum_t (x_t - m)(x_t+1 - m) and sum_t (x_t - m)^2
+    autocov = lagged - mean * (2 * total - previous) + (nvols - 1) * mean ** 2
+    variance = squares - nvols * mean ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ar1 = np.where(variance > 0, autocov / variance, 0.)
+
+    func_sd = np.zeros(nvox)
+    for start in range(0, nvox, chunk_size):
+        chunk = np.asarray(series[:, start:start + chunk_size])
+        func_sd[start:start + chunk_size] = (
+            _percentile_lower(chunk, 75) - _percentile_lower(chunk, 25)) / 1.349
+
+    keep = func_sd > 0 if remove_zerovariance else np.ones(nvox, dtype=bool)
+    diff_sdhat = np.sqrt((1 - ar1[keep]) * 2) * func_sd[keep]
+    diff_sd_mean = diff_sdhat.mean()
+
+    dvars_nstd = np.zeros(nvols - 1)
+    dvars_vx_stdz = np.zeros(nvols - 1)
+    for i in range(1, nvols):
+        diff = (series[i] - series[i - 1])[keep].astype(np.float64)
+        dvars_nstd[i - 1] = np.sqrt((diff ** 2).mean())
+        dvars_vx_stdz[i - 1] = np.sqrt(((diff / diff_sdhat) ** 2).mean())
+    dvars_stdz = dvars_nstd / diff_sd_mean
+
+    if intensity_normalization != 0:
+        dvars_nstd *= intensity_normalization / _buffer_median(series, chunk_size)
+
+    del series
+    os.remove(buffer_file)
+    return dvars_stdz, dvars_nstd, dvars_vx_stdz
+
+
+def _percentile_lower(data, percentile):
+    try:
+        return np.percentile(data, percentile, axis=0, method='lower')
+    except TypeError:  # numpy < 1.22
+        return np.percentile(data, percentile, axis=0, interpolation='lower')
+
+
+def _buffer_median(series, chunk_size, nbins=65536):
+    ''' Exact median of a large disk-backed array, reading it in chunks '''
+    nrows = series.shape[0]
+    step = max(1, chunk_size // max(series.shape[1], 1)) * 64
+
+    def _chunks():
+        for start in range(0, nrows, step):
+            yield np.asarray(series[start:start + step]).ravel()
+
+    low = min([chunk.min() for chunk in _chunks()])
+    high = max([chunk.max() for chunk in _chunks()])
+    if low == high:
+        return float(low)
+
+    edges = np.linspace(low, high, nbins + 1)
+    counts = np.zeros(nbins, dtype=np.int64)
+    for chunk in _chunks():
+        counts += np.histogram(chunk, bins=edges)[0]
+
+    # the median is the average of the values at these (zero-based) ranks
+    size = series.size
+    ranks = [(size - 1) // 2, size // 2]
+    cumulative = np.cumsum(counts)
+    bins = [int(np.searchsorted(cumulative, rank, side='right')) for rank in ranks]
+    lo_edge, hi_edge = edges[min(bins)], edges[max(bins) + 1]
+    below = cumulative[min(bins) - 1] if min(bins) > 0 else 0
+
+    candidates = []
+    for chunk in _chunks():
+        selected = chunk[(chunk >= lo_edge) & (chunk <= hi_edge)]
+        if max(bins) < nbins - 1:
+            # values on the upper edge belong to the next bin
+            selected = selected[selected < hi_edge]
+        candidates.append(selected)
+    candidates = np.sort(np.hstack(candidates))
+    return float(np.mean([candidates[rank - below] for rank in ranks]))
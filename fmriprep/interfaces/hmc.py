@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+In-process head-motion correction.
+
+Each volume is registered to the reference with a rigid-body Gauss-Newton
+solver that runs coarse-to-fine over a subsampled pyramid. Volumes are
+independent, so they are distributed over a pool of workers.
+'''
+import os.path as op
+import multiprocessing as mp
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage as nd
+
+from nipype import logging
+from nipype.interfaces.base import (traits, isdefined, TraitedSpec, BaseInterface,
+                                    BaseInterfaceInputSpec, File, InputMultiPath,
+                                    OutputMultiPath)
+
+from fmriprep.interfaces.bids import _splitext
+from fmriprep.utils.nifti import save_nifti, work_file, load_header
+from fmriprep.utils.motion import (PARAMETER_NAMES, rigid_matrix, voxel_to_mm,
+                                   framewise_displacement, load_parameters, load_ants_moco,
+                                   centered_matrices, matrix_parameters, rms_displacement,
+                                   relative_matrices, native_world_matrices,
+                                   fsl_world_matrices, fov_center)
+
+LOGGER = logging.getLogger('interface')
+
+
+class NativeMotionCorrInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D EPI series')
+    ref_file = File(exists=True, desc='reference volume (defaults to the middle volume)')
+    levels = traits.List(traits.Int, [4, 2, 1], usedefault=True,
+                         desc='pyramid subsampling factors, coarse to fine')
+    max_iter = traits.Int(10, usedefault=True, desc='maximum iterations per level')
+    tolerance = traits.Float(1e-4, usedefault=True,
+                             desc='stop iterating when the update is below this norm')
+    interp_order = traits.Range(low=0, high=5, value=3, usedefault=True,
+                                desc='spline order used to resample the corrected volumes')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='number of volumes registered in parallel')
+    parallel = traits.Enum('processes', 'threads', usedefault=True, nohash=True,
+                           desc='type of worker pool')
+
+
+class NativeMotionCorrOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='motion corrected series')
+    par_file = File(exists=True, desc='motion parameters, FSL .par layout')
+    mean_img = File(exists=True, desc='mean of the corrected series')
+
+
+class NativeMotionCorr(BaseInterface):
+    '''
+    Rigid-body head-motion correction implemented with NumPy/SciPy.
+
+    >>> hmc = NativeMotionCorr(in_file='sub-01_task-rest_bold.nii.gz', num_threads=8)
+    >>> hmc.run() # doctest: +SKIP
+    '''
+    input_spec = NativeMotionCorrInputSpec
+    output_spec = NativeMotionCorrOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(NativeMotionCorr, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        in_nii = nb.load(self.inputs.in_file)
+        series = np.asanyarray(in_nii.dataobj, dtype=np.float32)
+        zooms = in_nii.header.get_zooms()[:3]
+        nvols = series.shape[-1]
+
+        if isdefined(self.inputs.ref_file):
+            reference = np.asanyarray(nb.load(self.inputs.ref_file).dataobj,
+                                      dtype=np.float32)
+        else:
+            reference = series[..., nvols // 2]
+        reference = np.squeeze(reference)
+
+        levels = setup_levels(reference, zooms, self.inputs.levels)
+        args = [(series[..., i], self.inputs.max_iter, self.inputs.tolerance)
+                for i in range(nvols)]
+
+        nprocs = max(1, min(self.inputs.num_threads, nvols))
+        LOGGER.info('Registering %d volumes over %d %s', nvols, nprocs, self.inputs.parallel)
+        params = _run_pool(args, levels, nprocs, self.inputs.parallel)
+        params = np.array(params)
+
+        vox2mm = voxel_to_mm(reference.shape, zooms)
+        mm2vox = np.linalg.inv(vox2mm)
+        corrected = np.zeros(reference.shape + (nvols,), dtype=np.float32)
+        for i, vol_params in enumerate(params):
+            matrix = mm2vox.dot(rigid_matrix(vol_params)).dot(vox2mm)
+            corrected[..., i] = nd.affine_transform(
+                series[..., i], matrix[:3, :3], offset=matrix[:3, 3],
+                order=self.inputs.interp_order, mode='constant', cval=0.)
+
+        fname, _ = _splitext(self.inputs.in_file)
+        hdr = in_nii.header.copy()
+        hdr.set_data_dtype(np.float32)
+
+        out_file = op.abspath(work_file(fname + '_mcf.nii.gz'))
+        save_nifti(nb.Nifti1Image(corrected, in_nii.affine, hdr), out_file)
+        self._results['out_file'] = out_file
+
+        mean_img = op.abspath(work_file(fname + '_mcf_mean.nii.gz'))
+        hdr.set_data_shape(reference.shape)
+        save_nifti(nb.Nifti1Image(corrected.mean(axis=-1), in_nii.affine, hdr), mean_img)
+        self._results['mean_img'] = mean_img
+
+        par_file = op.abspath(fname + '_mcf.par')
+        np.savetxt(par_file, params, fmt=str('%.6f'), delimiter=str('  '))
+        self._results['par_file'] = par_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+
+class AntsMotionParametersInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc='MOCOparams.csv file written by antsMotionCorr')
+    reference = File(exists=True, mandatory=True,
+                     desc='fixed image given to antsMotionCorr')
+    radius = traits.Float(50, usedefault=True,
+                          desc='head radius in mm to calculate FD and RMS displacements')
+
+
+class AntsMotionParametersOutputSpec(TraitedSpec):
+    par_file = File(exists=True, desc='motion parameters, FSL .par layout')
+    out_file = File(exists=True, desc='framewise displacement and RMS displacements')
+
+
+class AntsMotionParameters(BaseInterface):
+    '''
+    Reads the transforms estimated by ``antsMotionCorr`` once and converts them
+    into motion parameters, framewise displacement and absolute and relative
+    RMS displacements for all volumes at once, without calling out to ANTs.
+    The parameters are given in world coordinates, around the center of the
+    field of view of the reference (see ``fmriprep.utils.motion``).
+    '''
+    input_spec = AntsMotionParametersInputSpec
+    output_spec = AntsMotionParametersOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(AntsMotionParameters, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        import pandas as pd
+
+        ref_header = load_header(self.inputs.reference)
+        affine, shape = ref_header.get_best_affine(), ref_header.get_data_shape()
+        matrices = centered_matrices(load_ants_moco(self.inputs.in_file, affine, shape),
+                                     affine, shape)
+        params = matrix_parameters(matrices)
+        rms_abs, rms_rel = rms_displacement(matrices, radius=self.inputs.radius)
+
+        fname = op.splitext(op.basename(self.inputs.in_file))[0]
+        par_file = op.abspath(fname + '.par')
+        np.savetxt(par_file, params, fmt=str('%.6f'), delimiter=str('  '))
+        self._results['par_file'] = par_file
+
+        out_file = op.abspath(fname + '_displacement.tsv')
+        pd.DataFrame({
+            'FramewiseDisplacement': np.hstack((
+                0., framewise_displacement(params, radius=self.inputs.radius))),
+            'AbsoluteRMS': rms_abs,
+            'RelativeRMS': rms_rel,
+        }, columns=['FramewiseDisplacement', 'AbsoluteRMS', 'RelativeRMS']).to_csv(
+            out_file, sep=str('\t'), index=False, float_format=str('%.6f'))
+        self._results['out_file'] = out_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class HarmonizeMotionInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='motion estimates: the .par file of the native engine, '
+                              'the MAT_* files of MCFLIRT (in order) or the '
+                              'MOCOparams.csv file of antsMotionCorr')
+    convention = traits.Enum('native', 'fsl', 'ants', mandatory=True,
+                             desc='engine that estimated the motion')
+    reference = File(exists=True, mandatory=True,
+                     desc='reference the series was registered to (the series is '
+                     'assumed to share its grid)')
+
+
+class HarmonizeMotionOutputSpec(TraitedSpec):
+    par_file = File(exists=True, desc='world motion parameters, FSL .par layout')
+
+
+class HarmonizeMotion(BaseInterface):
+    '''
+    Converts the motion estimated by an engine, in its own frame, into world
+    motion parameters: rotations around the center of the field of view of the
+    reference and translations along the RAS+ axes, from the reference to each
+    volume (see ``fmriprep.utils.motion``). Engines can then be compared with
+    each other and with a ground truth.
+    '''
+    input_spec = HarmonizeMotionInputSpec
+    output_spec = HarmonizeMotionOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(HarmonizeMotion, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        ref_header = load_header(self.inputs.reference)
+        affine = ref_header.get_best_affine()
+        shape = ref_header.get_data_shape()[:3]
+
+        if self.inputs.convention == 'native':
+            matrices = native_world_matrices(
+                load_parameters(self.inputs.in_files[0])[:, :6], affine, shape,
+                ref_header.get_zooms()[:3])
+        elif self.inputs.convention == 'fsl':
+            matrices = fsl_world_matrices(
+                [np.loadtxt(in_file) for in_file in self.inputs.in_files],
+                ref_header, ref_header)
+        else:
+            matrices = load_ants_moco(self.inputs.in_files[0], affine, shape)
+
+        par_file = op.abspath('{}_world.par'.format(self.inputs.convention))
+        np.savetxt(par_file, matrix_parameters(centered_matrices(matrices, affine, shape)),
+                   fmt=str('%.6f'), delimiter=str('  '))
+        self._results['par_file'] = par_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class SplitChunksInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='4D EPI series')
+    chunk_size = traits.Range(low=1, mandatory=True, desc='volumes per chunk')
+
+
+class SplitChunksOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(File(exists=True), desc='consecutive temporal chunks')
+
+
+class SplitChunks(BaseInterface):
+    '''
+    Splits a 4D series into consecutive chunks of ``chunk_size`` volumes, so
+    that they can be head-motion corrected in parallel against a common
+    reference. A last chunk shorter than half ``chunk_size`` is merged into
+    the previous one.
+    '''
+    input_spec = SplitChunksInputSpec
+    output_spec = SplitChunksOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(SplitChunks, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        in_nii = nb.load(self.inputs.in_file)
+        nvols = in_nii.shape[-1] if len(in_nii.shape) > 3 else 1
+        bounds = chunk_bounds(nvols, self.inputs.chunk_size)
+
+        fname, _ = _splitext(self.inputs.in_file)
+        self._results['out_files'] = []
+        for i, (start, stop) in enumerate(bounds):
+            out_file = op.abspath('{}_chunk{:04d}.nii'.format(fname, i))
+            save_nifti(nb.Nifti1Image(in_nii.dataobj[..., start:stop], in_nii.affine,
+                                      in_nii.header), out_file)
+            self._results['out_files'].append(out_file)
+
+        LOGGER.info('Split %d volumes into %d chunks', nvols, len(bounds))
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class MergeChunksInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='corrected chunks, in temporal order')
+    in_params = InputMultiPath(File(exists=True), mandatory=True,
+                               desc='motion parameters of each chunk, in temporal order')
+    out_file = File(desc='output series file name')
+
+
+class MergeChunksOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='corrected series')
+    par_file = File(exists=True, desc='motion parameters of the whole series')
+
+
+class MergeChunks(BaseInterface):
+    '''
+    Stitches the outputs of a chunked head-motion correction back together:
+    the corrected chunks are concatenated along time and the parameter files
+    appended in order (keeping only the first header line, if any).
+    '''
+    input_spec = MergeChunksInputSpec
+    output_spec = MergeChunksOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(MergeChunks, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        out_file = self.inputs.out_file
+        if not isdefined(out_file):
+            fname, ext = _splitext(self.inputs.in_files[0])
+            out_file = fname.replace('_chunk0000', '') + '_merged' + ext
+        out_file = op.abspath(out_file)
+
+        niis = [nb.load(in_file) for in_file in self.inputs.in_files]
+        save_nifti(nb.Nifti1Image(
+            np.concatenate([np.asanyarray(nii.dataobj) for nii in niis], axis=-1),
+            niis[0].affine, niis[0].header), out_file)
+        self._results['out_file'] = out_file
+
+        fname, ext = _splitext(self.inputs.in_params[0])
+        par_file = op.abspath(fname.replace('_chunk0000', '') + '_merged' + ext)
+        with open(par_file, 'w') as out_fobj:
+            for i, in_params in enumerate(self.inputs.in_params):
+                with open(in_params) as in_fobj:
+                    lines = in_fobj.readlines()
+                if i > 0 and lines and not _is_numeric(lines[0]):
+                    lines = lines[1:]
+                out_fobj.writelines(line if line.endswith('\n') else line + '\n'
+                                    for line in lines)
+        self._results['par_file'] = par_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+class CompareMotionInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc='world motion parameters of each engine (see '
+                              'HarmonizeMotion), FSL .par layout')
+    labels = traits.List(traits.Str, desc='name of each engine')
+    in_mask = File(exists=True, mandatory=True,
+                   desc='mask of the voxels where displacements are compared, on the '
+                   'grid of the reference the parameters were harmonized with')
+    radius = traits.Float(50, usedefault=True,
+                          desc='head radius in mm to calculate FD differences')
+    chunk_size = traits.Int(3000000, usedefault=True, nohash=True,
+                            desc='displacements evaluated at once (volumes x voxels)')
+
+
+class CompareMotionOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc='per-volume differences between engines')
+    summary_file = File(exists=True, desc='summary statistics of the agreement')
+
+
+class CompareMotion(BaseInterface):
+    '''
+    Compares the world motion parameters estimated by several engines on the
+    same run. For every pair of engines, writes per-volume absolute differences
+    of each parameter, from the reference (absolute) and from the previous
+    volume (relative), the FD of the difference trace, and the mean and maximum
+    disagreement of the displacement fields over the mask; plus a JSON summary
+    with the correlations of the traces.
+    '''
+    input_spec = CompareMotionInputSpec
+    output_spec = CompareMotionOutputSpec
+
+    def __init__(self, **inputs):
+        self._results = {}
+        super(CompareMotion, self).__init__(**inputs)
+
+    def _run_interface(self, runtime):
+        import json
+        from itertools import combinations
+        import pandas as pd
+
+        labels = self.inputs.labels
+        if not isdefined(labels):
+            labels = ['engine{}'.format(i) for i in range(len(self.inputs.in_files))]
+        if len(labels) != len(self.inputs.in_files):
+            raise ValueError('One label is required per parameters file')
+
+        traces = [load_parameters(in_file)[:, :6] for in_file in self.inputs.in_files]
+        nvols = min(len(trace) for trace in traces)
+        if any(len(trace) != nvols for trace in traces):
+            LOGGER.warning('Motion traces of different lengths, comparing the first '
+                           '%d volumes', nvols)
+        traces = [trace[:nvols] for trace in traces]
+        matrices = [rigid_matrix(trace) for trace in traces]
+        # volume to volume motion, none for the first volume
+        relatives = [np.concatenate((np.eye(4)[np.newaxis], relative_matrices(matrix)))
+                     for matrix in matrices]
+
+        # world coordinates around the center of the field of view, as the parameters
+        mask_nii = nb.load(self.inputs.in_mask)
+        mask = np.asanyarray(mask_nii.dataobj) > 0
+        if mask.ndim > 3:
+            mask = mask[..., 0]
+        points = (np.transpose(np.nonzero(mask)).dot(mask_nii.affine[:3, :3].T) +
+                  mask_nii.affine[:3, 3] - fov_center(mask_nii.affine, mask.shape))
+
+        table = pd.DataFrame(index=np.arange(nvols))
+        summary = {}
+        for index_a, index_b in combinations(range(len(labels)), 2):
+            pair = '{}_vs_{}'.format(labels[index_a], labels[index_b])
+            trace_a, trace_b = traces[index_a], traces[index_b]
+            difference = trace_a - trace_b
+            relative = (matrix_parameters(relatives[index_a]) -
+                        matrix_parameters(relatives[index_b]))
+            for i, name in enumerate(PARAMETER_NAMES):
+                table['{}_{}'.format(pair, name)] = np.abs(difference[:, i])
+            for i, name in enumerate(PARAMETER_NAMES):
+                table['{}_rel_{}'.format(pair, name)] = np.abs(relative[:, i])
+            table[pair + '_fd'] = np.hstack((0., framewise_displacement(
+                difference, radius=self.inputs.radius)))
+
+            disp_mean, disp_max = displacement_disagreement(
+                matrices[index_a], matrices[index_b], points,
+                chunk_size=self.inputs.chunk_size)
+            table[pair + '_disp_mean'] = disp_mean
+            table[pair + '_disp_max'] = disp_max
+            rel_mean, rel_max = displacement_disagreement(
+                relatives[index_a], relatives[index_b], points,
+                chunk_size=self.inputs.chunk_size)
+            table[pair + '_rel_disp_mean'] = rel_mean
+            table[pair + '_rel_disp_max'] = rel_max
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlation = [np.corrcoef(trace_a[:, i], trace_b[:, i])[0, 1]
+                               for i in range(6)]
+            summary[pair] = {
+                'correlation': dict(zip(PARAMETER_NAMES, _nan_to_none(correlation))),
+                'mean_abs_difference': dict(zip(
+                    PARAMETER_NAMES, np.abs(difference).mean(axis=0).tolist())),
+                'max_abs_difference': dict(zip(
+                    PARAMETER_NAMES, np.abs(difference).max(axis=0).tolist())),
+                'rel_mean_abs_difference': dict(zip(
+                    PARAMETER_NAMES, np.abs(relative).mean(axis=0).tolist())),
+                'rel_max_abs_difference': dict(zip(
+                    PARAMETER_NAMES, np.abs(relative).max(axis=0).tolist())),
+                'disp_mean_mm': float(disp_mean.mean()),
+                'disp_max_mm': float(disp_max.max()),
+                'rel_disp_mean_mm': float(rel_mean.mean()),
+                'rel_disp_max_mm': float(rel_max.max()),
+            }
+
+        out_file = op.abspath('motion_comparison.tsv')
+        table.to_csv(out_file, sep=str('\t'), index=False, float_format=str('%.6f'))
+        self._results['out_file'] = out_file
+
+        summary_file = op.abspath('motion_comparison.json')
+        with open(summary_file, 'w') as fobj:
+            json.dump(summary, fobj, indent=2, sort_keys=True)
+        self._results['summary_file'] = summary_file
+        return runtime
+
+    def _list_outputs(self):
+        return self._results
+
+
+def displacement_disagreement(matrices_a, matrices_b, points, chunk_size=3000000):
+    '''
+    Mean and maximum distance, per volume, between the positions that two
+    series of rigid-body matrices assign to the same points (N x 3, mm).
+    '''
+    delta = np.asanyarray(matrices_a) - np.asanyarray(matrices_b)
+    nvols = len(delta)
+    total = np.zeros(nvols)
+    largest = np.zeros(nvols)
+    step = max(1, chunk_size // max(nvols, 1))
+    for start in range(0, len(points), step):
+        chunk = points[start:start + step]
+        distances = np.linalg.norm(
+            np.einsum('nij,pj->npi', delta[:, :3, :3], chunk) + delta[:, np.newaxis, :3, 3],
+            axis=2)
+        total += distances.sum(axis=1)
+        largest = np.maximum(largest, distances.max(axis=1))
+    return total / max(len(points), 1), largest
+
+
+def chunk_bounds(nvols, chunk_size):
+    ''' (start, stop) volume indices of the temporal chunks of a series '''
+    starts = list(range(0, nvols, chunk_size))
+    if len(starts) > 1 and nvols - starts[-1] < chunk_size / 2.:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [nvols]))
+
+
+def _is_numeric(line):
+    try:
+        [float(value) for value in line.replace(',', ' ').split()]
+    except ValueError:
+        return False
+    return True
+
+
+def _nan_to_none(values):
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def setup_levels(reference, zooms, factors):
+    ''' Precompute, for each pyramid level, the sampling grid (mm), the reference
+    intensities on it and the pseudo-inverse of the (fixed) Gauss-Newton Jacobian. '''
+    vox2mm = voxel_to_mm(reference.shape, zooms)
+    mm2vox = np.linalg.inv(vox2mm)
+
+    levels = []
+    for factor in factors:
+        sigma = 0.5 * factor if factor > 1 else 0.
+        smoothed = nd.gaussian_filter(reference, sigma) if sigma else reference
+        grid = tuple(slice(0, n, factor) for n in reference.shape)
+        samples = smoothed[grid]
+        # Only register within the head, the background only adds noise
+        inside = samples > samples.mean()
+
+        index = np.array(np.nonzero(inside), dtype=np.float64) * factor
+        points = vox2mm[:3, :3].dot(index).T + vox2mm[:3, 3]
+        gradient = np.array([g[grid][inside] for g in np.gradient(smoothed, *zooms)]).T
+
+        jacobian = np.empty((len(points), 6))
+        for axis in range(3):
+            # derivative of a small rotation around axis is the cross product
+            jacobian[:, axis] = (gradient * np.cross(np.eye(3)[axis], points)).sum(axis=1)
+        jacobian[:, 3:] = gradient
+
+        levels.append({
+            'sigma': sigma,
+            'points': points,
+            'mm2vox': mm2vox,
+            'target': samples[inside],
+            'solver': np.linalg.pinv(jacobian),
+        })
+    return levels
+
+
+def register_volume(moving, levels, max_iter=10, tolerance=1e-4):
+    ''' Estimate the rigid-body parameters that bring ``moving`` onto the reference '''
+    params = np.zeros(6)
+    for level in levels:
+        smoothed = nd.gaussian_filter(moving, level['sigma']) if level['sigma'] else moving
+        points = np.hstack((level['points'], np.ones((len(level['points']), 1)))).T
+        for _ in range(max_iter):
+            matrix = level['mm2vox'].dot(rigid_matrix(params))
+            index = matrix.dot(points)[:3]
+            warped = nd.map_coordinates(smoothed, index, order=1, mode='nearest')
+            update = level['solver'].dot(warped - level['target'])
+            params -= update
+            if np.linalg.norm(update) < tolerance:
+                break
+    return params
+
+
+def _register_worker(args, levels):
+    return register_volume(args[0], levels, *args[1:])
+
+
+def _run_pool(args, levels, nprocs, parallel='processes'):
+    if nprocs == 1:
+        return [_register_worker(arg, levels) for arg in args]
+
+    # daemonic processes (e.g. some nipype plugins) are not allowed to have children
+    if parallel == 'threads' or mp.current_process().daemon:
+        pool = ThreadPool(nprocs)
+    else:
+        pool = mp.Pool(nprocs)
+    try:
+        # one batch per worker, so that processes receive the set-up only once
+        return pool.map(partial(_register_worker, levels=levels), args,
+                        chunksize=-(-len(args) // nprocs))
+    finally:
+        pool.close()
+        pool.join()
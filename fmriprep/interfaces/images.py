@@ -2,7 +2,6 @@ import json
 import re
 import os
 import os.path as op
-from shutil import copy
 
 from nipype import logging
 from nipype.interfaces.base import (
@@ -12,6 +11,7 @@ from nipype.interfaces.base import (
 
 from fmriprep.interfaces.bids import _splitext 
 from fmriprep.utils.misc import make_folder
+from fmriprep.utils.publish import publish_file, PUBLISH_MODES
 
 class ImageDataSinkInputSpec(BaseInterfaceInputSpec):
     base_directory = traits.Directory(
@@ -20,6 +20,8 @@ class ImageDataSinkInputSpec(BaseInterfaceInputSpec):
     base_file = traits.Str(desc='the input func file')
     overlay_file = traits.Str(desc='the input func file')
     origin_file = traits.Str(desc='File from the dataset that image is primarily derived from')
+    publish_mode = traits.Enum(*PUBLISH_MODES, usedefault=True,
+                               desc='hardlink or reflink the image if possible, or copy it')
 
 class ImageDataSinkOutputSpec(TraitedSpec):
     out_file = OutputMultiPath(File(exists=True, desc='written file path'))
@@ -34,8 +36,6 @@ class ImageDataSink(BaseInterface):
         super(ImageDataSink, self).__init__(**inputs)
 
     def _run_interface(self, runtime):
-        origin_fname, _ = _splitext(self.inputs.origin_file)
-
         image_inputs = {}
         if isdefined(self.inputs.base_file):
             image_inputs['base_file'] = self.inputs.base_file
@@ -44,45 +44,54 @@ class ImageDataSink(BaseInterface):
         if isdefined(self.inputs.origin_file):
             image_inputs['origin_file'] = self.inputs.overlay_file
 
-        m = re.search(
-            '^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?'
-            '(_(?P<task_id>task-[a-zA-Z0-9]+))?(_(?P<acq_id>acq-[a-zA-Z0-9]+))?'
-            '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?(_(?P<run_id>run-[a-zA-Z0-9]+))?',
-            origin_fname
-        )
-
         base_directory = os.getcwd()
         if isdefined(self.inputs.base_directory):
             base_directory = op.abspath(self.inputs.base_directory)
 
-        out_path = 'images/{subject_id}'.format(**m.groupdict())
+        out_file = image_path(self.inputs.in_file, self.inputs.origin_file,
+                              base_directory, image_inputs)
 
-        out_path = op.join(base_directory, out_path)
+        self._results['out_file'].append(out_file)
+        publish_file(self.inputs.in_file, out_file, mode=self.inputs.publish_mode)
 
-        make_folder(out_path)
+        return runtime
 
-        _, out_filename = op.split(self.inputs.in_file)
+    def _list_outputs(self):
+        return self._results
 
-        #  test incoming origin file for these identifiers, if they exist
-        #  we want to fold them into out filename
-        group_keys = ['ses_id', 'task_id', 'acq_id', 'rec_id', 'run_id']
-        if [x for x in group_keys if m.groupdict().get(x)]:
-            out_filename, ext = _splitext(out_filename)
-            out_filename = '{}_{}.{}'.format(out_filename, origin_fname, ext)
 
-        out_file = op.join(out_path, out_filename)
+def image_path(in_file, origin_file, base_directory, image_inputs):
+    ''' Creates the images folder of the subject of ``origin_file`` and the
+    JSON describing the image inputs, and returns the path of the image '''
+    origin_fname, _ = _splitext(origin_file)
 
+    m = re.search(
+        '^(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<ses_id>ses-[a-zA-Z0-9]+))?'
+        '(_(?P<task_id>task-[a-zA-Z0-9]+))?(_(?P<acq_id>acq-[a-zA-Z0-9]+))?'
+        '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?(_(?P<run_id>run-[a-zA-Z0-9]+))?',
+        origin_fname
+    )
 
-        self._results['out_file'].append(out_file)
-        copy(self.inputs.in_file, out_file)
-        json_fname, _ = _splitext(out_filename)
+    out_path = 'images/{subject_id}'.format(**m.groupdict())
 
-        json_out_filename = '{}.{}'.format(json_fname, 'json')
-        json_out_file = op.join(out_path, json_out_filename)
-        with open(json_out_file, 'w') as fp:
-            json.dump(image_inputs, fp)
+    out_path = op.join(base_directory, out_path)
 
-        return runtime
+    make_folder(out_path)
 
-    def _list_outputs(self):
-        return self._results
+    _, out_filename = op.split(in_file)
+
+    #  test incoming origin file for these identifiers, if they exist
+    #  we want to fold them into out filename
+    group_keys = ['ses_id', 'task_id', 'acq_id', 'rec_id', 'run_id']
+    if [x for x in group_keys if m.groupdict().get(x)]:
+        out_filename, ext = _splitext(out_filename)
+        out_filename = '{}_{}.{}'.format(out_filename, origin_fname, ext)
+
+    json_fname, _ = _splitext(out_filename)
+
+    json_out_filename = '{}.{}'.format(json_fname, 'json')
+    json_out_file = op.join(out_path, json_out_filename)
+    with open(json_out_file, 'w') as fp:
+        json.dump(image_inputs, fp)
+
+    return op.join(out_path, out_filename)
@@ -8,6 +8,8 @@ import nibabel as nb
 from nipype.interfaces.base import (traits, TraitedSpec, BaseInterface,
                                     BaseInterfaceInputSpec, File)
 
+from fmriprep.utils.nifti import save_nifti
+
 LOG = logging.getLogger('binarizesegmentationinterface')
 
 class BinarizeSegmentationInputSpec(BaseInterfaceInputSpec):
@@ -49,7 +51,7 @@ class BinarizeSegmentation(BaseInterface):
         bimap = mapper(segments_data)
 
         bimap_nii = nb.Nifti1Image(bimap.astype(int), segments_affine)
-        nb.nifti1.save(bimap_nii, output_filename)
+        save_nifti(bimap_nii, output_filename)
         self._results['out_mask'] = output_filename
 
         LOG.debug('BinarizeSegmentation interface saved mask of shape %s to file %s',
@@ -108,56 +108,32 @@ def _tsv_format(translations, rot_angles, fmt='confounds'):
 def nii_concat(in_files):
     from nibabel.funcs import concat_images
     import os
+    from fmriprep.utils.nifti import save_nifti, work_file
     new_nii = concat_images(in_files, check_affines=False)
 
-    new_nii.to_filename("merged.nii.gz")
+    return os.path.abspath(save_nifti(new_nii, work_file("merged.nii.gz")))
 
-    return os.path.abspath("merged.nii.gz")
+
+def decompress_nii(in_file):
+    import os
+    import gzip
+    from shutil import copyfileobj
+
+    if not in_file.endswith('.gz'):
+        return in_file
+
+    out_file = os.path.abspath(os.path.basename(in_file)[:-3])
+    with gzip.open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+        copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+    return out_file
 
 
 def reorient(in_file):
     import os
     import nibabel as nb
+    from fmriprep.utils.nifti import save_nifti
 
     _, outfile = os.path.split(in_file)
     nii = nb.as_closest_canonical(nb.load(in_file))
-    nii.to_filename(outfile)
+    save_nifti(nii, outfile)
     return os.path.abspath(outfile)
-
-
-def prepare_roi_from_probtissue(in_file, epi_mask, epi_mask_erosion_mm=0,
-                                erosion_mm=0):
-    import os
-    import nibabel as nb
-    import scipy.ndimage as nd
-
-    probability_map_nii = nb.load(in_file)
-    probability_map_data = probability_map_nii.get_data()
-
-    # thresholding
-    probability_map_data[probability_map_data < 0.95] = 0
-    probability_map_data[probability_map_data != 0] = 1
-
-    epi_mask_nii = nb.load(epi_mask)
-    epi_mask_data = epi_mask_nii.get_data()
-    if epi_mask_erosion_mm:
-        epi_mask_data = nd.binary_erosion(epi_mask_data,
-                                      iterations=int(epi_mask_erosion_mm/max(probability_map_nii.header.get_zooms()))).astype(int)
-        eroded_mask_file = os.path.abspath("erodd_mask.nii.gz")
-        nb.Nifti1Image(epi_mask_data, epi_mask_nii.affine, epi_mask_nii.header).to_filename(eroded_mask_file)
-    else:
-        eroded_mask_file = epi_mask
-    probability_map_data[epi_mask_data != 1] = 0
-
-    # shrinking
-    if erosion_mm:
-        iter_n = int(erosion_mm/max(probability_map_nii.header.get_zooms()))
-        probability_map_data = nd.binary_erosion(probability_map_data,
-                                                 iterations=iter_n).astype(int)
-
-
-    new_nii = nb.Nifti1Image(probability_map_data, probability_map_nii.affine,
-                             probability_map_nii.header)
-    new_nii.to_filename("roi.nii.gz")
-    return os.path.abspath("roi.nii.gz"), eroded_mask_file
-
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Head-motion correction benchmark
+=====
+Runs the shared reference trunk and then every HMC branch on each functional
+run of a BIDS dataset, recording per-node wall time, CPU time and peak memory,
+and the accuracy of the estimated parameters when a ground truth is available.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import os.path as op
+import glob
+import sys
+from argparse import ArgumentParser
+from argparse import RawTextHelpFormatter
+from multiprocessing import cpu_count
+
+# Engine name -> workflow factory
+ENGINES = {
+    'ants': 'test_ants',
+    'fsl': 'test_fsl',
+    'native': 'test_native',
+}
+
+SUMMARY_FIELDS = ['engine', 'n_nodes', 'failed_nodes', 'wall_time_s', 'cpu_time_s',
+                  'peak_rss_gb', 'rot_rmse_deg', 'rot_max_deg', 'trans_rmse_mm',
+                  'trans_max_mm']
+
+CONSTRUCTION_FIELDS = ['n_subjects', 'n_runs', 'n_nodes', 'index_time_s', 'build_time_s',
+                       'build_time_per_subject_s']
+
+RESAMPLING_FIELDS = ['method', 'interp', 'map', 'time_s', 'roi_voxels', 'roi_dice',
+                     'max_abs_diff']
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Head-motion correction benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('bids_dir', action='store')
+    parser.add_argument('output_dir', action='store')
+    parser.add_argument('--participant_label', action='store', nargs='+')
+    parser.add_argument('--task-id', action='store',
+                        help='limit the benchmark only to one task')
+    parser.add_argument('--engines', action='store', nargs='+', choices=sorted(ENGINES),
+                        default=sorted(ENGINES), help='HMC branches to benchmark')
+    parser.add_argument('--ground-truth-dir', action='store',
+                        help='directory holding <bold filename>_motion.par files')
+    parser.add_argument('--hmc-nthreads', action='store', default=0, type=int,
+                        help='number of volumes registered in parallel by the native HMC')
+    parser.add_argument('--hmc-chunk-size', action='store', default=0, type=int,
+                        help='split each run into chunks of this many volumes that are '
+                             'head-motion corrected in parallel (0 disables chunking)')
+    parser.add_argument('-w', '--work-dir', action='store',
+                        default=op.join(os.getcwd(), 'work'))
+
+    opts = parser.parse_args()
+    run_benchmark(opts)
+
+
+def run_benchmark(opts):
+    from fmriprep.utils import make_folder
+    from fmriprep.utils.layout import BIDSIndex
+    from fmriprep.utils.misc import collect_bids_data, get_biggest_epi_file_size_gb
+
+    settings = {
+        'bids_root': op.abspath(opts.bids_dir),
+        'output_dir': op.abspath(opts.output_dir),
+        'work_dir': op.join(op.abspath(opts.work_dir), 'benchmark'),
+        'ants_nthreads': cpu_count(),
+        'hmc_nthreads': opts.hmc_nthreads or cpu_count(),
+        'hmc_chunk_size': opts.hmc_chunk_size,
+    }
+    make_folder(settings['output_dir'])
+    make_folder(settings['work_dir'])
+
+    ground_truth = {}
+    if opts.ground_truth_dir:
+        for root, _, filenames in os.walk(opts.ground_truth_dir):
+            for fname in filenames:
+                if fname.endswith('_motion.par'):
+                    ground_truth[fname[:-len('_motion.par')]] = op.join(root, fname)
+
+    subject_list = opts.participant_label
+    if not subject_list:
+        subject_list = [op.basename(subdir)[4:] for subdir in glob.glob(
+            op.join(settings['bids_root'], 'sub-*'))]
+
+    layout = BIDSIndex(settings['bids_root'], subjects=subject_list,
+                       cache_file=op.join(settings['work_dir'], 'bids_index.json'))
+    for subject in subject_list:
+        subject_data = collect_bids_data(settings['bids_root'], subject, opts.task_id,
+                                         layout=layout)
+        settings['biggest_epi_file_size_gb'] = get_biggest_epi_file_size_gb(
+            subject_data['func'])
+        for epi in subject_data['func']:
+            benchmark_run(epi, opts.engines, settings, ground_truth)
+
+    return 0
+
+
+def benchmark_run(epi, engines, settings, ground_truth=None):
+    """Run the HMC branches on one EPI series and write the comparison table"""
+    import pandas as pd
+    from fmriprep.interfaces.bids import DerivativesDataSink, _splitext
+    from fmriprep.utils.benchmark import (
+        NodeResourceMonitor, NODE_FIELDS, parameter_errors, world_truth, html_table)
+    from fmriprep.utils.memory import epi_dims
+    from fmriprep.utils.motion import load_parameters
+    from fmriprep.utils.nifti import load_header
+    from fmriprep.workflows import base
+
+    fname, _ = _splitext(epi)
+    settings = dict(settings, epi_dims=epi_dims(epi))
+    truth = None
+    if ground_truth and fname in ground_truth:
+        # engines are compared to the truth in world coordinates, as CompareMotion does
+        truth = world_truth(load_parameters(ground_truth[fname]), load_header(epi))
+
+    # The reference trunk is shared by all the engines, so it is run (and accounted) once
+    reference = base.epi_reference(name='reference_{}'.format(fname), settings=settings)
+    reference.base_dir = settings['work_dir']
+    reference.inputs.inputnode.epi = epi
+    monitor = NodeResourceMonitor(engine='reference')
+    execgraph = reference.run(plugin='Linear', plugin_args={'status_callback': monitor})
+    trunk = {field: _workflow_output(reference, execgraph, field)
+             for field in ['epi_file', 'ref_epi', 'epi_mask']}
+    node_rows = list(monitor.records)
+    summary_rows = [monitor.summary()]
+
+    for engine in engines:
+        workflow = getattr(base, ENGINES[engine])(name='{}_{}'.format(engine, fname),
+                                                  settings=settings)
+        workflow.base_dir = settings['work_dir']
+        workflow.inputs.inputnode.epi = epi
+        for field in ['epi_file', 'ref_epi', 'epi_mask']:
+            setattr(workflow.inputs.inputnode, field, trunk[field])
+
+        monitor = NodeResourceMonitor(engine=engine)
+        try:
+            execgraph = workflow.run(plugin='Linear',
+                                     plugin_args={'status_callback': monitor})
+        except RuntimeError:
+            execgraph = None
+
+        summary = monitor.summary()
+        if execgraph is not None and truth is not None:
+            par_file = _workflow_output(workflow, execgraph, 'world_par')
+            summary.update(parameter_errors(load_parameters(par_file)[:, :6], truth))
+
+        node_rows += monitor.records
+        summary_rows.append(summary)
+
+    out_dir = op.join(settings['work_dir'], 'tables')
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    nodes_file = op.join(out_dir, fname + '_nodes.tsv')
+    pd.DataFrame(node_rows, columns=NODE_FIELDS).to_csv(
+        nodes_file, sep=str('\t'), index=False, na_rep='n/a')
+    summary_file = op.join(out_dir, fname + '_summary.tsv')
+    pd.DataFrame(summary_rows, columns=SUMMARY_FIELDS).to_csv(
+        summary_file, sep=str('\t'), index=False, na_rep='n/a')
+    report_file = op.join(out_dir, fname + '_summary.html')
+    with open(report_file, 'w') as fobj:
+        fobj.write(html_table(summary_rows, SUMMARY_FIELDS, title='HMC benchmark'))
+
+    for in_file, suffix, out_path_base in [
+            (nodes_file, 'hmc_benchmark_nodes', None),
+            (summary_file, 'hmc_benchmark', None),
+            (report_file, 'hmc_benchmark', 'reports')]:
+        DerivativesDataSink(base_directory=settings['output_dir'], source_file=epi,
+                            in_file=in_file, suffix=suffix,
+                            out_path_base=out_path_base).run()
+
+    print(pd.DataFrame(summary_rows, columns=SUMMARY_FIELDS).to_string(index=False))
+    return summary_rows
+
+
+def construction_main():
+    """Entry point of the workflow construction benchmark"""
+    parser = ArgumentParser(description='Workflow construction benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('work_dir', action='store',
+                        help='folder for the synthetic datasets and the results table')
+    parser.add_argument('--subjects', action='store', nargs='+', type=int,
+                        default=[1, 10, 100], help='numbers of subjects to build')
+    parser.add_argument('--runs', action='store', nargs='+', type=int, default=[1, 4],
+                        help='numbers of runs per subject')
+    parser.add_argument('--nthreads', action='store', default=0, type=int,
+                        help='threads generating the subject workflows')
+    opts = parser.parse_args()
+    construction_benchmark(opts.work_dir, opts.subjects, opts.runs,
+                           nthreads=opts.nthreads or cpu_count())
+
+
+def construction_benchmark(work_dir, subject_counts, run_counts, nthreads=1):
+    """
+    Time the indexing of the dataset and the construction of the subject
+    workflows (base_workflow_enumerator) for growing numbers of subjects and
+    runs of a synthetic phantom dataset
+    """
+    from time import time
+    import pandas as pd
+    from fmriprep.utils.layout import BIDSIndex
+    from fmriprep.utils.phantom import make_phantom_dataset
+    from fmriprep.workflows.base import base_workflow_enumerator
+
+    work_dir = op.abspath(work_dir)
+    rows = []
+    for n_runs in run_counts:
+        bids_dir = op.join(work_dir, 'phantom_runs-{}'.format(n_runs))
+        if not op.isdir(bids_dir):
+            make_phantom_dataset(bids_dir, n_subjects=max(subject_counts), n_runs=n_runs,
+                                 size='small', n_vols=4)
+        settings = {
+            'bids_root': bids_dir,
+            'output_dir': op.join(work_dir, 'out'),
+            'work_dir': work_dir,
+            'nthreads': nthreads,
+            'ants_nthreads': 1,
+            'hmc_nthreads': 1,
+        }
+
+        for n_subjects in subject_counts:
+            subjects = ['{:02d}'.format(i + 1) for i in range(n_subjects)]
+            start = time()
+            layout = BIDSIndex(bids_dir, subjects=subjects)
+            indexed = time()
+            workflow = base_workflow_enumerator(subjects, None, settings, layout=layout)
+            built = time()
+            rows.append({
+                'n_subjects': n_subjects,
+                'n_runs': n_runs,
+                'n_nodes': len(workflow._get_all_nodes()),
+                'index_time_s': indexed - start,
+                'build_time_s': built - indexed,
+                'build_time_per_subject_s': (built - indexed) / n_subjects,
+            })
+
+    table = pd.DataFrame(rows, columns=CONSTRUCTION_FIELDS)
+    table.to_csv(op.join(work_dir, 'construction_benchmark.tsv'), sep=str('\t'),
+                 index=False)
+    print(table.to_string(index=False))
+    return rows
+
+
+def resampling_main():
+    """Entry point of the tissue map resampling benchmark"""
+    parser = ArgumentParser(description='Tissue probability map resampling benchmark',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('work_dir', action='store',
+                        help='folder for the resampled maps and the results table')
+    parser.add_argument('reference', action='store', help='image defining the EPI grid')
+    parser.add_argument('matrix_file', action='store', help='FLIRT matrix from T1w to EPI')
+    parser.add_argument('tpms', action='store', nargs='+',
+                        help='tissue probability maps in T1w space (CSF, GM, WM)')
+    parser.add_argument('--indices', action='store', nargs='+', type=int, default=[0, 2],
+                        help='maps to resample')
+    parser.add_argument('--interps', action='store', nargs='+',
+                        choices=['sinc', 'cubic', 'linear'], default=['sinc', 'cubic', 'linear'])
+    parser.add_argument('--no-flirt', action='store_true', default=False,
+                        help='do not run FSL ApplyXFM as the baseline')
+    opts = parser.parse_args()
+    resampling_benchmark(opts.work_dir, opts.tpms, opts.reference, opts.matrix_file,
+                         indices=opts.indices, interps=opts.interps, flirt=not opts.no_flirt)
+
+
+def resampling_benchmark(work_dir, tpms, reference, matrix_file, indices=(0, 2),
+                         interps=('sinc', 'cubic', 'linear'), flirt=True, threshold=0.95):
+    """
+    Time the resampling of tissue probability maps onto the EPI grid by FSL
+    ApplyXFM (one process per map, sinc interpolation) and by ResampleTPMs,
+    and compare the ROIs (maps thresholded as in TissueROIs) with those of
+    the baseline: ApplyXFM if FSL is available, else ResampleTPMs with sinc.
+    Times are given for resampling all the maps of a row's method.
+    """
+    from time import time
+    import numpy as np
+    import nibabel as nb
+    import pandas as pd
+    from nipype.interfaces import fsl
+    from fmriprep.interfaces.confounds import ResampleTPMs
+
+    work_dir = op.abspath(work_dir)
+    tpms = [op.abspath(tpm) for tpm in tpms]
+    reference = op.abspath(reference)
+    matrix_file = op.abspath(matrix_file)
+    indices = list(indices)
+
+    def _in_folder(name, func):
+        folder = op.join(work_dir, name)
+        if not op.isdir(folder):
+            os.makedirs(folder)
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            start = time()
+            out_files = func()
+            return time() - start, out_files
+        finally:
+            os.chdir(cwd)
+
+    def _flirt():
+        out_files = []
+        for index in indices:
+            out_files.append(fsl.ApplyXFM(
+                in_file=tpms[index], reference=reference, in_matrix_file=matrix_file,
+                apply_xfm=True, interp='sinc', output_type='NIFTI',
+                out_file='tpm{}_flirt.nii'.format(index)).run().outputs.out_file)
+        return out_files
+
+    def _resample(interp):
+        def _run():
+            out_files = ResampleTPMs(in_tpms=tpms, reference=reference,
+                                     in_matrix_file=matrix_file, indices=indices,
+                                     interp=interp).run().outputs.out_files
+            return out_files if isinstance(out_files, list) else [out_files]
+        return _run
+
+    runs = []
+    if flirt and fsl.Info.version():
+        runs.append(('flirt', 'sinc') + _in_folder('flirt', _flirt))
+    for interp in interps:
+        runs.append(('fmriprep', interp) + _in_folder('fmriprep_' + interp, _resample(interp)))
+
+    baseline = [np.asanyarray(nb.load(out_file).dataobj) for out_file in runs[0][3]]
+    rows = []
+    for method, interp, elapsed, out_files in runs:
+        for index, out_file, base in zip(indices, out_files, baseline):
+            data = np.asanyarray(nb.load(out_file).dataobj)
+            roi, base_roi = data >= threshold, base >= threshold
+            overlap = roi.sum() + base_roi.sum()
+            rows.append({
+                'method': method,
+                'interp': interp,
+                'map': index,
+                'time_s': elapsed,
+                'roi_voxels': int(roi.sum()),
+                'roi_dice': 2. * (roi & base_roi).sum() / overlap if overlap else 1.,
+                'max_abs_diff': float(np.abs(data - base).max()),
+            })
+
+    table = pd.DataFrame(rows, columns=RESAMPLING_FIELDS)
+    table.to_csv(op.join(work_dir, 'resampling_benchmark.tsv'), sep=str('\t'),
+                 index=False)
+    print(table.to_string(index=False))
+    return rows
+
+
+def _node_outputs(execgraph, name):
+    return [node.result.outputs.get() for node in execgraph.nodes()
+            if node.name == name][0]
+
+
+def _workflow_output(workflow, execgraph, field):
+    # identity nodes are pruned from the execution graph, so outputnode fields
+    # are looked up on the node that feeds them
+    for source, dest, data in workflow._graph.edges(data=True):
+        if dest.name != 'outputnode':
+            continue
+        for source_field, dest_field in data['connect']:
+            if dest_field == field:
+                return _node_outputs(execgraph, source.name)[source_field]
+    raise KeyError(field)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -48,6 +48,11 @@ def main():
                          help='run debug version of workflow')
     g_input.add_argument('--nthreads', action='store', default=0,
                          type=int, help='number of threads')
+    g_input.add_argument('--hmc-nthreads', action='store', default=0, type=int,
+                         help='number of volumes registered in parallel by the native HMC')
+    g_input.add_argument('--hmc-chunk-size', action='store', default=0, type=int,
+                         help='split each run into chunks of this many volumes that are '
+                              'head-motion corrected in parallel (0 disables chunking)')
     g_input.add_argument('--mem_mb', action='store', default=0,
                          type=int, help='try to limit requested memory to this number')
     g_input.add_argument('--write-graph', action='store_true', default=False,
@@ -56,12 +61,21 @@ def main():
                          help='nipype plugin configuration file')
     g_input.add_argument('-w', '--work-dir', action='store',
                          default=op.join(os.getcwd(), 'work'))
+    g_input.add_argument('--work-compress', action='store_true', default=False,
+                         help='gzip the intermediate images of the working directory '
+                              '(by default they are written uncompressed and memory-mapped)')
     g_input.add_argument('--ignore', required=False,
                          action='store', choices=['fieldmaps'],
                          nargs="+", default=[],
                          help='In case the dataset includes fieldmaps but you chose not to take advantage of them.')
     g_input.add_argument('--reports-only', action='store_true', default=False,
                          help="only generate reports, don't run workflows. This will only rerun report aggregation, not reportlet generation for specific nodes.")
+    g_input.add_argument('--external-reportlets', action='store_true', default=False,
+                         help='write the reportlets next to the reports, loaded on demand, '
+                              'instead of inlining them')
+    g_input.add_argument('--compress-reportlets', action='store_true', default=False,
+                         help='gzip the external reportlets (the reports must be served '
+                              'over HTTP)')
     g_input.add_argument('--skip-native', action='store_true',
                          default=False,
                          help="don't output timeseries in native space")
@@ -87,6 +101,8 @@ def create_workflow(opts):
     from nipype import config as ncfg
     from fmriprep.utils import make_folder
     from fmriprep.viz.reports import run_reports
+    from fmriprep.utils.crash import crash_callback, summarize_crashes
+    from fmriprep.utils.layout import BIDSIndex
     from fmriprep.workflows.base import base_workflow_enumerator
 
     errno = 0
@@ -98,6 +114,8 @@ def create_workflow(opts):
         'mem_mb': opts.mem_mb,
         'debug': opts.debug,
         'ants_nthreads': opts.ants_nthreads,
+        'hmc_nthreads': opts.hmc_nthreads,
+        'hmc_chunk_size': opts.hmc_chunk_size,
         'skull_strip_ants': opts.skull_strip_ants,
         'output_dir': op.abspath(opts.output_dir),
         'work_dir': op.abspath(opts.work_dir),
@@ -108,6 +126,10 @@ def create_workflow(opts):
     # set up logger
     logger = logging.getLogger('cli')
 
+    # read by the nodes, which may run in other processes
+    if opts.work_compress:
+        os.environ['FMRIPREP_WORK_COMPRESS'] = '1'
+
     if opts.debug:
         settings['ants_t1-mni_settings'] = 't1-mni_registration_test'
         logger.setLevel(logging.DEBUG)
@@ -125,7 +147,8 @@ def create_workflow(opts):
     logger.addHandler(logging.FileHandler(op.join(log_dir, 'run_workflow')))
 
     if opts.reports_only:
-        run_reports(settings['output_dir'])
+        run_reports(settings['output_dir'], nprocs=settings['nthreads'] or None,
+                    external=opts.external_reportlets, compress=opts.compress_reportlets)
         sys.exit()
 
     # Set nipype config
@@ -151,9 +174,15 @@ def create_workflow(opts):
             if settings['mem_mb']:
                 plugin_settings['plugin_args']['memory_gb'] = settings['mem_mb']/1024
 
+    # summarize crash files as nodes fail, for the reports
+    plugin_settings.setdefault('plugin_args', {})['status_callback'] = crash_callback
+
     if settings['ants_nthreads'] == 0:
         settings['ants_nthreads'] = cpu_count()
 
+    if settings['hmc_nthreads'] == 0:
+        settings['hmc_nthreads'] = cpu_count()
+
     # Determine subjects to be processed
     subject_list = opts.participant_label
 
@@ -163,20 +192,27 @@ def create_workflow(opts):
 
     logger.info('Subject list: %s', ', '.join(subject_list))
 
+    # Index the dataset once for all subjects, reusing the index of previous runs
+    layout = BIDSIndex(settings['bids_root'], subjects=subject_list,
+                       cache_file=op.join(settings['work_dir'], 'bids_index.json'))
+
     # Build main workflow and run
     preproc_wf = base_workflow_enumerator(subject_list, task_id=opts.task_id,
-                                          settings=settings)
+                                          settings=settings, layout=layout)
     preproc_wf.base_dir = settings['work_dir']
     try:
         preproc_wf.run(**plugin_settings)
     except RuntimeError:
         errno = 1
+    # in case the plugin does not support status callbacks
+    summarize_crashes(log_dir)
 
     if opts.write_graph:
         preproc_wf.write_graph(graph2use="colored", format='svg',
                                simple_form=True)
 
-    run_reports(settings['output_dir'])
+    run_reports(settings['output_dir'], nprocs=settings['nthreads'] or None,
+                external=opts.external_reportlets, compress=opts.compress_reportlets)
 
     sys.exit(errno)
 
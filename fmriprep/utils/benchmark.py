@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Utilities to measure the cost and accuracy of the head-motion correction branches.
+'''
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+from fmriprep.utils.motion import native_world_matrices, world_parameters
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+NODE_FIELDS = ['engine', 'node', 'wall_time_s', 'cpu_time_s', 'peak_rss_gb', 'status']
+
+
+def _cpu_time():
+    usage = [resource.getrusage(who)
+             for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum([u.ru_utime + u.ru_stime for u in usage])
+
+
+def _tree_rss(process):
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    return total
+
+
+class _RSSSampler(threading.Thread):
+    ''' Polls the resident memory of this process and all its children '''
+
+    def __init__(self, interval=0.1):
+        super(_RSSSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process(os.getpid())
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, _tree_rss(self._process))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+class NodeResourceMonitor(object):
+    '''
+    A ``status_callback`` for nipype plugins that records, for every node, the wall
+    time, the CPU time (including subprocesses) and the peak resident memory.
+
+    CPU time is only attributed correctly when nodes run one at a time (``Linear``
+    plugin). Peak memory is sampled with psutil when available; otherwise the
+    high-water mark reported by ``getrusage`` is used, which is an upper bound.
+
+    >>> monitor = NodeResourceMonitor(engine='fsl')
+    >>> workflow.run(plugin='Linear', plugin_args={'status_callback': monitor}) # doctest: +SKIP
+    '''
+
+    def __init__(self, engine=None, interval=0.1):
+        self.engine = engine
+        self.interval = interval
+        self.records = []
+        self._running = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            sampler = None
+            if psutil is not None:
+                sampler = _RSSSampler(self.interval)
+                sampler.start()
+            self._running[node.fullname] = (time.time(), _cpu_time(), sampler)
+            return
+
+        if node.fullname not in self._running:
+            return
+
+        start_wall, start_cpu, sampler = self._running.pop(node.fullname)
+        if sampler is not None:
+            peak_rss = sampler.stop()
+        else:
+            # ru_maxrss is given in kilobytes on Linux
+            peak_rss = 1024 * max([resource.getrusage(who).ru_maxrss for who in
+                                   (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)])
+
+        self.records.append({
+            'engine': self.engine,
+            'node': node.fullname,
+            'wall_time_s': time.time() - start_wall,
+            'cpu_time_s': _cpu_time() - start_cpu,
+            'peak_rss_gb': peak_rss / (1024. ** 3),
+            'status': status,
+        })
+
+    def summary(self):
+        ''' Totals for all the nodes recorded so far '''
+        return {
+            'engine': self.engine,
+            'n_nodes': len(self.records),
+            'wall_time_s': sum([r['wall_time_s'] for r in self.records]),
+            'cpu_time_s': sum([r['cpu_time_s'] for r in self.records]),
+            'peak_rss_gb': max([r['peak_rss_gb'] for r in self.records] or [0.]),
+            'failed_nodes': len([r for r in self.records if r['status'] != 'end']),
+        }
+
+
+def world_truth(truth, header):
+    ''' World parameters of a ground truth given in the frame of the native
+    engine (as written by fmriprep.utils.phantom), for the run of ``header`` '''
+    affine = header.get_best_affine()
+    shape = header.get_data_shape()[:3]
+    return world_parameters(native_world_matrices(np.atleast_2d(truth)[:, :6], affine,
+                                                  shape, header.get_zooms()[:3]),
+                            affine, shape)
+
+
+def parameter_errors(estimated, truth):
+    ''' Compare two sets of motion parameters (FSL layout) given in the same frame,
+    e.g. world parameters (see fmriprep.utils.motion and ``world_truth``) '''
+    estimated = np.atleast_2d(estimated)
+    truth = np.atleast_2d(truth)
+    if estimated.shape != truth.shape:
+        raise ValueError('Parameter traces differ in shape: {} vs {}'.format(
+            estimated.shape, truth.shape))
+
+    error = estimated - truth
+    rotations = np.degrees(error[:, :3])
+    translations = error[:, 3:6]
+    return {
+        'rot_rmse_deg': float(np.sqrt((rotations ** 2).mean())),
+        'rot_max_deg': float(np.abs(rotations).max()),
+        'trans_rmse_mm': float(np.sqrt((translations ** 2).mean())),
+        'trans_max_mm': float(np.abs(translations).max()),
+    }
+
+
+def html_table(rows, columns, title=None):
+    ''' A minimal HTML table, as used by the report reportlets '''
+    lines = ['<!-- {} -->'.format(title or 'table')]
+    if title:
+        lines.append('<h4>{}</h4>'.format(title))
+    lines.append('<table class="table table-condensed">')
+    lines.append('<tr>{}</tr>'.format(''.join(['<th>{}</th>'.format(c) for c in columns])))
+    for row in rows:
+        cells = []
+        for column in columns:
+            value = row.get(column)
+            if isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            cells.append('<td>{}</td>'.format('n/a' if value is None else value))
+        lines.append('<tr>{}</tr>'.format(''.join(cells)))
+    lines.append('</table>')
+    return '\n'.join(lines)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Storage of the confounds tables.
+
+Confounds are written as the BIDS TSV file and as a binary sidecar with the
+same name and the ``.npz`` extension. The sidecar holds each column as a
+separate float64 array, with the column names and the file each column was
+read from, so loading a few columns neither parses text nor reads the others.
+'''
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+COLUMNS_KEY = 'columns'
+SOURCES_KEY = 'sources'
+
+
+def sidecar_file(in_file):
+    ''' Path of the binary sidecar of a confounds TSV file '''
+    return op.splitext(in_file)[0] + '.npz'
+
+
+def write_confounds(confounds_data, out_file, sources=None):
+    '''
+    Write a confounds table as a TSV file and its binary sidecar, and return
+    the path of the sidecar. ``sources`` gives the origin of each column.
+    '''
+    confounds_data.to_csv(out_file, sep=str("\t"), index=False, na_rep="n/a")
+
+    columns = [str(column) for column in confounds_data.columns]
+    if sources is None:
+        sources = [''] * len(columns)
+    arrays = {_column_key(i): np.asarray(confounds_data.iloc[:, i].values, dtype=np.float64)
+              for i in range(len(columns))}
+    arrays[COLUMNS_KEY] = np.array(columns, dtype='U')
+    arrays[SOURCES_KEY] = np.array(sources, dtype='U')
+
+    out_sidecar = sidecar_file(out_file)
+    np.savez(out_sidecar, **arrays)
+    return out_sidecar
+
+
+def confounds_metadata(in_file):
+    ''' Column names and sources of a confounds sidecar (or TSV file) '''
+    npz_file = _sidecar(in_file)
+    if npz_file is None:
+        raise IOError('No up-to-date sidecar for {}'.format(in_file))
+    with np.load(npz_file) as npz:
+        return list(zip(npz[COLUMNS_KEY].tolist(), npz[SOURCES_KEY].tolist()))
+
+
+def load_confounds(in_file, columns=None):
+    '''
+    Read a confounds table (all the columns, or only ``columns``, in that
+    order) as a DataFrame. ``in_file`` is the TSV file or its sidecar; the
+    TSV file is parsed only if it has no sidecar, or a sidecar older than it.
+
+    >>> load_confounds('sub-01_task-rest_bold_confounds.tsv',
+    ...                columns=['FramewiseDisplacement']) # doctest: +SKIP
+    '''
+    npz_file = _sidecar(in_file)
+    if npz_file is None:
+        confounds_data = pd.read_csv(in_file, sep="\t", na_values="n/a", usecols=columns)
+        # usecols keeps the order of the file
+        return confounds_data if columns is None else confounds_data[columns]
+
+    with np.load(npz_file) as npz:
+        all_columns = npz[COLUMNS_KEY].tolist()
+        if columns is None:
+            columns = all_columns
+        missing = [column for column in columns if column not in all_columns]
+        if missing:
+            raise KeyError('Unknown confounds in {}: {}'.format(in_file, ', '.join(missing)))
+        return pd.DataFrame(
+            {column: npz[_column_key(all_columns.index(column))] for column in columns},
+            columns=columns)
+
+
+def _sidecar(in_file):
+    ''' The sidecar to read for ``in_file``, or None if the TSV must be parsed '''
+    if in_file.endswith('.npz'):
+        return in_file
+    npz_file = sidecar_file(in_file)
+    if op.isfile(npz_file) and op.getmtime(npz_file) >= op.getmtime(in_file):
+        return npz_file
+    return None
+
+
+def _column_key(index):
+    return 'column{:04d}'.format(index)
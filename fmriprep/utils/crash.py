@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+JSON summaries of nipype crash files.
+
+Crash files are pickles of the failed node, which can only be loaded with
+the same versions of nipype and of the interfaces. Each crash file is
+summarized (node, working directory, inputs and traceback) in a JSON file
+with the same name, once, by the process that ran the workflow; reports
+read the summaries only.
+'''
+import json
+import os
+import os.path as op
+import re
+
+from nipype import logging
+
+LOGGER = logging.getLogger('workflow')
+
+CRASH_RE = re.compile(r'^crash-(?P<time>[0-9]+-[0-9]+)-(?P<user>[^-]+)-(?P<node>.+?)'
+                      r'(-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})?'
+                      r'\.pklz$')
+
+
+def summary_file(crash_file):
+    ''' Path of the summary of a crash file '''
+    return op.splitext(crash_file)[0] + '.json'
+
+
+def summarize_crash(crash_file):
+    ''' Writes the JSON summary of a crash file and returns its path '''
+    from nipype.utils.filemanip import loadcrash
+
+    crash_data = loadcrash(crash_file)
+    summary = {'file': op.basename(crash_file),
+               'traceback': list(crash_data.get('traceback', []))}
+
+    node = crash_data.get('node')
+    if node:
+        summary['node'] = str(node)
+        if node.base_dir:
+            summary['node_dir'] = node.output_dir()
+        else:
+            summary['node_dir'] = "Node crashed before execution"
+        summary['inputs'] = [[name, '{}'.format(value)]
+                             for name, value in sorted(node.inputs.trait_get().items())]
+
+    out_file = summary_file(crash_file)
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    with open(tmp_file, 'w') as fobj:
+        json.dump(summary, fobj)
+    os.rename(tmp_file, out_file)
+    return out_file
+
+
+def summarize_crashes(crash_dir):
+    ''' Summarizes the crash files under a folder that have no summary yet '''
+    summaries = []
+    for root, _, filenames in os.walk(crash_dir):
+        for fname in sorted(filenames):
+            crash_file = op.join(root, fname)
+            if CRASH_RE.match(fname) and not op.isfile(summary_file(crash_file)):
+                try:
+                    summaries.append(summarize_crash(crash_file))
+                except Exception as exc:  # a crash summary should never fail a run
+                    LOGGER.warning('Could not summarize %s: %s', crash_file, exc)
+    return summaries
+
+
+def crash_callback(node, status):
+    ''' Plugin ``status_callback`` summarizing crash files as nodes fail '''
+    if status == 'exception':
+        summarize_crashes(node.config['execution'].get('crashdump_dir', os.getcwd()))
+
+
+def load_crash_summary(crash_file):
+    ''' Error description of a crash file for the reports: its summary if it
+    exists, otherwise only the name of the node that crashed '''
+    try:
+        with open(summary_file(crash_file)) as fobj:
+            error = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        match = CRASH_RE.match(op.basename(crash_file))
+        error = {'file': op.basename(crash_file), 'traceback': [],
+                 'node': match.group('node') if match else None}
+    error['crash_file'] = crash_file
+    return error
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Persistent index of the imaging files of a BIDS dataset.
+
+The index only walks the ``sub-<label>`` folders it is asked for, and can be
+saved as a JSON file. Every indexed folder is stored with its modification
+time: adding, removing or renaming a file changes the mtime of its folder, so
+on reload only the subjects with a stale folder are walked again.
+
+Sidecar metadata is resolved through the BIDS inheritance chain (top level,
+subject, session and sidecar JSON files). Each JSON file is parsed at most
+once per process: parsed files are kept in a LRU cache and only read again
+when their modification time or size changes. The chains are kept in a LRU
+cache of their own. Both caches are shared by the threads of a process.
+'''
+from collections import OrderedDict
+import copy
+import json
+import os
+import os.path as op
+import re
+import threading
+
+from nipype import logging
+
+LOGGER = logging.getLogger('workflow')
+
+INDEX_VERSION = 1
+
+NIFTI_RE = re.compile(r'^(?P<entities>sub-[^.]+)\.(?P<ext>nii(\.gz)?)$')
+
+# Maximum number of parsed JSON files kept in memory
+JSON_CACHE_SIZE = 512
+# Maximum number of inheritance chains kept in memory
+CHAIN_CACHE_SIZE = 4096
+
+_JSON_CACHE = OrderedDict()
+_CHAIN_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def parse_filename(filename):
+    ''' Entities of a BIDS NIfTI file name, or None if it is not one '''
+    match = NIFTI_RE.match(op.basename(filename))
+    if match is None:
+        return None
+
+    chunks = match.group('entities').split('_')
+    entities = {'type': chunks[-1], 'extension': match.group('ext')}
+    for chunk in chunks[:-1]:
+        key, _, value = chunk.partition('-')
+        entities[{'sub': 'subject', 'ses': 'session', 'acq': 'acquisition',
+                  'rec': 'reconstruction'}.get(key, key)] = value
+    return entities
+
+
+class BIDSIndex(object):
+    '''
+    Index of the NIfTI files of a BIDS dataset, queried with the same
+    arguments as ``BIDSLayout.get``.
+
+    >>> layout = BIDSIndex('/data/ds054', subjects=['01'], cache_file='bids_index.json')
+    >>> layout.get(subject='01', modality='func', type='bold') # doctest: +SKIP
+    '''
+
+    def __init__(self, root, subjects=None, cache_file=None):
+        self.root = root
+        self.cache_file = cache_file
+        self._subjects = {}
+        self._lock = threading.Lock()
+
+        if cache_file is not None and op.isfile(cache_file):
+            self._load(cache_file)
+
+        if subjects is None:
+            subjects = self.list_subjects()
+        changed = [self._update(_label(subject)) for subject in subjects]
+
+        if cache_file is not None and any(changed):
+            self.save(cache_file)
+
+    def list_subjects(self):
+        ''' Labels of all the subject folders of the dataset '''
+        return sorted(name[4:] for name in os.listdir(self.root)
+                      if name.startswith('sub-') and op.isdir(op.join(self.root, name)))
+
+    def get(self, subject=None, extensions=None, **filters):
+        ''' Paths (under ``root``) of the files matching all the given entities '''
+        subjects = [_label(subject)] if subject is not None else sorted(self._subjects)
+        filters = {key: str(value) for key, value in filters.items() if value is not None}
+
+        results = []
+        for label in subjects:
+            with self._lock:
+                if label not in self._subjects and self._update(label) \
+                        and self.cache_file is not None:
+                    self.save(self.cache_file)
+            for relpath in self._subjects[label]['files']:
+                entities = parse_filename(relpath)
+                entities['modality'] = op.basename(op.dirname(relpath))
+                if extensions and entities['extension'] not in extensions:
+                    continue
+                if all(_matches(entities.get(key), value) for key, value in filters.items()):
+                    results.append(op.join(self.root, relpath))
+        return results
+
+    def save(self, cache_file):
+        ''' Atomically write the index '''
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as fobj:
+            json.dump({'version': INDEX_VERSION, 'root': op.abspath(self.root),
+                       'subjects': self._subjects}, fobj)
+        os.rename(tmp_file, cache_file)
+
+    def _load(self, cache_file):
+        try:
+            with open(cache_file) as fobj:
+                index = json.load(fobj)
+        except ValueError:
+            return
+        if (index.get('version') == INDEX_VERSION and
+                index.get('root') == op.abspath(self.root)):
+            self._subjects = index['subjects']
+
+    def _update(self, subject):
+        ''' Walk the subject folder again if it is not indexed or it changed '''
+        entry = self._subjects.get(subject)
+        if entry is not None and not _stale(self.root, entry['dirs']):
+            return False
+
+        dirs = {}
+        files = []
+        subject_dir = 'sub-' + subject
+        for dirpath, dirnames, filenames in os.walk(op.join(self.root, subject_dir)):
+            dirnames.sort()
+            reldir = op.relpath(dirpath, self.root)
+            dirs[reldir] = op.getmtime(dirpath)
+            files += [op.join(reldir, fname) for fname in sorted(filenames)
+                      if NIFTI_RE.match(fname)]
+        self._subjects[subject] = {'dirs': dirs, 'files': files}
+        return True
+
+
+def _label(subject):
+    subject = str(subject)
+    return subject[4:] if subject.startswith('sub-') else subject
+
+
+def _stale(root, dirs):
+    if not dirs:
+        return True
+    for reldir, mtime in dirs.items():
+        try:
+            if op.getmtime(op.join(root, reldir)) != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _matches(entity, value):
+    if entity is None:
+        return False
+    if entity == value:
+        return True
+    # runs may be zero-padded in the file names
+    return entity.isdigit() and value.isdigit() and int(entity) == int(value)
+
+
+def load_json(json_file):
+    ''' Parsed contents of a JSON file (None if it does not exist), cached
+    until the file changes. Files that are not valid JSON are read as empty.
+    The returned dict is shared: do not modify it. '''
+    try:
+        stat = os.stat(json_file)
+    except OSError:
+        return None
+    key = (stat.st_mtime, stat.st_size)
+
+    with _CACHE_LOCK:
+        entry = _JSON_CACHE.pop(json_file, None)
+        if entry is not None and entry[0] == key:
+            _JSON_CACHE[json_file] = entry
+            return entry[1]
+
+    with open(json_file, 'r') as fobj:
+        try:
+            contents = json.load(fobj)
+        except ValueError:
+            LOGGER.warning('Ignoring invalid JSON file %s', json_file)
+            contents = {}
+
+    with _CACHE_LOCK:
+        _JSON_CACHE.pop(json_file, None)
+        _JSON_CACHE[json_file] = (key, contents)
+        while len(_JSON_CACHE) > JSON_CACHE_SIZE:
+            _JSON_CACHE.popitem(last=False)
+    return contents
+
+
+def sidecar_chain(in_file):
+    ''' JSON files a NIfTI file inherits metadata from, from the top level
+    of the dataset down to its own sidecar (in increasing precedence) '''
+    in_file = op.abspath(in_file)
+    with _CACHE_LOCK:
+        chain = _CHAIN_CACHE.pop(in_file, None)
+        if chain is not None:
+            _CHAIN_CACHE[in_file] = chain
+            return chain
+
+    fname = in_file[:-len('.gz')] if in_file.endswith('.gz') else in_file
+    side_json = op.splitext(fname)[0] + '.json'
+    fname_comps = op.basename(side_json).split('_')
+
+    session_comps = [comp for comp in fname_comps if not comp.startswith('run')]
+    subject_comps = [comp for comp in session_comps if not comp.startswith('ses')]
+    top_comps = [comp for comp in subject_comps if not comp.startswith('sub')]
+    sub = next(comp for comp in fname_comps if comp.startswith('sub'))
+    ses = next((comp for comp in fname_comps if comp.startswith('ses')), None)
+
+    bids_dir = op.dirname(op.dirname(op.dirname(in_file)))
+    if ses:
+        bids_dir = op.dirname(bids_dir)
+
+    chain = [op.join(bids_dir, '_'.join(top_comps)),
+             op.join(bids_dir, sub, '_'.join(subject_comps))]
+    if ses:
+        chain.append(op.join(bids_dir, sub, ses, '_'.join(session_comps)))
+    chain.append(side_json)
+
+    chain = tuple(chain)
+    with _CACHE_LOCK:
+        _CHAIN_CACHE.pop(in_file, None)
+        _CHAIN_CACHE[in_file] = chain
+        while len(_CHAIN_CACHE) > CHAIN_CACHE_SIZE:
+            _CHAIN_CACHE.popitem(last=False)
+    return chain
+
+
+def get_metadata(in_file):
+    ''' Metadata of a NIfTI file, merged along its inheritance chain '''
+    metadata = {}
+    for json_file in sidecar_chain(in_file):
+        contents = load_json(json_file)
+        if contents is not None:
+            metadata.update(contents)
+    return copy.deepcopy(metadata)
+
+
+def prefetch_metadata(in_files):
+    ''' Metadata of several NIfTI files (e.g. all the runs of a subject).
+    The JSON files they share are parsed once, and stay cached for later
+    calls to ``get_metadata``. '''
+    chains = {in_file: sidecar_chain(in_file) for in_file in in_files}
+    contents = {}
+    for chain in chains.values():
+        for json_file in chain:
+            if json_file not in contents:
+                contents[json_file] = load_json(json_file)
+
+    metadata = {}
+    for in_file, chain in chains.items():
+        merged = {}
+        for json_file in chain:
+            if contents[json_file] is not None:
+                merged.update(contents[json_file])
+        metadata[in_file] = copy.deepcopy(merged)
+    return metadata
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Analytic memory model of the workflow nodes.
+
+Estimates are computed from NIfTI headers only: the in-memory size of a run
+in the working dtype of each interface, times the number of copies of the
+series (and of single volumes) that the interface holds at once, plus the
+blocks of voxel time courses that chunked computations hold.
+'''
+import numpy as np
+
+from fmriprep.utils.nifti import load_header
+
+GB = 1024. ** 3
+
+# Interpreter, libraries and small buffers of any node
+BASE_GB = 0.2
+
+# Interface -> (working dtype, copies of the series, copies of one volume)
+INTERFACE_FACTORS = {
+    'AntsMotionCorr': (np.float32, 2, 4),
+    'MCFLIRT': (np.float32, 2, 4),
+    'NativeMotionCorr': (np.float32, 2, 8),
+    'SplitChunks': (np.float32, 1, 0),
+    'MergeChunks': (np.float32, 2, 0),
+    'MotionConfounds': (np.float32, 1, 8),
+    'AntsMotionParameters': (np.float64, 0, 0),
+    'HarmonizeMotion': (np.float64, 0, 0),
+    'CompareMotion': (np.float64, 0, 4),
+    'ComputeEPIMask': (np.float64, 0, 4),
+    'DecompressEPI': (np.float32, 0, 0),
+    'ComputeDVARS': (np.float64, 3, 0),
+    'FramewiseDisplacement': (np.float64, 0, 0),
+    'TCompCorRPT': (np.float64, 3, 0),
+    'ACompCorRPT': (np.float64, 3, 0),
+    'CombinedCompCor': (np.float64, 1, 2),
+    'SignalExtraction': (np.float64, 2, 0),
+    'RegionSignals': (np.float32, 0, 4),
+    'TissueROIs': (np.float64, 0, 8),
+}
+
+# Interfaces not listed above are assumed to hold three float64 copies of the run
+DEFAULT_FACTORS = (np.float64, 3, 0)
+
+# Interface -> (voxels per chunk, copies of the time courses of a chunk), in the
+# working dtype. The series copy of MotionConfounds is the disk-backed buffer
+# of streaming_dvars, whose pages stay resident; the robust standard deviation
+# then reads it in chunks of 50000 voxels and sorts a copy of each.
+CHUNK_FACTORS = {
+    'MotionConfounds': (50000, 2),
+}
+
+
+def epi_dims(in_file):
+    ''' Number of voxels per volume and number of volumes, read from the header '''
+    shape = load_header(in_file).get_data_shape()
+    nvols = shape[3] if len(shape) > 3 else 1
+    return int(np.prod(shape[:3])), int(nvols)
+
+
+def memory_gb(interface, settings, nvols=None):
+    '''
+    Memory estimate (GB) of an interface (given by name) on a run.
+    The run is described by ``settings['epi_dims']``; otherwise the estimate
+    falls back to ``settings['biggest_epi_file_size_gb']``, the float32 size
+    of the largest run of the subject. ``nvols`` limits the number of volumes
+    the node sees (e.g. a temporal chunk).
+    '''
+    dtype, series, volumes = INTERFACE_FACTORS.get(interface, DEFAULT_FACTORS)
+    chunk_voxels, chunks = CHUNK_FACTORS.get(interface, (0, 0))
+    itemsize = np.dtype(dtype).itemsize
+
+    if settings.get('epi_dims') is not None:
+        nvox, run_vols = settings['epi_dims']
+        if nvols is not None:
+            run_vols = min(run_vols, nvols)
+        return BASE_GB + itemsize * (nvox * (series * run_vols + volumes) +
+                                     chunks * min(chunk_voxels, nvox) * run_vols) / GB
+
+    return BASE_GB + series * settings['biggest_epi_file_size_gb'] * itemsize / 4.
+
+
+def set_memory(node, settings, interface=None, nvols=None):
+    ''' Attach the estimate to a node. ``interface`` defaults to the class name
+    of the node's interface; Function nodes must name their model explicitly. '''
+    if interface is None:
+        interface = type(node.interface).__name__
+    node.interface.estimated_memory_gb = memory_gb(interface, settings, nvols=nvols)
+    return node
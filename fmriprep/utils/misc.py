@@ -7,7 +7,8 @@ from os import path as op
 from errno import EEXIST
 import re
 
-from bids.grabbids import BIDSLayout
+from fmriprep.utils.layout import BIDSIndex, prefetch_metadata
+from fmriprep.utils.memory import epi_dims, GB
 
 INPUTS_SPEC = {'fieldmaps': [], 'func': [], 't1': [], 'sbref': []}
 
@@ -49,26 +50,16 @@ fieldmap_suffixes = {
 }
 
 
-def collect_bids_data(dataset, subject, task=None, session=None, run=None):
+def collect_bids_data(dataset, subject, task=None, session=None, run=None, layout=None):
+    ''' Imaging files of one subject, and the metadata of its functional runs.
+    ``layout`` is a ``BIDSIndex`` shared across subjects; if not given, only
+    this subject's folder is indexed. '''
     subject = str(subject)
     if subject.startswith('sub-'):
         subject = subject[4:]
 
-    layout = BIDSLayout(dataset)
-
-    if session:
-        session_list = [session]
-    else:
-        session_list = layout.unique('session')
-        if session_list == []:
-            session_list = [None]
-
-    if run:
-        run_list = [run]
-    else:
-        run_list = layout.unique('run')
-        if run_list == []:
-            run_list = [None]
+    if layout is None:
+        layout = BIDSIndex(dataset, subjects=[subject])
 
     queries = {
         'fmap': {'modality': 'fmap', 'extensions': ['nii', 'nii.gz']},
@@ -85,15 +76,18 @@ def collect_bids_data(dataset, subject, task=None, session=None, run=None):
     for key in queries.keys():
         queries[key]['subject'] = subject
 
+    # Session and run filters are pushed down to the functional queries
+    for key in ['epi', 'sbref']:
+        queries[key]['session'] = session
+        queries[key]['run'] = run
+
     imaging_data = copy.deepcopy(INPUTS_SPEC)
-    fieldmap_files = [x.filename for x in layout.get(**queries['fmap'])]
-    imaging_data['fmap'] = fieldmap_files
-    t1_files = [x.filename for x in layout.get(**queries['t1w'])]
-    imaging_data['t1w'] = t1_files
-    sbref_files = [x.filename for x in layout.get(**queries['sbref'])]
-    imaging_data['sbref'] = sbref_files
-    epi_files = [x.filename for x in layout.get(**queries['epi'])]
-    imaging_data['func'] = epi_files
+    imaging_data['fmap'] = layout.get(**queries['fmap'])
+    imaging_data['t1w'] = layout.get(**queries['t1w'])
+    imaging_data['sbref'] = layout.get(**queries['sbref'])
+    imaging_data['func'] = layout.get(**queries['epi'])
+    # Sidecar metadata of all the runs, resolved with a single parse of each JSON
+    imaging_data['metadata'] = prefetch_metadata(imaging_data['func'])
 
     '''
     loop_on = ['session', 'run', 'acquisition', 'task']
@@ -121,9 +115,11 @@ def collect_bids_data(dataset, subject, task=None, session=None, run=None):
 
 
 def get_biggest_epi_file_size_gb(files):
+    ''' In-memory (float32) size of the largest run, computed from the headers '''
     max_size = 0
     for file in files:
-        size = os.path.getsize(file)/(1024*1024*1024)
+        nvox, nvols = epi_dims(file)
+        size = nvox * nvols * 4 / GB
         if size > max_size:
             max_size = size
     return max_size
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Helpers to handle rigid-body head-motion parameters.
+
+Parameters are stored as in FSL's ``.par`` files: three rotations (rad) around
+the x, y and z axes followed by three translations (mm).
+
+Engines report motion in different frames. They are compared as world
+matrices: 4x4 matrices (RAS+ mm) mapping each position of the reference onto
+the position of the same tissue in the volume. ``world_parameters`` expresses
+them as parameters around the center of the field of view of the reference,
+which are those of the native engine when the voxel axes are aligned with RAS+.
+'''
+import numpy as np
+
+PARAMETER_NAMES = ['rot_x', 'rot_y', 'rot_z', 'trans_x', 'trans_y', 'trans_z']
+
+
+def rigid_matrix(params):
+    ''' Build 4x4 rigid-body matrices (mm) from one or several rows of parameters.
+    Rotations are composed as Rz.Ry.Rx and applied around the coordinates origin. '''
+    params = np.asanyarray(params, dtype=np.float64)
+    single = params.ndim == 1
+    params = np.atleast_2d(params)
+
+    cos = np.cos(params[:, :3])
+    sin = np.sin(params[:, :3])
+    ones = np.ones(len(params))
+    zeros = np.zeros(len(params))
+
+    rot_x = np.array([[ones, zeros, zeros],
+                      [zeros, cos[:, 0], -sin[:, 0]],
+                      [zeros, sin[:, 0], cos[:, 0]]]).transpose(2, 0, 1)
+    rot_y = np.array([[cos[:, 1], zeros, sin[:, 1]],
+                      [zeros, ones, zeros],
+                      [-sin[:, 1], zeros, cos[:, 1]]]).transpose(2, 0, 1)
+    rot_z = np.array([[cos[:, 2], -sin[:, 2], zeros],
+                      [sin[:, 2], cos[:, 2], zeros],
+                      [zeros, zeros, ones]]).transpose(2, 0, 1)
+
+    matrices = np.tile(np.eye(4), (len(params), 1, 1))
+    matrices[:, :3, :3] = np.einsum('nij,njk,nkl->nil', rot_z, rot_y, rot_x)
+    matrices[:, :3, 3] = params[:, 3:6]
+
+    if single:
+        return matrices[0]
+    return matrices
+
+
+def voxel_to_mm(shape, zooms):
+    ''' Matrix mapping voxel indices onto mm coordinates centered in the field of view '''
+    zooms = np.asanyarray(zooms[:3], dtype=np.float64)
+    center = (np.asanyarray(shape[:3], dtype=np.float64) - 1) / 2.
+    matrix = np.diag(np.hstack((zooms, 1.)))
+    matrix[:3, 3] = -zooms * center
+    return matrix
+
+
+def load_parameters(in_file):
+    ''' Read a text file of motion parameters, one row per volume. Whitespace and
+    comma separated files are accepted, with or without a header line. '''
+    with open(in_file) as fobj:
+        first = fobj.readline()
+
+    delimiter = ',' if ',' in first else None
+    try:
+        [float(value) for value in first.replace(',', ' ').split()]
+        skip = 0
+    except ValueError:
+        skip = 1
+    return np.loadtxt(in_file, delimiter=delimiter, skiprows=skip, ndmin=2)
+
+
+def framewise_displacement(params, radius=50.):
+    ''' Power's framewise displacement between consecutive volumes (one value less
+    than volumes). Rotations are converted to arc length over a sphere of ``radius`` mm. '''
+    params = np.atleast_2d(params)[:, :6]
+    diff = np.abs(np.diff(params, axis=0))
+    return radius * diff[:, :3].sum(axis=1) + diff[:, 3:].sum(axis=1)
+
+
+def matrix_parameters(matrices):
+    ''' Inverse of ``rigid_matrix``: six parameters per 4x4 matrix. Scalings and
+    shears, if any, are discarded by taking the closest rotation. '''
+    matrices = np.asanyarray(matrices, dtype=np.float64)
+    single = matrices.ndim == 2
+    matrices = matrices.reshape(-1, 4, 4)
+
+    # polar decomposition, vectorized over all the volumes
+    left, _, right = np.linalg.svd(matrices[:, :3, :3])
+    rotations = np.einsum('nij,njk->nik', left, right)
+
+    params = np.zeros((len(matrices), 6))
+    params[:, 0] = np.arctan2(rotations[:, 2, 1], rotations[:, 2, 2])
+    params[:, 1] = -np.arcsin(np.clip(rotations[:, 2, 0], -1., 1.))
+    params[:, 2] = np.arctan2(rotations[:, 1, 0], rotations[:, 0, 0])
+    params[:, 3:] = matrices[:, :3, 3]
+
+    if single:
+        return params[0]
+    return params
+
+
+def rms_displacement(matrices, radius=50.):
+    ''' Absolute (to the reference) and relative (to the previous volume) RMS
+    displacement of the points within a sphere of ``radius`` mm (Jenkinson, 1999) '''
+    matrices = np.asanyarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+
+    def _rms(deltas):
+        deltas = deltas - np.eye(4)
+        linear = np.einsum('nji,njk->nik', deltas[:, :3, :3], deltas[:, :3, :3])
+        translation = deltas[:, :3, 3]
+        return np.sqrt(0.2 * radius ** 2 * np.trace(linear, axis1=1, axis2=2) +
+                       (translation ** 2).sum(axis=1))
+
+    return _rms(matrices), np.hstack((0., _rms(relative_matrices(matrices))))
+
+
+def fov_center(affine, shape):
+    ''' World coordinates (mm) of the center of the field of view of an image '''
+    center = (np.asanyarray(shape[:3], dtype=np.float64) - 1) / 2.
+    return affine[:3, :3].dot(center) + affine[:3, 3]
+
+
+def centered_matrices(matrices, affine, shape):
+    ''' World matrices rewritten in coordinates whose origin is the center of
+    the field of view of the reference (``affine`` and ``shape``) '''
+    center = np.eye(4)
+    center[:3, 3] = fov_center(affine, shape)
+    return np.einsum('ij,njk,kl->nil', np.linalg.inv(center),
+                     np.asanyarray(matrices, dtype=np.float64).reshape(-1, 4, 4), center)
+
+
+def world_parameters(matrices, affine, shape):
+    ''' Six parameters per world matrix, with the rotations applied around the
+    center of the field of view of the reference '''
+    return matrix_parameters(centered_matrices(matrices, affine, shape))
+
+
+def relative_matrices(matrices):
+    ''' Matrices from each volume to the next one (one less than volumes) '''
+    matrices = np.asanyarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    return np.einsum('nij,njk->nik', matrices[1:], np.linalg.inv(matrices[:-1]))
+
+
+def native_world_matrices(params, affine, shape, zooms):
+    ''' World matrices of the parameters estimated by ``NativeMotionCorr``,
+    which are given in mm around the center of the field of view, along the
+    voxel axes (``voxel_to_mm``) of the reference '''
+    vox2mm = voxel_to_mm(shape, zooms)
+    to_world = np.asanyarray(affine, dtype=np.float64).dot(np.linalg.inv(vox2mm))
+    return np.einsum('ij,njk,kl->nil', to_world, rigid_matrix(np.atleast_2d(params)),
+                     np.linalg.inv(to_world))
+
+
+def fsl_scaling(header):
+    ''' Matrix from voxel indices to FSL coordinates: voxel sizes in mm, with
+    the first axis flipped if the voxel to world matrix has a positive
+    determinant '''
+    scaling = np.diag(list(header.get_zooms()[:3]) + [1.])
+    if np.linalg.det(header.get_best_affine()[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = header.get_data_shape()[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def fsl_voxel_matrix(matrix, in_header, ref_header):
+    ''' Matrix mapping the voxels of the reference onto the voxels of the input
+    image, for a FLIRT matrix from the input to the reference '''
+    return np.linalg.inv(fsl_scaling(in_header)).dot(
+        np.linalg.inv(matrix)).dot(fsl_scaling(ref_header))
+
+
+def fsl_world_matrices(matrices, in_header, ref_header):
+    ''' World matrices of the FLIRT matrices (one per volume, from the input
+    onto the reference) saved by ``mcflirt -mats`` '''
+    in_affine = in_header.get_best_affine()
+    ref_inverse = np.linalg.inv(ref_header.get_best_affine())
+    return np.array([in_affine.dot(fsl_voxel_matrix(matrix, in_header, ref_header)).dot(
+        ref_inverse) for matrix in np.asanyarray(matrices).reshape(-1, 4, 4)])
+
+
+def load_ants_moco(in_file, affine, shape):
+    ''' Read the ``MOCOparams.csv`` file written by ``antsMotionCorr`` and return
+    one world matrix per volume, for the fixed image given by ``affine`` and
+    ``shape``. Affine (12 parameters) and rigid Euler (6 parameters) transforms
+    are supported. '''
+    with open(in_file) as fobj:
+        header = fobj.readline().strip().split(',')
+    columns = [i for i, name in enumerate(header) if name.startswith('MOCOparam')]
+    values = np.loadtxt(in_file, delimiter=',', skiprows=1, ndmin=2)[:, columns]
+
+    matrices = np.tile(np.eye(4), (len(values), 1, 1))
+    if values.shape[1] == 12:
+        matrices[:, :3, :3] = values[:, :9].reshape(-1, 3, 3)
+        translations = values[:, 9:]
+    elif values.shape[1] == 6:
+        # itk::Euler3DTransform composes its rotations as Rz.Rx.Ry
+        rotations = []
+        for axis in range(3):
+            angles = np.zeros((len(values), 6))
+            angles[:, axis] = values[:, axis]
+            rotations.append(rigid_matrix(angles))
+        matrices[:] = np.einsum('nij,njk,nkl->nil', rotations[2], rotations[0], rotations[1])
+        translations = values[:, 3:]
+    else:
+        raise ValueError('Unsupported transform with {} parameters in {}'.format(
+            values.shape[1], in_file))
+
+    # ITK maps fixed onto moving physical points (LPS+), rotating around the
+    # center of the fixed image: offset = translation + center - matrix.center
+    lps = np.diag([-1., -1., 1., 1.])
+    center = lps[:3, :3].dot(fov_center(affine, shape))
+    matrices[:, :3, 3] = translations + center - matrices[:, :3, :3].dot(center)
+    return np.einsum('ij,njk,kl->nil', lps, matrices, lps)
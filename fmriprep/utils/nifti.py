@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Low-level NIfTI input/output helpers.
+
+Compressed images are written as a sequence of independent gzip members,
+each compressed by a pool of threads (zlib releases the GIL). Concatenated
+members are a valid gzip stream, readable by nibabel, FSL, AFNI and ANTs.
+The compression level and number of threads default to the
+``FMRIPREP_GZIP_LEVEL`` and ``FMRIPREP_GZIP_THREADS`` environment variables.
+
+Intermediate images of the working directory are written uncompressed
+unless ``FMRIPREP_WORK_COMPRESS`` is set, so that the next node can
+memory-map them; derivatives are compressed by the sinks.
+
+Code that only needs the geometry of an image (shape, affine, header of a
+reference) reads it with ``load_header``, which never touches the voxel data
+and keeps the headers it parsed until their file changes.
+'''
+from collections import OrderedDict
+import io
+import os
+import threading
+import zlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+from nibabel.fileholders import FileHolder
+from nibabel.openers import ImageOpener
+
+GZIP_LEVEL = 1
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Maximum number of parsed headers kept in memory
+HEADER_CACHE_SIZE = 256
+
+_HEADER_CACHE = OrderedDict()
+_HEADER_LOCK = threading.Lock()
+
+
+def iter_volumes(in_file, dtype=np.float32):
+    '''
+    Yield the volumes of a 3D/4D NIfTI file in order, one at a time.
+
+    The file is read sequentially, so for compressed images each byte is
+    decompressed once and memory stays bounded by one volume. Uncompressed
+    images without scaling (the work directory policy) are memory-mapped.
+    '''
+    proxy = nb.load(in_file).dataobj
+    shape = proxy.shape[:3]
+    nvols = proxy.shape[3] if len(proxy.shape) > 3 else 1
+
+    if not in_file.endswith('.gz') and proxy.slope == 1 and proxy.inter == 0:
+        data = load_data(in_file).reshape(shape + (nvols,), order='F')
+        for i in range(nvols):
+            yield data[..., i].astype(dtype)
+        return
+    nbytes = int(np.prod(shape)) * proxy.dtype.itemsize
+
+    with ImageOpener(in_file, 'rb') as fobj:
+        fobj.seek(proxy.offset)
+        for _ in range(nvols):
+            volume = np.frombuffer(fobj.read(nbytes), dtype=proxy.dtype)
+            volume = volume.reshape(shape, order='F').astype(dtype)
+            if proxy.slope != 1:
+                volume *= proxy.slope
+            if proxy.inter != 0:
+                volume += proxy.inter
+            yield volume
+
+
+def work_compressed():
+    ''' Whether intermediate images are gzipped (``FMRIPREP_WORK_COMPRESS``) '''
+    return os.environ.get('FMRIPREP_WORK_COMPRESS', '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def work_file(fname):
+    ''' Name of an intermediate image, given with a ``.nii.gz`` extension,
+    under the working directory policy '''
+    if fname.endswith('.nii.gz') and not work_compressed():
+        return fname[:-len('.gz')]
+    return fname
+
+
+def fsl_output_type():
+    ''' FSL output type matching the working directory policy '''
+    return 'NIFTI_GZ' if work_compressed() else 'NIFTI'
+
+
+def load_header(in_file):
+    ''' Header of a NIfTI file, read without its voxel data and cached until
+    the file changes. The header is a copy the caller may modify. '''
+    stat = os.stat(in_file)
+    key = (stat.st_mtime, stat.st_size)
+
+    with _HEADER_LOCK:
+        entry = _HEADER_CACHE.pop(in_file, None)
+        if entry is not None and entry[0] == key:
+            _HEADER_CACHE[in_file] = entry
+            return entry[1].copy()
+
+    # images are loaded lazily: only the header is read and decompressed
+    header = nb.load(in_file).header.copy()
+
+    with _HEADER_LOCK:
+        _HEADER_CACHE.pop(in_file, None)
+        _HEADER_CACHE[in_file] = (key, header)
+        while len(_HEADER_CACHE) > HEADER_CACHE_SIZE:
+            _HEADER_CACHE.popitem(last=False)
+    return header.copy()
+
+
+def image_like(data, ref_file):
+    ''' NIfTI image of ``data`` with the affine and header of a reference file
+    (of any number of volumes), whose voxel data is not read '''
+    header = load_header(ref_file)
+    return nb.Nifti1Image(data, header.get_best_affine(), header)
+
+
+def load_data(in_file):
+    ''' Data array of an image. Uncompressed images without scaling are
+    memory-mapped copy-on-write, so changing the array leaves the file intact. '''
+    return np.asanyarray(nb.load(in_file, mmap='c').dataobj)
+
+
+def gzip_settings(level=None, nthreads=None):
+    ''' Compression level and threads, from the arguments or the environment '''
+    if level is None:
+        level = int(os.environ.get('FMRIPREP_GZIP_LEVEL', GZIP_LEVEL))
+    if nthreads is None:
+        nthreads = int(os.environ.get('FMRIPREP_GZIP_THREADS', 0)) or min(cpu_count(), 8)
+    return level, max(1, nthreads)
+
+
+class ParallelGzipFile(io.IOBase):
+    '''
+    Write-only file object producing a multi-member gzip file. Data is cut
+    in blocks of ``block_size`` bytes, which are compressed in parallel and
+    written in order; at most two blocks per thread are held in memory.
+
+    >>> with ParallelGzipFile('out.nii.gz', level=1, nthreads=4) as fobj: # doctest: +SKIP
+    ...     fobj.write(data)
+    '''
+
+    def __init__(self, filename, level=None, nthreads=None, block_size=GZIP_BLOCK_SIZE):
+        super(ParallelGzipFile, self).__init__()
+        self.level, nthreads = gzip_settings(level, nthreads)
+        self.block_size = block_size
+        self._fobj = open(filename, 'wb')
+        self._pool = ThreadPool(nthreads) if nthreads > 1 else None
+        self._max_pending = 2 * nthreads
+        self._pending = []
+        self._buffer = []
+        self._buffered = 0
+        self._pos = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B') if not isinstance(data, bytes) else data
+        self._buffer.append(bytes(data))
+        self._buffered += len(data)
+        self._pos += len(data)
+        if self._buffered >= self.block_size:
+            block = b''.join(self._buffer)
+            for start in range(0, len(block) - self.block_size + 1, self.block_size):
+                self._submit(block[start:start + self.block_size])
+            rest = block[start + self.block_size:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        ''' Only forward seeks are possible, filling the gap with zeros '''
+        if whence == 1:
+            offset += self._pos
+        if whence == 2 or offset < self._pos:
+            raise IOError('Can only seek forward in a ParallelGzipFile')
+        if offset > self._pos:
+            self.write(b'\x00' * (offset - self._pos))
+        return self._pos
+
+    def close(self):
+        if self._fobj is None:
+            return super(ParallelGzipFile, self).close()
+        if self._buffered:
+            self._submit(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._drain(0)
+        if self._pool is not None:
+            self._pool.close()
+        self._fobj.close()
+        self._fobj = None
+        super(ParallelGzipFile, self).close()
+
+    def _submit(self, block):
+        if self._pool is None:
+            self._fobj.write(_gzip_member(block, self.level))
+            return
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.level)))
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending):
+        while len(self._pending) > max_pending:
+            self._fobj.write(self._pending.pop(0).get())
+
+
+def save_nifti(img, out_file, level=None, nthreads=None):
+    ''' Save an image; ``.gz`` files are compressed in parallel '''
+    if not str(out_file).endswith('.gz'):
+        img.to_filename(out_file)
+        return out_file
+
+    with ParallelGzipFile(out_file, level=level, nthreads=nthreads) as fobj:
+        img.to_file_map({'image': FileHolder(fileobj=fobj),
+                         'header': FileHolder(fileobj=fobj)})
+    return out_file
+
+
+def gzip_file(in_file, out_file, level=None, nthreads=None):
+    ''' Compress a file in parallel '''
+    with open(in_file, 'rb') as src, \
+            ParallelGzipFile(out_file, level=level, nthreads=nthreads) as dst:
+        for block in iter(lambda: src.read(GZIP_BLOCK_SIZE), b''):
+            dst.write(block)
+    return out_file
+
+
+def _gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
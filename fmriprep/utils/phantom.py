@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Deterministic synthetic motion phantom.
+
+Builds a small BIDS dataset whose BOLD runs are rendered from an analytic head
+model moved by a known rigid-body trace, with intensity spikes and drift. The
+true parameters are written to ``derivatives/phantom`` as ``<bold>_motion.par``
+files, in the layout expected by ``fmriprep-benchmark --ground-truth-dir``.
+
+The parameters follow the convention of ``fmriprep.utils.motion``: sampling a
+volume at the positions given by its parameters recovers the reference.
+'''
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os.path as op
+from argparse import ArgumentParser
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage as nd
+
+from fmriprep.utils.misc import make_folder
+from fmriprep.utils.motion import rigid_matrix, voxel_to_mm
+from fmriprep.utils.nifti import save_nifti
+
+# Name -> (matrix size, voxel size in mm, repetition time in s)
+SIZES = {
+    'small': ((32, 32, 20), (6., 6., 7.), 2.),
+    'standard': ((64, 64, 32), (3., 3., 3.5), 2.),
+    'multiband': ((104, 104, 72), (2., 2., 2.), 0.72),
+}
+
+# Ellipsoids of the head model: center (mm), semi-axes (mm), T2* and T1 intensities
+HEAD_MODEL = [
+    ((0., 0., 0.), (72., 90., 66.), 600., 300.),    # scalp and skull
+    ((0., 0., 4.), (64., 82., 58.), 800., 500.),    # gray matter
+    ((0., 0., 8.), (50., 68., 44.), 650., 900.),    # white matter
+    ((-10., 4., 10.), (6., 22., 12.), 1500., 150.),  # lateral ventricles
+    ((10., 4., 10.), (6., 22., 12.), 1500., 150.),
+]
+
+
+def render_head(shape, zooms, contrast='bold', seed=0):
+    ''' Render the head model on a grid centered in the field of view '''
+    column = 2 if contrast == 'bold' else 3
+    vox2mm = voxel_to_mm(shape, zooms)
+    coords = np.indices(shape, dtype=np.float32).reshape(3, -1)
+    coords = vox2mm[:3, :3].dot(coords) + vox2mm[:3, 3:]
+
+    data = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    for structure in HEAD_MODEL:
+        center = np.array(structure[0])[:, np.newaxis]
+        axes = np.array(structure[1])[:, np.newaxis]
+        inside = (((coords - center) / axes) ** 2).sum(axis=0) <= 1.
+        data[inside] = structure[column]
+    data = data.reshape(shape)
+
+    # Some texture, so that registration has features to lock onto
+    rng = np.random.RandomState(seed)
+    texture = nd.gaussian_filter(rng.standard_normal(shape).astype(np.float32), 1.5)
+    data *= 1. + 0.6 * texture / np.abs(texture).max()
+    return nd.gaussian_filter(data, 0.7)
+
+
+def motion_trace(n_vols, max_rotation_deg=1.5, max_translation_mm=2., n_jerks=2,
+                 rng=None):
+    ''' A smooth random walk of the six parameters, plus a few abrupt jerks '''
+    rng = rng or np.random.RandomState(0)
+    steps = rng.standard_normal((n_vols, 6))
+    trace = nd.gaussian_filter1d(np.cumsum(steps, axis=0), 2., axis=0)
+    trace -= trace[0]
+    for jerk in rng.choice(np.arange(1, n_vols), size=min(n_jerks, n_vols - 1),
+                           replace=False):
+        trace[jerk:] += rng.standard_normal(6) * np.abs(trace).max(axis=0) * 0.5
+
+    scale = np.abs(trace).max(axis=0)
+    scale[scale == 0] = 1.
+    limits = [np.radians(max_rotation_deg)] * 3 + [max_translation_mm] * 3
+    return trace / scale * np.array(limits)
+
+
+def make_bold(reference, zooms, params, spikes=(), drift=0.01, noise=0.01, rng=None):
+    ''' Move the reference volume along the motion trace '''
+    rng = rng or np.random.RandomState(0)
+    vox2mm = voxel_to_mm(reference.shape, zooms)
+    mm2vox = np.linalg.inv(vox2mm)
+    n_vols = len(params)
+
+    series = np.zeros(reference.shape + (n_vols,), dtype=np.float32)
+    for i, matrix in enumerate(rigid_matrix(params)):
+        # the volume is the reference seen through the inverse of the transform
+        matrix = mm2vox.dot(np.linalg.inv(matrix)).dot(vox2mm)
+        series[..., i] = nd.affine_transform(reference, matrix[:3, :3],
+                                             offset=matrix[:3, 3], order=1)
+
+    series *= (1. + drift * np.arange(n_vols) / max(n_vols - 1, 1))
+    for spike in spikes:
+        series[..., spike] *= 1.05
+    series += rng.standard_normal(series.shape).astype(np.float32) * (
+        noise * reference.max())
+    return series
+
+
+def _save(data, zooms, out_file, tr=None):
+    affine = voxel_to_mm(data.shape, zooms)
+    nii = nb.Nifti1Image(np.clip(data, 0, None).astype(np.int16), affine)
+    nii.header.set_xyzt_units('mm', 'sec')
+    if tr is not None:
+        nii.header.set_zooms(tuple(zooms) + (tr,))
+    return save_nifti(nii, out_file)
+
+
+def make_phantom_dataset(out_dir, n_subjects=1, n_runs=1, size='standard', n_vols=100,
+                         task='phantom', max_rotation_deg=1.5, max_translation_mm=2.,
+                         n_spikes=2, drift=0.01, seed=0):
+    '''
+    Write a BIDS dataset with synthetic motion into ``out_dir``.
+    Returns the list of BOLD files generated.
+    '''
+    shape, zooms, tr = SIZES[size] if not isinstance(size, tuple) else size
+    out_dir = op.abspath(out_dir)
+    make_folder(out_dir)
+    truth_dir = op.join(out_dir, 'derivatives', 'phantom')
+
+    with open(op.join(out_dir, 'dataset_description.json'), 'w') as fobj:
+        json.dump({'Name': 'Synthetic motion phantom', 'BIDSVersion': '1.0.0'}, fobj)
+    with open(op.join(out_dir, 'task-{}_bold.json'.format(task)), 'w') as fobj:
+        json.dump({'RepetitionTime': tr, 'TaskName': task}, fobj)
+
+    reference = render_head(shape, zooms, seed=seed)
+    t1_zooms = (1.5, 1.5, 1.5)
+    t1_shape = tuple(int(round(n * z / 1.5)) for n, z in zip(shape, zooms))
+    t1w = render_head(t1_shape, t1_zooms, contrast='t1', seed=seed)
+
+    bold_files = []
+    for sub_index in range(n_subjects):
+        subject = 'sub-{:02d}'.format(sub_index + 1)
+        make_folder(op.join(out_dir, subject, 'anat'))
+        make_folder(op.join(out_dir, subject, 'func'))
+        make_folder(op.join(truth_dir, subject, 'func'))
+        _save(t1w, t1_zooms, op.join(out_dir, subject, 'anat', subject + '_T1w.nii.gz'))
+
+        for run_index in range(n_runs):
+            rng = np.random.RandomState(seed + 1000 * sub_index + run_index + 1)
+            fname = '{}_task-{}_run-{:02d}'.format(subject, task, run_index + 1)
+
+            params = motion_trace(n_vols, max_rotation_deg, max_translation_mm, rng=rng)
+            spikes = sorted(rng.choice(np.arange(n_vols), size=min(n_spikes, n_vols),
+                                       replace=False).tolist())
+            bold = make_bold(reference, zooms, params, spikes=spikes, drift=drift, rng=rng)
+
+            bold_file = op.join(out_dir, subject, 'func', fname + '_bold.nii.gz')
+            bold_files.append(_save(bold, zooms, bold_file, tr=tr))
+            _save(reference * 1.2, zooms,
+                  op.join(out_dir, subject, 'func', fname + '_sbref.nii.gz'))
+
+            np.savetxt(op.join(truth_dir, subject, 'func', fname + '_bold_motion.par'),
+                       params, fmt=str('%.6f'), delimiter=str('  '))
+            with open(op.join(truth_dir, subject, 'func', fname + '_bold_phantom.json'),
+                      'w') as fobj:
+                json.dump({'spikes': spikes, 'drift': drift, 'seed': seed}, fobj)
+
+    return bold_files
+
+
+def main():
+    """Entry point"""
+    parser = ArgumentParser(description='Generate a synthetic motion phantom BIDS dataset')
+    parser.add_argument('out_dir', action='store')
+    parser.add_argument('--subjects', action='store', type=int, default=1)
+    parser.add_argument('--runs', action='store', type=int, default=1)
+    parser.add_argument('--size', action='store', choices=sorted(SIZES), default='standard')
+    parser.add_argument('--volumes', action='store', type=int, default=100)
+    parser.add_argument('--max-rotation', action='store', type=float, default=1.5,
+                        help='maximum rotation, in degrees')
+    parser.add_argument('--max-translation', action='store', type=float, default=2.,
+                        help='maximum translation, in mm')
+    parser.add_argument('--spikes', action='store', type=int, default=2)
+    parser.add_argument('--drift', action='store', type=float, default=0.01)
+    parser.add_argument('--seed', action='store', type=int, default=0)
+    opts = parser.parse_args()
+
+    make_phantom_dataset(opts.out_dir, n_subjects=opts.subjects, n_runs=opts.runs,
+                         size=opts.size, n_vols=opts.volumes,
+                         max_rotation_deg=opts.max_rotation,
+                         max_translation_mm=opts.max_translation,
+                         n_spikes=opts.spikes, drift=opts.drift, seed=opts.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+'''
+Publishing of work directory files into the output folders.
+
+Files are hardlinked when the output folder is on the same filesystem,
+reflinked (copy-on-write clones) where the filesystem supports it, and
+copied otherwise. Targets that already hold the same contents are left
+untouched, so rerunning a sink costs a few ``stat`` calls. Uncompressed
+files published under a ``.gz`` name are compressed in parallel.
+'''
+import errno
+import hashlib
+import os
+import os.path as op
+import shutil
+
+from fmriprep.utils.nifti import gzip_file
+
+PUBLISH_MODES = ['auto', 'hardlink', 'reflink', 'copy']
+
+# Methods tried by each mode, in order. Copying always works.
+_METHODS = {
+    'auto': ['hardlink', 'reflink', 'copy'],
+    'hardlink': ['hardlink', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'copy': ['copy'],
+}
+
+# ioctl request to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
+COPY_BUFSIZE = 16 * 1024 * 1024
+
+
+def publish_file(in_file, out_file, mode='auto', check_hash=True):
+    '''
+    Make ``out_file`` hold the contents of ``in_file``, and return how it was
+    done: ``'skipped'``, ``'hardlink'``, ``'reflink'``, ``'copy'`` or
+    ``'gzip'`` (if only ``out_file`` ends with ``.gz``).
+
+    The target is skipped if it is a link to ``in_file``, or if it has the
+    same size and mtime (copies keep the mtime of their source). With
+    ``check_hash``, targets of the same size are also hashed before being
+    overwritten. New targets are written next to ``out_file`` and renamed
+    into place, so an existing link is never written through.
+    '''
+    if mode not in _METHODS:
+        raise ValueError('Unknown publish mode "{}"'.format(mode))
+
+    tmp_file = '{}.{}.tmp'.format(out_file, os.getpid())
+    if out_file.endswith('.gz') and not in_file.endswith('.gz'):
+        # compressed targets keep the mtime of their source
+        if op.isfile(out_file) and op.getmtime(out_file) == op.getmtime(in_file):
+            return 'skipped'
+        _remove(tmp_file)
+        gzip_file(in_file, tmp_file)
+        shutil.copystat(in_file, tmp_file)
+        os.rename(tmp_file, out_file)
+        return 'gzip'
+
+    if _unchanged(in_file, out_file, check_hash):
+        return 'skipped'
+
+    for method in _METHODS[mode]:
+        _remove(tmp_file)
+        if _PUBLISHERS[method](in_file, tmp_file):
+            break
+    os.rename(tmp_file, out_file)
+    return method
+
+
+def file_digest(in_file, bufsize=COPY_BUFSIZE):
+    ''' SHA-1 of a file, read in blocks '''
+    digest = hashlib.sha1()
+    with open(in_file, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(bufsize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _unchanged(in_file, out_file, check_hash):
+    try:
+        out_stat = os.stat(out_file)
+    except OSError:
+        return False
+    in_stat = os.stat(in_file)
+
+    if op.samestat(in_stat, out_stat):
+        return True
+    if in_stat.st_size != out_stat.st_size:
+        return False
+    if in_stat.st_mtime == out_stat.st_mtime:
+        return True
+    return check_hash and file_digest(in_file) == file_digest(out_file)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def _hardlink(in_file, out_file):
+    try:
+        os.link(in_file, out_file)
+    except (OSError, AttributeError):
+        # cross-device links, filesystems without hardlinks
+        return False
+    return True
+
+
+def _reflink(in_file, out_file):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (IOError, OSError):
+            cloned = False
+        else:
+            cloned = True
+    if cloned:
+        shutil.copystat(in_file, out_file)
+    return cloned
+
+
+def _copy(in_file, out_file):
+    with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+    shutil.copystat(in_file, out_file)
+    return True
+
+
+_PUBLISHERS = {'hardlink': _hardlink, 'reflink': _reflink, 'copy': _copy}
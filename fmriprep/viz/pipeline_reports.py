@@ -52,3 +52,15 @@ def stripped_brain_overlay(in_file, overlay_file, out_file):
     #  mask_display.display_mode = "yx"
     mask_display
     return os.path.abspath(out_file)
+
+
+def roi_overlay(in_file, roi_file, out_file, title=None):
+    import os.path
+    import matplotlib as mpl
+    mpl.use('Agg')
+    from nilearn.plotting import plot_roi
+    mask_display = plot_roi(roi_file, bg_img=in_file, title=title, display_mode="ortho",
+                            alpha=.5, cmap='autumn')
+    mask_display.savefig(out_file)
+    mask_display.close()
+    return os.path.abspath(out_file)
@@ -17,6 +17,12 @@
 .elem-image svg {
     width: 100%;   
 }
+.elem-image object {
+    width: 100%;
+}
+.reportlet-thumb {
+    cursor: pointer;
+}
 body { 
     padding-top: 65px; 
 }
@@ -24,6 +30,19 @@ body {
 </head>
 <body>
 
+{% macro reportlet(image) %}
+{% if external %}
+<div class="elem-image reportlet" data-src="{{ image.src }}">
+    {% if image.thumbnail %}
+    <img class="reportlet-thumb" loading="lazy" src="{{ image.thumbnail }}" alt="{{ image.0 }}" onclick="loadReportlet(this.parentNode);" />
+    {% endif %}
+    <a href="#" class="reportlet-show" onclick="loadReportlet(this.parentNode); return false;">Show full figure</a>
+</div>
+{% else %}
+<div class="elem-image">{{ image.1 }}</div>
+{% endif %}
+{% endmacro %}
+
 <nav class="navbar navbar-default navbar-fixed-top">
 <div class="container collapse navbar-collapse">
     <ul class="nav navbar-nav">
@@ -65,7 +84,7 @@ body {
                         <p class="elem-desc">{{ elem.description }}<p>
                         <br>
                         {% for image in elem.files_contents %}
-                            <div class="elem-image">{{ image.1 }}</div><br>
+                            {{ reportlet(image) }}<br>
                             <div class="elem-filename">
                                 Filename: {{ image.0 }}
                             </div>
@@ -81,7 +100,7 @@ body {
             <p class="elem-desc">{{ elem.description }}<p>
             <br>
             {% for image in elem.files_contents %}
-                <div class="elem-image">{{ image.1 }}</div><br>
+                {{ reportlet(image) }}<br>
                 Filename: {{ image.0 }}
             {% endfor %}
             {% endif %}
@@ -98,7 +117,7 @@ body {
         <div class="nipype_error">
             Node Name: <a href="#" onclick="toggle('{{error.file|replace('.', '')}}_details_id');">{{ error.node }}</a><br>
             <div id="{{error.file|replace('.', '')}}_details_id" style="display:none">
-            File: {{ error.file }}<br>
+            File: <a href="{{ error.crash_file }}">{{ error.file }}</a><br>
             Working Directory: {{ error.node_dir }}<br>
             Inputs: <br>
             <ul>
@@ -121,6 +140,42 @@ body {
 
 
 <script type="text/javascript">
+    // Externalized reportlets are fetched when shown, or when their section is opened
+    function loadReportlet(div) {
+        if (div.getAttribute('data-loaded')) {
+            return;
+        }
+        div.setAttribute('data-loaded', 'true');
+        var src = div.getAttribute('data-src');
+        var figure = document.createElement('div');
+        div.innerHTML = '';
+        div.appendChild(figure);
+        if (src.slice(-3) == '.gz') {
+            fetch(src).then(function (response) {
+                var stream = response.body.pipeThrough(new DecompressionStream('gzip'));
+                return new Response(stream).text();
+            }).then(function (svg) {
+                figure.innerHTML = svg;
+            });
+        } else {
+            figure.innerHTML = '<object type="image/svg+xml" data="' + src + '"></object>';
+        }
+    }
+
+    function loadSection(id) {
+        var section = document.getElementById(id);
+        if (section) {
+            var reportlets = section.querySelectorAll('.reportlet');
+            for (var i = 0; i < reportlets.length; i++) {
+                loadReportlet(reportlets[i]);
+            }
+        }
+    }
+
+    window.addEventListener('hashchange', function () {
+        loadSection(decodeURIComponent(window.location.hash.slice(1)));
+    });
+
     function toggle(id) {
         var element = document.getElementById(id);
         if(element.style.display == 'block')
@@ -1,13 +1,62 @@
 from __future__ import unicode_literals
 
+import base64
+import gzip
+import hashlib
+import io
 import json
 import re
 import os
+from multiprocessing import Pool
 
 import jinja2
-from nipype.utils.filemanip import loadcrash
 from pkg_resources import resource_filename as pkgrf
 
+from fmriprep.utils.crash import load_crash_summary
+
+REPORTLET_EXTENSIONS = ('svg', 'html')
+MANIFEST_FILENAME = 'reports_manifest.json'
+
+# Width (pixels) of the thumbnails of externalized reportlets
+THUMBNAIL_WIDTH = 320
+
+SVG_COMMENT_RE = re.compile(r'<!--.*?-->|<metadata>.*?</metadata>', re.DOTALL)
+SVG_SPACE_RE = re.compile(r'>\s+<')
+EMBEDDED_PNG_RE = re.compile(r'data:image/png;base64,([A-Za-z0-9+/=\s]+)')
+
+SUBJECT_RE = re.compile('^(?P<subject_id>sub-[a-zA-Z0-9]+)$')
+
+# Parsed configuration files and the Jinja environment, shared by the
+# reports generated in one process
+_CONFIGS = {}
+_JINJA_ENV = None
+
+
+class Reportlet(object):
+    ''' A reportlet file, (filename, contents) when indexed. The contents
+    (without the XML declaration line) are read only when rendered.
+    Externalized reportlets have the relative URLs of their copy (``src``)
+    and thumbnail, if any. '''
+    __slots__ = ('filename', 'src', 'thumbnail')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.src = None
+        self.thumbnail = None
+
+    @property
+    def contents(self):
+        with open(self.filename) as fp:
+            fp.readline()
+            return fp.read()
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.filename
+        if index == 1:
+            return self.contents
+        raise IndexError(index)
+
 class Element(object):
 
     def __init__(self, name, file_pattern, title, description):
@@ -33,20 +82,20 @@ class SubReport(object):
         for elem_index in range(len(self.elements) - 1, -1, -1):
             element = self.elements[elem_index]
             for index in range(len(element.files_contents) - 1, -1, -1):
-                filename = element.files_contents[index][0]
-                file_contents = element.files_contents[index][1]
+                file_contents = element.files_contents[index]
+                filename = file_contents[0]
                 name, title = self.generate_name_title(filename)
                 if not name:
                     continue
-                new_elem = {'name': element.name, 'file_pattern': element.file_pattern,
+                new_elem = {'name': element.name, 'file_pattern': element.file_pattern.pattern,
                             'title': element.title, 'description': element.description}
                 try:
                     new_element = Element(**new_elem)
                     run_reps[name].elements.append(new_element)
-                    run_reps[name].elements[-1].files_contents.append((filename, file_contents))
+                    run_reps[name].elements[-1].files_contents.append(file_contents)
                 except KeyError:
                     run_reps[name] = SubReport(name, [new_elem], title=title)
-                    run_reps[name].elements[0].files_contents.append((filename, file_contents))
+                    run_reps[name].elements[0].files_contents.append(file_contents)
         keys = list(run_reps.keys())
         keys.sort()
         for key in keys:
@@ -81,18 +130,26 @@ class SubReport(object):
 
 
 class Report(object):
+    ''' Report of one subject. ``files`` are the files under ``path``, if
+    they have been listed already. '''
 
-    def __init__(self, path, config, out_dir, out_filename='report.html'):
+    def __init__(self, path, config, out_dir, out_filename='report.html', files=None,
+                 external=False, compress=False):
         self.root = path
         self.sub_reports = []
         self.errors = []
-        self._load_config(config)
         self.out_dir = out_dir
         self.out_filename = out_filename
+        self.external = external
+        self.compress = compress
+        self._load_config(config, files)
 
-    def _load_config(self, config):
+    def _load_config(self, config, files=None):
         try:
-            config = json.load(open(config, 'r'))
+            if config not in _CONFIGS:
+                with open(config, 'r') as fp:
+                    _CONFIGS[config] = json.load(fp)
+            config = _CONFIGS[config]
         except Exception as e:
             print(e)
             return
@@ -101,32 +158,34 @@ class Report(object):
             sub_report = SubReport(**e)
             self.sub_reports.append(sub_report)
 
-        self.index()
+        self.index(files)
 
-    def index(self):
-        for root, directories, filenames in os.walk(self.root):
-            for f in filenames:
-                f = os.path.join(root, f)
-                for sub_report in self.sub_reports:
-                    for element in sub_report.elements:
-                        ext = f.split('.')[-1]
-                        if element.file_pattern.search(f) and (ext == 'svg' or ext == 'html'):
-                            with open(f) as fp:
-                                content = fp.read()
-                                content = '\n'.join(content.split('\n')[1:])
-                                element.files_contents.append((f, content))
+    def index(self, files=None):
+        ''' Assigns the reportlets to the elements of the report, testing
+        each file against all the element patterns at once '''
+        if files is None:
+            files = list_files(self.root)
+
+        elements = [element for sub_report in self.sub_reports
+                    for element in sub_report.elements]
+        pattern = element_index(elements)
+        for f in files:
+            if f.split('.')[-1] not in REPORTLET_EXTENSIONS:
+                continue
+            matches = pattern.match(f)
+            for i, element in enumerate(elements):
+                if matches.group('e%d' % i) is not None:
+                    element.files_contents.append(Reportlet(f))
         for sub_report in self.sub_reports:
             sub_report.order_by_run()
 
-        subject_dir = self.root.split('/')[-1]
-        subject = re.search('^(?P<subject_id>sub-[a-zA-Z0-9]+)$', subject_dir).group()
-        error_dir = os.path.join(self.root, '../../log', subject[4:])
+        error_dir = subject_error_dir(self.root)
         if os.path.isdir(error_dir):
             self.index_error_dir(error_dir)
 
     def index_error_dir(self, error_dir):
-        ''' Crawl subjects most recent crash directory and return text for 
-            .pklz crash file found. '''
+        ''' Crawl subjects most recent crash directory and return the summary
+            of each .pklz crash file found. '''
         # Crash directories for subject are named by a timestamp. Sort 
         # listdir output to order it alphabetically, which for our timestamped 
         # directories is also a chronological listing. Assumes no other
@@ -144,50 +203,192 @@ class Report(object):
                 # Only deal with files that start with crash and end in pklz
                 if not (f[:5] == 'crash' and f[-4:] == 'pklz'):
                     continue
-                crash_data = loadcrash(os.path.join(root, f))
-                error = {}
-                node = None
-                if 'node' in crash_data:
-                    node = crash_data['node']
-                error['traceback'] = []
-                for elem in crash_data['traceback']:
-                    error['traceback'].append("<br>".join(elem.split("\n")))
-                error['file'] = f
-
-                if node:
-                    error['node'] = node
-                    if node.base_dir:
-                        error['node_dir'] = node.output_dir()
-                    else:
-                        error['node_dir'] = "Node crashed before execution"
-                    error['inputs'] = sorted(node.inputs.trait_get().items())
+                # the summary written when the node failed, not the pickle
+                error = load_crash_summary(os.path.join(root, f))
+                error['traceback'] = ["<br>".join(elem.split("\n"))
+                                      for elem in error['traceback']]
+                error['crash_file'] = os.path.relpath(error['crash_file'], self.out_dir)
                 self.errors.append(error)
 
 
     def generate_report(self):
-        searchpath = pkgrf('fmriprep', '/')
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(searchpath=searchpath),
+        ''' Writes the report, reading one reportlet at a time, and returns
+        its path. In external mode, the reportlets are copied (minified)
+        next to the report and loaded by the browser on demand. '''
+        if self.external:
+            self.externalize()
+        report_tpl = jinja_env().get_template('viz/report.tpl')
+        out_file = os.path.join(self.out_dir, self.out_filename)
+        with open(out_file, 'w') as fp:
+            report_tpl.stream(sub_reports=self.sub_reports, errors=self.errors,
+                              external=self.external).dump(fp)
+        return out_file
+
+    def externalize(self):
+        ''' Writes the minified reportlets and their thumbnails to the
+        ``<report name>_files`` folder. Files newer than their reportlet are
+        reused. '''
+        assets = os.path.splitext(self.out_filename)[0] + '_files'
+        for sub_report in self.sub_reports:
+            for report in [sub_report] + sub_report.run_reports:
+                for element in report.elements:
+                    for reportlet in element.files_contents:
+                        if reportlet.src is not None:
+                            continue
+                        relpath = os.path.join(
+                            assets, os.path.relpath(reportlet.filename, self.root))
+                        reportlet.src, reportlet.thumbnail = externalize_reportlet(
+                            reportlet, self.out_dir, relpath, compress=self.compress)
+
+
+def jinja_env():
+    ''' Jinja environment of the package templates, created once per process
+    so that templates are compiled only once '''
+    global _JINJA_ENV
+    if _JINJA_ENV is None:
+        _JINJA_ENV = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(searchpath=pkgrf('fmriprep', '/')),
             trim_blocks=True, lstrip_blocks=True
         )
-        report_tpl = env.get_template('viz/report.tpl')
-        report_render = report_tpl.render(sub_reports=self.sub_reports, errors=self.errors)
-        with open(os.path.join(self.out_dir, self.out_filename), 'w') as fp:
-            fp.write(report_render)
-        return report_render
+    return _JINJA_ENV
+
+
+def element_index(elements):
+    ''' One pattern testing a file name against the patterns of all the
+    elements: group ``e<i>`` is set if the i-th element matches '''
+    return re.compile(''.join(
+        '(?:(?=.*?(?:{}))(?P<e{}>))?'.format(element.file_pattern.pattern, i)
+        for i, element in enumerate(elements)))
+
+
+def minify_svg(contents):
+    ''' Drops comments, metadata and the whitespace between tags '''
+    return SVG_SPACE_RE.sub('><', SVG_COMMENT_RE.sub('', contents)).strip()
+
+
+def make_thumbnail(contents, out_file, width=THUMBNAIL_WIDTH):
+    ''' Downscales the first PNG image embedded in a reportlet, as matplotlib
+    writes them, to ``width`` pixels. Returns False if there is none. '''
+    match = EMBEDDED_PNG_RE.search(contents)
+    if match is None:
+        return False
+
+    from PIL import Image  # a dependency of matplotlib
+    image = Image.open(io.BytesIO(base64.b64decode(re.sub(r'\s', '', match.group(1)))))
+    image.thumbnail((width, width * image.size[1] // image.size[0] or 1))
+    image.save(out_file, 'PNG')
+    return True
 
 
-def run_reports(out_dir):
+def externalize_reportlet(reportlet, out_dir, relpath, compress=False):
+    ''' Writes the minified copy of a reportlet (gzipped if ``compress``) and
+    its thumbnail under ``out_dir``, unless they are newer than the reportlet.
+    Returns their paths relative to ``out_dir`` (thumbnail is None if the
+    reportlet has no raster image). '''
+    src = relpath + '.gz' if compress else relpath
+    thumbnail = os.path.splitext(relpath)[0] + '_thumb.png'
+    out_file = os.path.join(out_dir, src)
+    thumb_file = os.path.join(out_dir, thumbnail)
+
+    # the thumbnail is written first: a fresh copy implies a fresh thumbnail
+    if _newer(out_file, os.path.getmtime(reportlet.filename)):
+        return src, thumbnail if os.path.isfile(thumb_file) else None
+
+    if not os.path.isdir(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file))
+    contents = reportlet.contents
+    if not make_thumbnail(contents, thumb_file):
+        thumbnail = None
+        if os.path.isfile(thumb_file):
+            os.remove(thumb_file)
+
+    minified = minify_svg(contents).encode('utf-8')
+    with (gzip.open(out_file, 'wb') if compress else open(out_file, 'wb')) as fp:
+        fp.write(minified)
+    return src, thumbnail
+
+
+def _newer(fname, mtime):
+    return os.path.isfile(fname) and os.path.getmtime(fname) >= mtime
+
+
+def list_files(root):
+    return [os.path.join(dirpath, f)
+            for dirpath, _, filenames in os.walk(root) for f in sorted(filenames)]
+
+
+def subject_error_dir(subject_root):
+    subject = os.path.basename(os.path.normpath(subject_root))
+    return os.path.join(subject_root, '../../log', subject[4:])
+
+
+def subject_signature(files, extra_files):
+    ''' Digest of the names, sizes and modification times of the files a
+    subject report depends on '''
+    digest = hashlib.sha1()
+    for f in sorted(files) + list(extra_files):
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        digest.update('{}:{}:{}\n'.format(f, stat.st_size, stat.st_mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _generate_report(args):
+    root, config, out_dir, out_filename, files, external, compress = args
+    return Report(root, config, out_dir, out_filename, files=files,
+                  external=external, compress=compress).generate_report()
+
+
+def run_reports(out_dir, nprocs=None, external=False, compress=False):
+    ''' Generates the report of every subject with reportlets, in parallel.
+    Subjects whose reportlets, crash files, template and configuration are
+    unchanged since the reports listed in the manifest are skipped.
+    With ``external``, reportlets are not inlined in the reports but
+    written (minified, and gzipped if ``compress``) next to them, and
+    loaded on demand. '''
     reportlet_path = os.path.join(out_dir, 'reports/')
     config = pkgrf('fmriprep', 'viz/config.json')
+    template = pkgrf('fmriprep', 'viz/report.tpl')
+    if not os.path.isdir(reportlet_path):
+        return []
 
-    for root, _, _ in os.walk(reportlet_path):
-        #  relies on the fact that os.walk does not return a trailing /
-        dir = root.split('/')[-1]
-        try:
-            subject = re.search('^(?P<subject_id>sub-[a-zA-Z0-9]+)$', dir).group()
-            out_filename = '{}{}'.format(subject, '.html')
-            report = Report(root, config, out_dir, out_filename)
-            report.generate_report()
-        except AttributeError:
+    manifest_file = os.path.join(reportlet_path, MANIFEST_FILENAME)
+    try:
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+
+    jobs = []
+    signatures = {}
+    for subject in sorted(os.listdir(reportlet_path)):
+        root = os.path.join(reportlet_path, subject)
+        if SUBJECT_RE.match(subject) is None or not os.path.isdir(root):
+            continue
+        out_filename = '{}{}'.format(subject, '.html')
+        files = list_files(root)
+        error_dir = subject_error_dir(root)
+        signatures[subject] = subject_signature(
+            files + list_files(error_dir), [config, template, error_dir]) + \
+            ('-external' + ('-gz' if compress else '') if external else '')
+        if (manifest.get(subject) == signatures[subject] and
+                os.path.isfile(os.path.join(out_dir, out_filename))):
             continue
+        jobs.append((root, config, out_dir, out_filename, files, external, compress))
+
+    if len(jobs) > 1 and (nprocs is None or nprocs > 1):
+        pool = Pool(nprocs)
+        try:
+            reports = pool.map(_generate_report, jobs)
+        finally:
+            pool.close()
+    else:
+        reports = [_generate_report(job) for job in jobs]
+
+    tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as fp:
+        json.dump(signatures, fp)
+    os.rename(tmp_file, manifest_file)
+    return reports
@@ -8,44 +8,67 @@ Created on Wed Dec  2 17:35:40 2015
 @author: craigmoodie
 """
 import os
-from copy import deepcopy
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from time import strftime
 
-from nipype.algorithms.confounds import ComputeDVARS, FramewiseDisplacement
 from nipype.pipeline import engine as pe
 from nipype.interfaces import c3, fsl, utility
 from nipype.interfaces import utility as niu
-from nipype.interfaces.ants.preprocess import AntsMotionCorr, AntsMotionCorrStats, AntsMatrixConversion
+from nipype.interfaces.ants.preprocess import AntsMotionCorr
 from niworkflows.interfaces.masks import ComputeEPIMask
 
-from fmriprep.interfaces import BIDSDataGrabber, DerivativesDataSink
+from fmriprep.interfaces import (BIDSDataGrabber, DerivativesDataSink, DerivativesBatchSink,
+                                 NativeMotionCorr, AntsMotionParameters, HarmonizeMotion,
+                                 CompareMotion)
+from fmriprep.interfaces.hmc import SplitChunks, MergeChunks
+from fmriprep.interfaces.confounds import MotionConfounds
+from fmriprep.interfaces.utils import decompress_nii
+from fmriprep.interfaces.bids import _splitext
+from fmriprep.utils.memory import epi_dims, set_memory
+from fmriprep.utils.nifti import fsl_output_type, work_file
 from fmriprep.utils.misc import collect_bids_data, get_biggest_epi_file_size_gb
-from fmriprep.workflows.confounds import _gather_confounds
 from fmriprep.workflows import confounds
 
-def base_workflow_enumerator(subject_list, task_id, settings):
+def base_workflow_enumerator(subject_list, task_id, settings, layout=None):
     workflow = pe.Workflow(name='workflow_enumerator')
+
+    def _generate(subject):
+        return base_workflow_generator(subject, task_id=task_id, settings=settings,
+                                       layout=layout)
+
+    # BIDS queries and header reads are I/O bound: generate the subjects on a
+    # pool of threads (results come back in subject order)
+    nthreads = max(1, min(settings.get('nthreads') or cpu_count(), len(subject_list)))
+    pool = ThreadPool(nthreads)
+    try:
+        generated = pool.map(_generate, subject_list)
+    finally:
+        pool.close()
+
     generated_list = []
-    for subject in subject_list:
-        generated_workflow = base_workflow_generator(subject, task_id=task_id,
-                                                     settings=settings)
+    for subject, generated_workflow in zip(subject_list, generated):
         if generated_workflow:
             cur_time = strftime('%Y%m%d-%H%M%S')
             generated_workflow.config['execution']['crashdump_dir'] = (
                 os.path.join(settings['output_dir'], 'log', subject, cur_time)
             )
+            # nodes only read their config, so they all share the subject's one
             for node in generated_workflow._get_all_nodes():
-                node.config = deepcopy(generated_workflow.config)
+                node.config = generated_workflow.config
             generated_list.append(generated_workflow)
     workflow.add_nodes(generated_list)
 
     return workflow
 
 
-def base_workflow_generator(subject_id, task_id, settings):
-    subject_data = collect_bids_data(settings['bids_root'], subject_id, task_id)
+def base_workflow_generator(subject_id, task_id, settings, layout=None):
+    subject_data = collect_bids_data(settings['bids_root'], subject_id, task_id,
+                                     layout=layout)
 
-    settings["biggest_epi_file_size_gb"] = get_biggest_epi_file_size_gb(subject_data['func'])
+    # subjects may be generated concurrently, so the shared settings are not modified
+    settings = dict(settings, biggest_epi_file_size_gb=get_biggest_epi_file_size_gb(
+        subject_data['func']))
 
     if subject_data['t1w'] == []:
         raise Exception(
@@ -64,24 +87,137 @@ def mottcorr_comp(subject_data, settings, name='mottcorr_comp'):
         fields=['silly_out', 'silly_out2']), name='outputnode')
     bidssrc = pe.Node(BIDSDataGrabber(subject_data=subject_data), name='BIDSDatasource')
 
-    ants_hmc = test_ants(settings=settings)
-    ants_hmc.get_node('inputnode').iterables = ('epi', subject_data['func'])
+    # One subgraph per run (rather than iterables), so that the memory
+    # estimates of every node follow the size of its own run
+    for epi in subject_data['func']:
+        run_settings = dict(settings, epi_dims=epi_dims(epi))
+        run_name = _splitext(epi)[0].split('_', 1)[-1]
+
+        inputnode = pe.Node(niu.IdentityInterface(fields=['epi']),
+                            name='inputnode_' + run_name)
+        inputnode.inputs.epi = epi
+
+        epi_ref = epi_reference(name='EPIReference_' + run_name, settings=run_settings)
+        workflow.connect([(inputnode, epi_ref, [('epi', 'inputnode.epi')])])
+
+        hmc_wfs = [
+            ('ants', test_ants(name='test_antsmottcorr_' + run_name, settings=run_settings)),
+            ('fsl', test_fsl(name='test_mcflirt_' + run_name, settings=run_settings)),
+            ('native', test_native(name='test_nativemottcorr_' + run_name,
+                                   settings=run_settings))]
+        compare = compare_motion(labels=[label for label, _ in hmc_wfs],
+                                 name='CompareMotion_' + run_name, settings=run_settings)
+        workflow.connect([
+            (inputnode, compare, [('epi', 'inputnode.epi')]),
+            (epi_ref, compare, [('outputnode.epi_mask', 'inputnode.epi_mask')]),
+        ])
+
+        for i, (_, hmc_wf) in enumerate(hmc_wfs):
+            workflow.connect([
+                (inputnode, hmc_wf, [('epi', 'inputnode.epi')]),
+                (epi_ref, hmc_wf, [('outputnode.epi_file', 'inputnode.epi_file'),
+                                   ('outputnode.ref_epi', 'inputnode.ref_epi'),
+                                   ('outputnode.epi_mask', 'inputnode.epi_mask')]),
+                (hmc_wf, compare, [('outputnode.world_par',
+                                    'inputnode.par_file%d' % (i + 1))]),
+            ])
 
-    fsl_hmc = test_fsl(settings=settings)
-    fsl_hmc.get_node('inputnode').iterables = ('epi', subject_data['func'])
+    return workflow
 
-    workflow.add_nodes([ants_hmc, fsl_hmc])
+def compare_motion(labels, name='CompareMotion', settings=None):
+    """
+    Per-run agreement between the world motion parameters of the HMC engines,
+    written to derivatives as a TSV and a summary JSON.
+    """
+    workflow = pe.Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi', 'epi_mask'] + ['par_file%d' % (i + 1) for i in range(len(labels))]),
+        name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['out_file', 'summary_file']), name='outputnode')
+
+    merge = pe.Node(niu.Merge(len(labels)), name='MergeParameters')
+    compare = pe.Node(CompareMotion(labels=labels), name='CompareMotion')
+    set_memory(compare, settings)
+
+    ds_compare = pe.Node(
+        DerivativesDataSink(base_directory=settings['output_dir'],
+                            suffix='hmc_comparison'),
+        name='DerivativesHMCComparison'
+    )
+    ds_summary = pe.Node(
+        DerivativesDataSink(base_directory=settings['output_dir'],
+                            suffix='hmc_comparison'),
+        name='DerivativesHMCComparisonSummary'
+    )
 
+    workflow.connect([
+        (inputnode, merge, [('par_file%d' % (i + 1), 'in%d' % (i + 1))
+                            for i in range(len(labels))]),
+        (merge, compare, [('out', 'in_files')]),
+        (inputnode, compare, [('epi_mask', 'in_mask')]),
+        (compare, outputnode, [('out_file', 'out_file'),
+                               ('summary_file', 'summary_file')]),
+        (inputnode, ds_compare, [('epi', 'source_file')]),
+        (compare, ds_compare, [('out_file', 'in_file')]),
+        (inputnode, ds_summary, [('epi', 'source_file')]),
+        (compare, ds_summary, [('summary_file', 'in_file')]),
+    ])
     return workflow
 
-def test_ants(name='test_antsmottcorr', settings=None):
+def epi_reference(name='EPIReference', settings=None):
+    """
+    Per-run trunk shared by all HMC engines: a decompressed copy of the
+    series, one reference (average) image and one brain mask.
+    """
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(fields=['epi']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(
-        fields=['epi_hmc', 'dvars_out', 'epi_mask']), name='outputnode')
-
+        fields=['epi_file', 'ref_epi', 'epi_mask']), name='outputnode')
 
+    decompress = pe.Node(
+        utility.Function(
+            function=decompress_nii,
+            input_names=['in_file'],
+            output_names=['out_file']
+        ),
+        name='DecompressEPI'
+    )
+    set_memory(decompress, settings, interface='DecompressEPI')
     ants_mean = pe.Node(AntsMotionCorr(), name='ANTS_mean')
+    set_memory(ants_mean, settings)
+    skullstrip_epi = pe.Node(ComputeEPIMask(generate_report=True, dilation=1),
+                             name='ComputeEPIMask')
+    set_memory(skullstrip_epi, settings)
+
+    # the mask and its reportlet, saved to images/, in one job
+    ds_mask = pe.Node(
+        DerivativesBatchSink(base_directory=settings['output_dir'],
+                             suffixes=['epi_mask']),
+        name='DerivativesEPImask'
+    )
+
+    workflow.connect([
+        (inputnode, decompress, [('epi', 'in_file')]),
+        (decompress, ants_mean, [('out_file', 'average_image')]),
+        (ants_mean, skullstrip_epi, [('average_image', 'in_file')]),
+        (decompress, outputnode, [('out_file', 'epi_file')]),
+        (ants_mean, outputnode, [('average_image', 'ref_epi')]),
+        (skullstrip_epi, outputnode, [('mask_file', 'epi_mask')]),
+        (inputnode, ds_mask, [('epi', 'source_file')]),
+        (skullstrip_epi, ds_mask, [('mask_file', 'epi_mask'),
+                                   ('out_report', 'in_images')]),
+    ])
+    return workflow
+
+def test_ants(name='test_antsmottcorr', settings=None):
+    workflow = pe.Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi', 'epi_file', 'ref_epi', 'epi_mask']), name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi_hmc', 'dvars_out', 'epi_mask', 'par_file', 'world_par']),
+        name='outputnode')
+
     ants_hmc_config = {
         'metric_type': 'GC',
         'metric_weight': 1,
@@ -94,174 +230,181 @@ def test_ants(name='test_antsmottcorr', settings=None):
         'n_images': 10,
         'use_fixed_reference_image': True,
         'use_scales_estimator': True,
-        'output_warped_image': 'warped.nii.gz',
+        'output_warped_image': work_file('warped.nii.gz'),
         'output_transform_prefix': 'motcorr',
         'transformation_model': 'Affine',
         'gradient_step_length': 0.005
     }
 
-    ants_hmc = pe.Node(AntsMotionCorr(**ants_hmc_config),
-                       name='EPI_ANTS_hmc')
-    skullstrip_epi = pe.Node(ComputeEPIMask(generate_report=True, dilation=1),
-                             name='ComputeEPIMask')
+    ants_hmc, (hmc_in, in_field), (hmc_out, image_field, params_field) = hmc_nodes(
+        workflow, AntsMotionCorr(**ants_hmc_config), 'EPI_ANTS_hmc',
+        'moving_image', 'warped_image', 'composite_transform', settings)
 
-    dvars = pe.Node(ComputeDVARS(save_all=True, remove_zerovariance=True),
-                    name='ants_DVARS')
-    dvars.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    hmc_confounds = pe.Node(MotionConfounds(), name='antsMotionConfounds')
+    set_memory(hmc_confounds, settings)
 
-    frame_displace = pe.Node(FramewiseDisplacement(),
-                             name="FramewiseDisplacement")
-    frame_displace.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
+    params = pe.Node(AntsMotionParameters(), name='ants_params')
+    set_memory(params, settings)
 
-    ants_fd = pe.Node(
-        AntsMotionCorrStats(output="frame_displacement.csv", framewise=False),
-        name='ants_fd'
+    workflow.connect([
+        (inputnode, ants_hmc, [('ref_epi', 'fixed_image')]),
+        (inputnode, params, [('ref_epi', 'reference')]),
+        (inputnode, hmc_in, [('epi_file', in_field)]),
+        (inputnode, hmc_confounds, [('epi_mask', 'in_mask')]),
+        (hmc_out, hmc_confounds, [(image_field, 'in_file')]),
+        (hmc_confounds, outputnode, [('out_file', 'dvars_out')]),
+        (hmc_out, outputnode, [(image_field, 'epi_hmc')]),
+        (inputnode, outputnode, [('epi_mask', 'epi_mask')]),
+        (hmc_out, params, [(params_field, 'in_file')]),
+        (params, hmc_confounds, [('par_file', 'in_plots')]),
+        (params, outputnode, [('par_file', 'par_file'),
+                              ('par_file', 'world_par')]),
+    ])
+
+    ds_derivatives = pe.Node(
+        DerivativesBatchSink(base_directory=settings['output_dir'],
+                             suffixes=['ants_hmc', 'ants_dvar', 'ants_par', 'ants_fd']),
+        name='antsDerivatives'
     )
+    workflow.connect([
+        (inputnode, ds_derivatives, [('epi', 'source_file')]),
+        (hmc_out, ds_derivatives, [(image_field, 'ants_hmc')]),
+        (hmc_confounds, ds_derivatives, [('out_file', 'ants_dvar')]),
+        (params, ds_derivatives, [('out_file', 'ants_fd'),
+                                  ('par_file', 'ants_par')])
+    ])
+    return workflow
 
-    params = pe.Node(AntsMatrixConversion(), name='ants_params')
+def test_fsl(name='test_mcflirt', settings=None):
+    workflow = pe.Workflow(name=name)
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi', 'epi_file', 'ref_epi', 'epi_mask']), name='inputnode')
+    outputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi_hmc', 'dvars_out', 'epi_mask', 'par_file', 'world_par']),
+        name='outputnode')
 
-    concat = pe.Node(
-        utility.Function(
-            function=_gather_confounds,
-            input_names=['dvars', 'frame_displace'],
-            output_names=['combined_out']
-        ),
-        name="ConcatConfounds"
-    )
+    hmc, (hmc_in, in_field), (hmc_out, image_field, params_field) = hmc_nodes(
+        workflow, fsl.MCFLIRT(save_mats=True, save_plots=True, output_type=fsl_output_type()),
+        'fslEPI_hmc', 'in_file', 'out_file', 'par_file', settings)
+    hmc_confounds = pe.Node(MotionConfounds(), name='fslMotionConfounds')
+    set_memory(hmc_confounds, settings)
+    harmonize = pe.Node(HarmonizeMotion(convention='fsl'), name='fslHarmonizeMotion')
+    set_memory(harmonize, settings)
 
     workflow.connect([
-        (inputnode, ants_mean, [('epi', 'average_image')]),
-        (ants_mean, ants_hmc, [('average_image', 'fixed_image')]),
-        (inputnode, ants_hmc, [('epi', 'moving_image')]),
-        (ants_mean, skullstrip_epi, [('average_image', 'in_file')]),
-        (skullstrip_epi, dvars, [('mask_file', 'in_mask')]),
-        (ants_hmc, dvars, [('warped_image', 'in_file')]),
-        (dvars, concat, [('out_all', 'dvars')]),
-        (concat, outputnode, [('combined_out', 'dvar_out')]),
-        (ants_hmc, outputnode, [('warped_image', 'epi_hmc')]),
-        (skullstrip_epi, outputnode, [('mask_file', 'epi_mask')]),
-        (skullstrip_epi, ants_fd, [('mask_file', 'mask')]),
-        (ants_hmc, ants_fd, [('composite_transform', 'moco')]),
-        (ants_hmc, params, [('composite_transform', 'matrix')]),
-        (params, frame_displace,  [('parameters', 'in_plots')]),
-        (frame_displace, concat, [('out_file', 'frame_displace')]),
+        (inputnode, hmc, [('ref_epi', 'ref_file')]),
+        (inputnode, harmonize, [('ref_epi', 'reference')]),
+        (hmc, harmonize, [(('mat_file', _flatten), 'in_files')]),
+        (harmonize, outputnode, [('par_file', 'world_par')]),
+        (inputnode, hmc_in, [('epi_file', in_field)]),
+        (inputnode, hmc_confounds, [('epi_mask', 'in_mask')]),
+        (hmc_out, hmc_confounds, [(image_field, 'in_file'),
+                                  (params_field, 'in_plots')]),
+        (hmc_confounds, outputnode, [('out_file', 'dvars_out')]),
+        (inputnode, outputnode, [('epi_mask', 'epi_mask')]),
+        (hmc_out, outputnode, [(image_field, 'epi_hmc'),
+                               (params_field, 'par_file')]),
     ])
 
-    ds_mask = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='ants_mask'),
-        name='antsDerivativesEPImask'
-    )
-    ds_hmc = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='ants_hmc'),
-        name='antsDerivativesEPIHMC'
-    )
-    ds_dvars = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='ants_dvar'),
-        name='antsDerivativesEPIDVARS'
-    )
-    ds_par = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='ants_par'),
-        name='antsDerivativesMotPar'
-    )
-    ds_fd = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='ants_fd'),
-        name='antsDerivativesEPIFD'
+    ds_derivatives = pe.Node(
+        DerivativesBatchSink(base_directory=settings['output_dir'],
+                             suffixes=['fsl_hmc', 'fsl_dvar']),
+        name='Derivatives'
     )
+
     workflow.connect([
-        (inputnode, ds_mask, [('epi', 'source_file')]),
-        (inputnode, ds_hmc, [('epi', 'source_file')]),
-        (inputnode, ds_dvars, [('epi', 'source_file')]),
-        (inputnode, ds_fd, [('epi', 'source_file')]),
-        (inputnode, ds_par, [('epi', 'source_file')]),
-        (skullstrip_epi, ds_mask, [('mask_file', 'in_file')]),
-        (ants_hmc, ds_hmc, [('warped_image', 'in_file')]),
-        (concat, ds_dvars, [('combined_out', 'in_file')]),
-        (ants_fd, ds_fd, [('output', 'in_file')]),
-        (params, ds_par, [('parameters', 'in_file')])
+        (inputnode, ds_derivatives, [('epi', 'source_file')]),
+        (hmc_out, ds_derivatives, [(image_field, 'fsl_hmc')]),
+        (hmc_confounds, ds_derivatives, [('out_file', 'fsl_dvar')]),
     ])
     return workflow
 
-def test_fsl(name='test_mcflirt', settings=None):
+def test_native(name='test_nativemottcorr', settings=None):
     workflow = pe.Workflow(name=name)
-    inputnode = pe.Node(niu.IdentityInterface(fields=['epi']), name='inputnode')
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['epi', 'epi_file', 'ref_epi', 'epi_mask']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(
-        fields=['epi_hmc', 'dvars_out', 'epi_mask']), name='outputnode')
-
-    hmc = pe.Node(fsl.MCFLIRT(
-        save_mats=True, save_plots=True, mean_vol=True), name='fslEPI_hmc')
-    hmc.interface.estimated_memory_gb = settings["biggest_epi_file_size_gb"] * 3
-    skullstrip_epi = pe.Node(ComputeEPIMask(generate_report=True, dilation=1),
-                             name='skullstrip_epi')
-    dvars = pe.Node(ComputeDVARS(save_all=True, remove_zerovariance=True),
-                    name='fslDVARS')
-    dvars.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
-
-    frame_displace = pe.Node(FramewiseDisplacement(),
-                             name="FramewiseDisplacement")
-    frame_displace.interface.estimated_memory_gb = settings[
-                                              "biggest_epi_file_size_gb"] * 3
-
-    concat = pe.Node(
-        utility.Function(
-            function=_gather_confounds,
-            input_names=['dvars', 'frame_displace'],
-            output_names=['combined_out']
-        ),
-        name="ConcatConfounds"
-    )
+        fields=['epi_hmc', 'dvars_out', 'epi_mask', 'par_file', 'world_par']),
+        name='outputnode')
+
+    hmc, (hmc_in, in_field), (hmc_out, image_field, params_field) = hmc_nodes(
+        workflow, NativeMotionCorr(num_threads=settings.get('hmc_nthreads', 1)),
+        'nativeEPI_hmc', 'in_file', 'out_file', 'par_file', settings)
+    hmc.interface.num_threads = settings.get('hmc_nthreads', 1)
+    hmc_confounds = pe.Node(MotionConfounds(), name='nativeMotionConfounds')
+    set_memory(hmc_confounds, settings)
+    harmonize = pe.Node(HarmonizeMotion(convention='native'), name='nativeHarmonizeMotion')
+    set_memory(harmonize, settings)
 
     workflow.connect([
-        (inputnode, hmc, [('epi', 'in_file')]),
-        (hmc, skullstrip_epi, [('mean_img', 'in_file')]),
-        (skullstrip_epi, dvars, [('mask_file', 'in_mask')]),
-        (hmc, dvars, [('out_file', 'in_file')]),
-        (dvars, concat, [('out_all', 'dvars')]),
-        (concat, outputnode, [('combined_out', 'dvars_out')]),
-        (skullstrip_epi, outputnode, [('mask_file', 'epi_mask')]),
-        (hmc, outputnode, [('out_file', 'epi_hmc')]),
-        (hmc, frame_displace, [('par_file', 'in_plots')]),
-        (frame_displace, concat, [('out_file', 'frame_displace')]),
+        (inputnode, hmc, [('ref_epi', 'ref_file')]),
+        (inputnode, harmonize, [('ref_epi', 'reference')]),
+        (hmc_out, harmonize, [(params_field, 'in_files')]),
+        (harmonize, outputnode, [('par_file', 'world_par')]),
+        (inputnode, hmc_in, [('epi_file', in_field)]),
+        (inputnode, hmc_confounds, [('epi_mask', 'in_mask')]),
+        (hmc_out, hmc_confounds, [(image_field, 'in_file'),
+                                  (params_field, 'in_plots')]),
+        (hmc_confounds, outputnode, [('out_file', 'dvars_out')]),
+        (inputnode, outputnode, [('epi_mask', 'epi_mask')]),
+        (hmc_out, outputnode, [(image_field, 'epi_hmc'),
+                               (params_field, 'par_file')]),
     ])
 
-    ds_mask = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='fsl_mask'),
-        name='DerivativesEPImask'
-    )
-    ds_hmc = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='fsl_hmc'),
-        name='DerivativesEPIHMC'
-    )
-    ds_dvars = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='fsl_dvar'),
-        name='DerivativesEPIDVARS'
-    )
-    ds_fd = pe.Node(
-        DerivativesDataSink(base_directory=settings['output_dir'],
-                            suffix='fsl_fd'),
-        name='DerivativesEPIFD'
+    ds_derivatives = pe.Node(
+        DerivativesBatchSink(base_directory=settings['output_dir'],
+                             suffixes=['native_hmc', 'native_dvar', 'native_par']),
+        name='Derivatives'
     )
 
     workflow.connect([
-        (inputnode, ds_mask, [('epi', 'source_file')]),
-        (inputnode, ds_hmc, [('epi', 'source_file')]),
-        (inputnode, ds_dvars, [('epi', 'source_file')]),
-        (skullstrip_epi, ds_mask, [('mask_file', 'in_file')]),
-        (hmc, ds_hmc, [('out_file', 'in_file')]),
-        (concat, ds_dvars, [('combined_out', 'in_file')]),
+        (inputnode, ds_derivatives, [('epi', 'source_file')]),
+        (hmc_out, ds_derivatives, [(image_field, 'native_hmc'),
+                                   (params_field, 'native_par')]),
+        (hmc_confounds, ds_derivatives, [('out_file', 'native_dvar')]),
     ])
     return workflow
 
+def hmc_nodes(workflow, interface, name, in_field, image_field, params_field,
+              settings=None):
+    """
+    Creates the head-motion correction node of a branch. If
+    ``settings['hmc_chunk_size']`` is set, the run is split into temporal
+    chunks that are registered to the shared reference in parallel (as a
+    MapNode) and then stitched back together in order.
+
+    Returns the HMC node (to connect the reference to), the (node, field)
+    receiving the series and the (node, series field, parameters field)
+    providing the outputs.
+    """
+    chunk_size = (settings or {}).get('hmc_chunk_size', 0)
+    if not chunk_size:
+        hmc = pe.Node(interface, name=name)
+        set_memory(hmc, settings)
+        return hmc, (hmc, in_field), (hmc, image_field, params_field)
+
+    # the last chunk absorbs a remainder of up to half a chunk
+    max_chunk = int(chunk_size * 1.5)
+    split = pe.Node(SplitChunks(chunk_size=chunk_size), name=name + '_split')
+    set_memory(split, settings, nvols=max_chunk)
+    hmc = pe.MapNode(interface, iterfield=[in_field], name=name)
+    set_memory(hmc, settings, nvols=max_chunk)
+    merge = pe.Node(MergeChunks(), name=name + '_merge')
+    set_memory(merge, settings)
+    workflow.connect([
+        (split, hmc, [('out_files', in_field)]),
+        (hmc, merge, [(image_field, 'in_files'),
+                      (params_field, 'in_params')]),
+    ])
+    return hmc, (split, 'in_file'), (merge, 'out_file', 'par_file')
+
+def _flatten(inlist):
+    # the MAT files of MCFLIRT, from one node or from a MapNode over chunks
+    flat = []
+    for item in inlist:
+        flat += _flatten(item) if isinstance(item, (list, tuple)) else [item]
+    return flat
+
 def _first(inlist):
     if isinstance(inlist, (list, tuple)):
         inlist = _first(inlist[0])
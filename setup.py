@@ -43,7 +43,13 @@ def main():
         extras_require=ldict['EXTRA_REQUIRES'],
         dependency_links=ldict['LINKS_REQUIRES'],
         package_data={'fmriprep': ['data/*.json', 'viz/*.tpl', 'viz/*.json']},
-        entry_points={'console_scripts': ['fmriprep=fmriprep.run_workflow:main',]},
+        entry_points={'console_scripts': ['fmriprep=fmriprep.run_workflow:main',
+                                          'fmriprep-benchmark=fmriprep.run_benchmark:main',
+                                          'fmriprep-benchmark-construction='
+                                          'fmriprep.run_benchmark:construction_main',
+                                          'fmriprep-benchmark-resampling='
+                                          'fmriprep.run_benchmark:resampling_main',
+                                          'fmriprep-phantom=fmriprep.utils.phantom:main']},
         packages=find_packages(),
         zip_safe=False
     )
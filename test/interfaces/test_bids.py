@@ -5,7 +5,7 @@ import unittest
 
 from nipype.pipeline import engine as pe
 
-from fmriprep.interfaces.bids import DerivativesDataSink
+from fmriprep.interfaces.bids import DerivativesDataSink, DerivativesBatchSink
 import fmriprep.utils.misc as misc
 
 
@@ -42,3 +42,42 @@ class TestDerivativesDatasink(unittest.TestCase):
             deriv_filename
         )
         self.assertTrue(os.path.isfile(deriv_path))
+
+
+class TestDerivativesBatchSink(unittest.TestCase):
+    source_file = '/data/sub-01/ses-01/func/sub-01_ses-01_task-rest_bold.nii.gz'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+        self.in_files = []
+        for fname in ['hmc.nii.gz', 'par.par', 'chunk0.nii.gz', 'chunk1.nii.gz', 'plot.svg']:
+            self.in_files.append(os.path.join(self.tmpdir, fname))
+            with open(self.in_files[-1], 'w') as fobj:
+                fobj.write(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch(self):
+        sink = DerivativesBatchSink(suffixes=['hmc', 'par', 'chunk', 'fd'],
+                                    base_directory=self.out_dir,
+                                    source_file=self.source_file)
+        sink.inputs.hmc = self.in_files[0]
+        sink.inputs.par = self.in_files[1]
+        sink.inputs.chunk = self.in_files[2:4]
+        sink.inputs.in_images = [self.in_files[4]]
+        result = sink.run()
+
+        deriv_path = os.path.join(self.out_dir, 'derivatives', 'sub-01', 'ses-01', 'func',
+                                  'sub-01_ses-01_task-rest_bold')
+        expected = [deriv_path + '_hmc.nii.gz', deriv_path + '_par.par',
+                    deriv_path + '_chunk0000.nii.gz', deriv_path + '_chunk0001.nii.gz']
+        self.assertEqual(result.outputs.out_file[:4], expected)
+        # the undefined suffix is skipped, and the image goes to images/
+        self.assertEqual(len(result.outputs.out_file), 5)
+        self.assertTrue(result.outputs.out_file[4].startswith(
+            os.path.join(self.out_dir, 'images', 'sub-01')))
+        for in_file, out_file in zip(self.in_files, result.outputs.out_file):
+            with open(out_file) as fobj:
+                self.assertEqual(fobj.read(), os.path.basename(in_file))
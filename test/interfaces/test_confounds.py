@@ -0,0 +1,327 @@
+''' Testing module for fmriprep.interfaces.confounds '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from scipy import ndimage as nd
+from nipype.algorithms.confounds import compute_dvars
+
+from fmriprep.interfaces.confounds import (MotionConfounds, ResampleTPMs, TissueROIs,
+                                           CombinedCompCor, RegionSignals, DVARS_COLUMNS,
+                                           mask_distance)
+from fmriprep.utils.motion import framewise_displacement
+from fmriprep.utils.nifti import iter_volumes
+
+
+class TestMotionConfounds(unittest.TestCase):
+    ''' Checks the streaming confounds against nipype's implementations '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(42)
+        shape = (12, 10, 8)
+        baseline = rng.rand(*shape) * 500 + 500
+        series = baseline[..., np.newaxis] + rng.standard_normal(shape + (15,)) * 20
+        series[..., 7] += 60
+        nb.Nifti1Image(series.astype(np.float32), np.eye(4)).to_filename('epi.nii.gz')
+
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[2:-2, 2:-2, 1:-1] = 1
+        nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+
+        self.params = rng.standard_normal((15, 6)) * [0.01, 0.01, 0.01, 1., 1., 1.]
+        np.savetxt('motion.par', self.params)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_volumes(self):
+        data = np.asanyarray(nb.load('epi.nii.gz').dataobj)
+        for i, volume in enumerate(iter_volumes('epi.nii.gz')):
+            self.assertTrue(np.allclose(volume, data[..., i]))
+        self.assertEqual(i, data.shape[-1] - 1)
+
+    def test_confounds(self):
+        result = MotionConfounds(in_file='epi.nii.gz', in_mask='mask.nii.gz',
+                                 in_plots='motion.par').run()
+        confounds = pd.read_csv(result.outputs.out_file, sep='\t')
+        self.assertEqual(list(confounds.columns),
+                         DVARS_COLUMNS + ['FramewiseDisplacement'])
+        self.assertEqual(len(confounds), 14)
+
+        expected = compute_dvars('epi.nii.gz', 'mask.nii.gz', remove_zerovariance=True)
+        for column, values in zip(DVARS_COLUMNS, expected):
+            self.assertTrue(np.allclose(confounds[column], values, rtol=1e-4), column)
+        self.assertTrue(np.allclose(confounds['FramewiseDisplacement'],
+                                    framewise_displacement(self.params)))
+        self.assertAlmostEqual(result.outputs.avg_std, expected[0].mean(), places=4)
+
+
+class TestTissueROIs(unittest.TestCase):
+    ''' Checks the ROIs and the distance transform erosions '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        shape = (20, 20, 10)
+        # anisotropic voxels, 2mm thick slices
+        affine = np.diag([1., 1., 2., 1.])
+        self.mask = np.zeros(shape, dtype=bool)
+        self.mask[2:-2, 2:-2, 1:-1] = True
+        nb.Nifti1Image(self.mask.astype(np.uint8), affine).to_filename('mask.nii.gz')
+
+        csf = np.zeros(shape, dtype=np.float32)
+        csf[8:12, 8:12, 3:7] = 0.99
+        wm = np.zeros(shape, dtype=np.float32)
+        wm[2:-2, 2:-2, 1:-1] = 0.97
+        wm[8:12, 8:12, 3:7] = 0.2
+        for name, data in [('csf', csf), ('gm', np.zeros(shape)), ('wm', wm)]:
+            nb.Nifti1Image(data, affine).to_filename(name + '.nii.gz')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_mask_distance(self):
+        # one voxel of erosion on an isotropic grid is one binary erosion
+        distance = mask_distance(self.mask, (1., 1., 1.))
+        self.assertTrue(np.array_equal(distance > 1, nd.binary_erosion(self.mask)))
+        self.assertTrue(np.array_equal(distance > 0, self.mask))
+
+        # the grid edges are outside the mask
+        full = np.ones((5, 5, 5), dtype=bool)
+        self.assertEqual(mask_distance(full, (1., 1., 1.))[2, 2, 2], 3)
+        self.assertEqual(mask_distance(full, (1., 1., 2.))[2, 2, 0], 2)
+
+    def test_rois(self):
+        result = TissueROIs(in_tpms=['csf.nii.gz', 'gm.nii.gz', 'wm.nii.gz'],
+                            in_mask='mask.nii.gz', csf_mask_erosion_mm=2,
+                            wm_erosion_mm=1, wm_mask_erosion_mm=1).run()
+        outputs = {name: np.asanyarray(nb.load(getattr(result.outputs, name)).dataobj)
+                   for name in ['csf_roi', 'wm_roi', 'combined_roi', 'label_file',
+                                'eroded_mask']}
+
+        distance = mask_distance(self.mask, (1., 1., 2.))
+        self.assertTrue(np.array_equal(outputs['eroded_mask'], distance > 2))
+        self.assertEqual(outputs['csf_roi'].sum(), 4 * 4 * 4)
+        # the mask is eroded once for the WM, then the ROI (which has a hole) again
+        wm_roi = (distance > 1) & ~outputs['csf_roi'].astype(bool)
+        self.assertTrue(np.array_equal(outputs['wm_roi'],
+                                       mask_distance(wm_roi, (1., 1., 2.)) > 1))
+        self.assertTrue(np.array_equal(outputs['combined_roi'],
+                                       outputs['csf_roi'] | outputs['wm_roi']))
+        self.assertEqual(outputs['label_file'].shape, self.mask.shape + (2,))
+        self.assertTrue(np.array_equal(outputs['label_file'][..., 0], outputs['wm_roi']))
+        self.assertTrue(np.array_equal(outputs['label_file'][..., 1], self.mask))
+
+    def test_reference_header(self):
+        # the voxel data of the reference run is never decompressed: its gzip
+        # stream is truncated after the header
+        affine = np.diag([1., 1., 2., 1.])
+        affine[:3, 3] = [5, 5, 5]
+        series = np.random.RandomState(0).rand(*(self.mask.shape + (50,)))
+        nb.Nifti1Image(series.astype(np.float32), affine).to_filename('epi.nii.gz')
+        with open('epi.nii.gz', 'rb') as src, open('ref.nii.gz', 'wb') as fobj:
+            contents = src.read()
+            fobj.write(contents[:len(contents) // 10])
+
+        result = TissueROIs(in_tpms=['csf.nii.gz', 'gm.nii.gz', 'wm.nii.gz'],
+                            in_mask='mask.nii.gz', ref_header='ref.nii.gz').run()
+        self.assertTrue(np.array_equal(nb.load(result.outputs.combined_roi).affine, affine))
+        self.assertEqual(nb.load(result.outputs.label_file).shape, self.mask.shape + (2,))
+
+
+class TestResampleTPMs(unittest.TestCase):
+    ''' Checks the in-process application of FLIRT matrices '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        shape = (16, 14, 12)
+        # a linear ramp along each axis, so that linear interpolation is exact
+        grid = np.indices(shape).astype(np.float32)
+        self.affine = np.diag([2., 2., 2., 1.])
+        for i, name in enumerate(['csf', 'gm', 'wm']):
+            nb.Nifti1Image(grid[i] + 10 * i, self.affine).to_filename(name + '.nii.gz')
+        self.grid = grid
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, matrix, **inputs):
+        np.savetxt('t1_to_epi.mat', matrix)
+        result = ResampleTPMs(in_tpms=['csf.nii.gz', 'gm.nii.gz', 'wm.nii.gz'],
+                              reference='csf.nii.gz', in_matrix_file='t1_to_epi.mat',
+                              **inputs).run()
+        return [np.asanyarray(nb.load(out_file).dataobj)
+                for out_file in result.outputs.out_files]
+
+    def test_identity(self):
+        for interp in ['sinc', 'cubic', 'linear']:
+            csf, wm = self._run(np.eye(4), interp=interp)
+            self.assertTrue(np.allclose(csf, self.grid[0], atol=1e-3), interp)
+            self.assertTrue(np.allclose(wm, self.grid[2] + 20, atol=1e-3), interp)
+
+    def test_translation(self):
+        # FSL coordinates are flipped along x for images with a positive
+        # determinant: a shift of +4mm samples two voxels further along i,
+        # and two voxels back along j
+        matrix = np.eye(4)
+        matrix[:3, 3] = [4, 4, 0]
+        csf, wm = self._run(matrix, interp='linear')
+        self.assertTrue(np.allclose(csf[:-2, 2:], self.grid[0][:-2, 2:] + 2))
+        self.assertTrue(np.all(csf[-2:] == 0) and np.all(csf[:, :2] == 0))
+        self.assertTrue(np.allclose(wm[:-2, 2:], self.grid[2][:-2, 2:] + 20))
+
+        matrix[:3, 3] = [0, 4, 0]
+        _, gm = self._run(matrix, indices=[0, 1], interp='linear')
+        self.assertTrue(np.allclose(gm[:, 2:], self.grid[1][:, 2:] - 2 + 10))
+
+
+class TestCombinedCompCor(unittest.TestCase):
+    ''' Checks the shared CompCor against a direct implementation '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(0)
+        shape = (10, 10, 6)
+        nvols = 60
+        # a few strong noise sources plus white noise
+        sources = rng.standard_normal((nvols, 3)) * [10, 6, 3]
+        loadings = rng.standard_normal((3,) + shape)
+        series = 1000 + np.tensordot(loadings, sources, axes=(0, 1)) \
+            + rng.standard_normal(shape + (nvols,))
+        series[:5, :, :, :] += rng.standard_normal((5,) + shape[1:] + (nvols,)) * 100
+        nb.Nifti1Image(series.astype(np.float32), np.eye(4)).to_filename('epi.nii.gz')
+        self.series = series.astype(np.float32)
+
+        self.amask = np.zeros(shape, dtype=bool)
+        self.amask[5:, :, :] = True
+        self.tmask = np.zeros(shape, dtype=bool)
+        self.tmask[2:8, 2:8, 1:5] = True
+        nb.Nifti1Image(self.amask.astype(np.uint8), np.eye(4)).to_filename('amask.nii.gz')
+        nb.Nifti1Image(self.tmask.astype(np.uint8), np.eye(4)).to_filename('tmask.nii.gz')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _expected(voxels, num_components):
+        # detrend, variance normalize and decompose as nipype's CompCor
+        timepoints = np.linspace(-1, 1, voxels.shape[1])
+        design = np.column_stack((np.ones_like(timepoints), timepoints))
+        betas = np.linalg.lstsq(design, voxels.T.astype(np.float64), rcond=None)[0]
+        data = voxels.T - design.dot(betas)
+        data /= data.std(axis=0)
+        return np.linalg.svd(data, full_matrices=False)[0][:, :num_components]
+
+    def _assert_same_components(self, components, expected):
+        for i in range(expected.shape[1]):
+            # components are defined up to their sign
+            self.assertGreater(abs(np.corrcoef(components[:, i], expected[:, i])[0, 1]),
+                               0.999, i)
+
+    def test_components(self):
+        result = CombinedCompCor(realigned_file='epi.nii.gz', acompcor_mask='amask.nii.gz',
+                                 tcompcor_mask='tmask.nii.gz', percentile_threshold=.25,
+                                 num_components=3, svd_method='full').run()
+
+        acompcor = pd.read_csv(result.outputs.acompcor_file, sep='\t')
+        self.assertEqual(list(acompcor.columns), ['aCompCor00', 'aCompCor01', 'aCompCor02'])
+        self._assert_same_components(acompcor.values, self._expected(
+            self.series[self.amask], 3))
+
+        # the tCompCor ROI holds the most variable quarter of its mask
+        high_variance = np.asanyarray(nb.load(result.outputs.high_variance_mask).dataobj) > 0
+        self.assertFalse(np.any(high_variance & ~self.tmask))
+        self.assertEqual(high_variance.sum(), int(np.ceil(self.tmask.sum() / 4.)))
+        self.assertFalse(np.any(high_variance[5:]))
+        tcompcor = pd.read_csv(result.outputs.tcompcor_file, sep='\t')
+        self._assert_same_components(tcompcor.values, self._expected(
+            self.series[high_variance], 3))
+
+    def test_randomized(self):
+        kwargs = dict(realigned_file='epi.nii.gz', acompcor_mask='amask.nii.gz',
+                      tcompcor_mask='tmask.nii.gz', num_components=3)
+        full = CombinedCompCor(svd_method='full', **kwargs).run().outputs
+        randomized = CombinedCompCor(**kwargs).run().outputs
+        for name in ['acompcor_file', 'tcompcor_file']:
+            expected = np.loadtxt(getattr(full, name), skiprows=1)
+            components = np.loadtxt(getattr(randomized, name), skiprows=1)
+            # both are signed the same way
+            self.assertTrue(np.allclose(components, expected, atol=1e-3), name)
+
+
+class TestRegionSignals(unittest.TestCase):
+    ''' Checks the bincount region means against direct means '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(0)
+        shape = (8, 9, 5)
+        self.series = (rng.rand(*(shape + (20,))) * 100 +
+                       np.linspace(0, 50, 20)).astype(np.float32)
+        nb.Nifti1Image(self.series, np.eye(4)).to_filename('epi.nii.gz')
+
+        self.mask = np.zeros(shape, dtype=bool)
+        self.mask[1:-1, 1:-1, 1:-1] = True
+        self.wm = np.zeros(shape, dtype=bool)
+        self.wm[3:6, 3:6, 2:4] = True
+        nb.Nifti1Image(np.stack((self.wm, self.mask), axis=-1).astype(np.uint8),
+                       np.eye(4)).to_filename('masks.nii.gz')
+        nb.Nifti1Image(self.wm.astype(np.uint8), np.eye(4)).to_filename('wm.nii.gz')
+        nb.Nifti1Image(self.mask.astype(np.uint8), np.eye(4)).to_filename('mask.nii.gz')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _signals(self, label_files, class_labels, **inputs):
+        result = RegionSignals(in_file='epi.nii.gz', label_files=label_files,
+                               class_labels=class_labels, **inputs).run()
+        signals = pd.read_csv(result.outputs.out_file, sep='\t')
+        self.assertEqual(list(signals.columns), class_labels)
+        return signals
+
+    def test_overlapping_masks(self):
+        expected = [self.series[self.wm].mean(axis=0), self.series[self.mask].mean(axis=0)]
+        for label_files in [['masks.nii.gz'], ['wm.nii.gz', 'mask.nii.gz']]:
+            signals = self._signals(label_files, ['WhiteMatter', 'GlobalSignal'])
+            self.assertTrue(np.allclose(signals['WhiteMatter'], expected[0], rtol=1e-5))
+            self.assertTrue(np.allclose(signals['GlobalSignal'], expected[1], rtol=1e-5))
+
+    def test_labels(self):
+        labels = np.zeros(self.mask.shape, dtype=np.int16)
+        labels[self.mask] = 2
+        labels[self.wm] = 1
+        labels[0, 0, 0] = 7  # not a class
+        nb.Nifti1Image(labels, np.eye(4)).to_filename('labels.nii.gz')
+
+        signals = self._signals(['labels.nii.gz'], ['WhiteMatter', 'Other', 'Empty'],
+                                detrend=True)
+        expected = self.series[self.mask & ~self.wm].mean(axis=0)
+        timepoints = np.linspace(-1, 1, len(expected))
+        expected -= np.polyval(np.polyfit(timepoints, expected, 1), timepoints)
+        self.assertTrue(np.allclose(signals['Other'], expected, atol=1e-3))
+        self.assertAlmostEqual(signals['WhiteMatter'].mean(), 0, places=3)
+        self.assertTrue(signals['Empty'].isnull().all())
@@ -0,0 +1,325 @@
+''' Testing module for fmriprep.interfaces.hmc '''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from scipy import ndimage as nd
+
+from fmriprep.interfaces.hmc import (setup_levels, register_volume, NativeMotionCorr,
+                                    AntsMotionParameters, HarmonizeMotion, CompareMotion,
+                                    SplitChunks, MergeChunks, chunk_bounds)
+from fmriprep.utils.motion import (rigid_matrix, voxel_to_mm, framewise_displacement,
+                                   load_parameters, rms_displacement, load_ants_moco,
+                                   fov_center, world_parameters, matrix_parameters,
+                                   fsl_scaling)
+
+
+class TestNativeHMC(unittest.TestCase):
+    ''' Testing class for the native head-motion correction '''
+
+    shape = (40, 40, 28)
+    zooms = (3., 3., 4.)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(1234)
+        x, y, z = np.meshgrid(*[np.arange(s) for s in self.shape], indexing='ij')
+        head = np.exp(-2 * (((x - 20) / 12.) ** 2 + ((y - 20) / 15.) ** 2 +
+                            ((z - 14) / 10.) ** 2)) * 1000
+        texture = nd.gaussian_filter(rng.rand(*self.shape), 2) * 800
+        self.reference = (head + texture * (head > 200)).astype(np.float32)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def move(self, params):
+        vox2mm = voxel_to_mm(self.shape, self.zooms)
+        matrix = np.linalg.inv(vox2mm).dot(
+            np.linalg.inv(rigid_matrix(params))).dot(vox2mm)
+        return nd.affine_transform(self.reference, matrix[:3, :3],
+                                   offset=matrix[:3, 3], order=3)
+
+    def test_identity(self):
+        levels = setup_levels(self.reference, self.zooms, [4, 2, 1])
+        params = register_volume(self.reference, levels)
+        self.assertTrue(np.allclose(params, 0, atol=1e-3))
+
+    def test_known_motion(self):
+        expected = np.array([0.02, -0.03, 0.015, 1.5, -2., 0.8])
+        levels = setup_levels(self.reference, self.zooms, [4, 2, 1])
+        params = register_volume(self.move(expected), levels)
+
+        self.assertTrue(np.allclose(params[:3], expected[:3], atol=5e-3))
+        self.assertTrue(np.allclose(params[3:], expected[3:], atol=0.1))
+
+    def test_run(self):
+        expected = np.array([[0., 0., 0., 0., 0., 0.],
+                             [0.02, -0.03, 0.015, 1.5, -2., 0.8],
+                             [-0.01, 0.02, 0., -1., 0.5, 1.2],
+                             [0., 0.01, -0.02, 0.3, 1., -0.6]])
+        affine = voxel_to_mm(self.shape, self.zooms)
+        series = np.stack([self.move(params) for params in expected], axis=-1)
+        nb.Nifti1Image(series, affine).to_filename('epi.nii.gz')
+        nb.Nifti1Image(self.reference, affine).to_filename('ref.nii.gz')
+
+        for parallel in ['threads', 'processes']:
+            result = NativeMotionCorr(in_file='epi.nii.gz', ref_file='ref.nii.gz',
+                                      num_threads=2, parallel=parallel).run()
+            params = load_parameters(result.outputs.par_file)
+            self.assertEqual(params.shape, (4, 6))
+            self.assertTrue(np.allclose(params[:, :3], expected[:, :3], atol=5e-3))
+            self.assertTrue(np.allclose(params[:, 3:], expected[:, 3:], atol=0.1))
+
+            # the corrected volumes and their mean are back on the reference
+            inside = self.reference > 200
+            corrected = nb.load(result.outputs.out_file).get_fdata()
+            self.assertEqual(corrected.shape, series.shape)
+            for i in range(4):
+                error = np.abs(corrected[..., i] - self.reference)[inside]
+                self.assertLess(error.mean(), 0.02 * self.reference[inside].mean())
+
+            mean_img = nb.load(result.outputs.mean_img)
+            self.assertEqual(mean_img.shape, self.shape)
+            self.assertTrue(np.allclose(mean_img.affine, affine))
+            self.assertTrue(np.allclose(mean_img.get_fdata(), corrected.mean(axis=-1),
+                                        atol=1e-3))
+
+
+class TestAntsMotionParameters(unittest.TestCase):
+    ''' Testing class for the conversion of antsMotionCorr transforms '''
+
+    shape = (30, 34, 20)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        # an oblique reference, far from the origin of the world coordinates
+        self.affine = rigid_matrix([0.3, -0.2, 0.5, 40., -25., 60.]).dot(
+            np.diag([2.5, 2.5, 3., 1.]))
+        nb.Nifti1Image(np.zeros(self.shape, dtype=np.float32),
+                       self.affine).to_filename('ref.nii.gz')
+        self.center = fov_center(self.affine, self.shape)
+        self.assertGreater(np.linalg.norm(self.center), 50)
+
+        # known motion, as rotations around the center of the field of view
+        rng = np.random.RandomState(0)
+        self.params = rng.standard_normal((10, 6)) * np.array([0.02] * 3 + [1.] * 3)
+        to_center = np.eye(4)
+        to_center[:3, 3] = self.center
+        self.world = np.einsum('ij,njk,kl->nil', to_center, rigid_matrix(self.params),
+                               np.linalg.inv(to_center))
+
+        # antsMotionCorr writes the row-major matrices and the translations of
+        # transforms between LPS+ points, centered on the fixed image
+        lps = np.diag([-1., -1., 1., 1.])
+        matrices = np.einsum('ij,njk,kl->nil', lps, self.world, lps)
+        itk_center = lps[:3, :3].dot(self.center)
+        translations = (matrices[:, :3, 3] - itk_center +
+                        matrices[:, :3, :3].dot(itk_center))
+        values = np.hstack((rng.rand(10, 2), matrices[:, :3, :3].reshape(-1, 9),
+                            translations))
+        header = ['MetricPre', 'MetricPost'] + ['MOCOparam{}'.format(i) for i in range(12)]
+        np.savetxt('motcorrMOCOparams.csv', values, delimiter=str(','),
+                   header=str(','.join(header)), comments=str(''))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_world_matrices(self):
+        matrices = load_ants_moco('motcorrMOCOparams.csv', self.affine, self.shape)
+        self.assertTrue(np.allclose(matrices, self.world, atol=1e-6))
+        self.assertTrue(np.allclose(world_parameters(matrices, self.affine, self.shape),
+                                    self.params, atol=1e-6))
+
+    def test_parameters(self):
+        result = AntsMotionParameters(in_file='motcorrMOCOparams.csv',
+                                      reference='ref.nii.gz').run()
+        self.assertTrue(np.allclose(load_parameters(result.outputs.par_file),
+                                    self.params, atol=1e-5))
+
+        displacement = pd.read_csv(result.outputs.out_file, sep='\t')
+        self.assertTrue(np.allclose(displacement['FramewiseDisplacement'][1:],
+                                    framewise_displacement(self.params), atol=1e-4))
+        self.assertTrue(np.allclose(displacement['AbsoluteRMS'],
+                                    rms_displacement(rigid_matrix(self.params))[0],
+                                    atol=1e-4))
+        self.assertEqual(displacement['RelativeRMS'][0], 0)
+
+
+class TestCompareMotion(unittest.TestCase):
+    ''' Testing class for the comparison of motion traces '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        rng = np.random.RandomState(0)
+        self.params = rng.standard_normal((8, 6)) * np.array([0.02] * 3 + [1.] * 3)
+        np.savetxt('first.par', self.params)
+        shifted = self.params.copy()
+        shifted[:, 3] += 0.5
+        np.savetxt('second.par', shifted)
+
+        mask = np.zeros((10, 10, 10), dtype=np.uint8)
+        mask[3:7, 3:7, 3:7] = 1
+        nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_compare(self):
+        result = CompareMotion(in_files=['first.par', 'second.par', 'first.par'],
+                               labels=['a', 'b', 'c'], in_mask='mask.nii.gz',
+                               chunk_size=100).run()
+        table = pd.read_csv(result.outputs.out_file, sep='\t')
+        self.assertEqual(len(table), 8)
+        self.assertTrue(np.allclose(table['a_vs_b_trans_x'], 0.5))
+        self.assertTrue(np.allclose(table['a_vs_b_disp_mean'], 0.5))
+        self.assertTrue(np.allclose(table['a_vs_b_disp_max'], 0.5))
+        self.assertTrue(np.allclose(table['a_vs_b_fd'], 0))
+        self.assertTrue(np.allclose(table['a_vs_c_disp_max'], 0))
+
+        with open(result.outputs.summary_file) as fobj:
+            summary = json.load(fobj)
+        self.assertEqual(sorted(summary), ['a_vs_b', 'a_vs_c', 'b_vs_c'])
+        self.assertAlmostEqual(summary['a_vs_b']['correlation']['trans_x'], 1.)
+        self.assertAlmostEqual(summary['b_vs_c']['disp_mean_mm'], 0.5)
+
+
+class TestHarmonizeMotion(unittest.TestCase):
+    ''' Testing class for the conversion of each engine's motion to world parameters '''
+
+    shape = (30, 34, 20)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        # an oblique reference (positive determinant, so FSL flips x), off the origin
+        self.affine = rigid_matrix([0.3, -0.2, 0.5, 40., -25., 60.]).dot(
+            np.diag([2.5, 2.5, 3., 1.]))
+        ref_nii = nb.Nifti1Image(np.zeros(self.shape, dtype=np.float32), self.affine)
+        ref_nii.to_filename('ref.nii.gz')
+        mask = np.zeros(self.shape, dtype=np.uint8)
+        mask[5:25, 5:29, 4:16] = 1
+        nb.Nifti1Image(mask, self.affine).to_filename('mask.nii.gz')
+
+        # one known motion, written below in the frame of each engine
+        rng = np.random.RandomState(0)
+        self.params = rng.standard_normal((6, 6)) * np.array([0.02] * 3 + [1.] * 3)
+        to_center = np.eye(4)
+        to_center[:3, 3] = fov_center(self.affine, self.shape)
+        world = np.einsum('ij,njk,kl->nil', to_center, rigid_matrix(self.params),
+                          np.linalg.inv(to_center))
+
+        # native: along the voxel axes, around the center of the field of view
+        to_world = self.affine.dot(np.linalg.inv(
+            voxel_to_mm(self.shape, ref_nii.header.get_zooms())))
+        np.savetxt('native.par', matrix_parameters(np.einsum(
+            'ij,njk,kl->nil', np.linalg.inv(to_world), world, to_world)))
+
+        # FSL: from the input onto the reference, in scaled (and flipped) voxels
+        scaling = fsl_scaling(ref_nii.header)
+        voxels = np.einsum('ij,njk,kl->nil', np.linalg.inv(self.affine), world, self.affine)
+        self.mat_files = []
+        for i, vox_matrix in enumerate(voxels):
+            self.mat_files.append('MAT_{:04d}'.format(i))
+            np.savetxt(self.mat_files[-1], scaling.dot(np.linalg.inv(vox_matrix)).dot(
+                np.linalg.inv(scaling)))
+
+        # ANTs: LPS+ physical points, around the center of the fixed image
+        lps = np.diag([-1., -1., 1., 1.])
+        matrices = np.einsum('ij,njk,kl->nil', lps, world, lps)
+        itk_center = lps[:3, :3].dot(to_center[:3, 3])
+        translations = (matrices[:, :3, 3] - itk_center +
+                        matrices[:, :3, :3].dot(itk_center))
+        header = ['MetricPre', 'MetricPost'] + ['MOCOparam{}'.format(i) for i in range(12)]
+        np.savetxt('MOCOparams.csv', np.hstack((
+            rng.rand(6, 2), matrices[:, :3, :3].reshape(-1, 9), translations)),
+                   delimiter=str(','), header=str(','.join(header)), comments=str(''))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_harmonized(self):
+        par_files = []
+        for convention, in_files in [('native', ['native.par']), ('fsl', self.mat_files),
+                                     ('ants', ['MOCOparams.csv'])]:
+            par_files.append(HarmonizeMotion(in_files=in_files, convention=convention,
+                                             reference='ref.nii.gz').run().outputs.par_file)
+            self.assertTrue(np.allclose(load_parameters(par_files[-1]), self.params,
+                                        atol=1e-5))
+
+        result = CompareMotion(in_files=par_files, labels=['native', 'fsl', 'ants'],
+                               in_mask='mask.nii.gz').run()
+        table = pd.read_csv(result.outputs.out_file, sep='\t')
+        self.assertEqual(len(table), 6)
+        self.assertLess(table.values.max(), 1e-3)
+
+    def test_native_axes(self):
+        # with voxel axes along RAS+, the native parameters are the world ones
+        affine = voxel_to_mm(self.shape, (2.5, 2.5, 3.)).dot(
+            rigid_matrix([0., 0., 0., 10., -5., 3.]))
+        nb.Nifti1Image(np.zeros(self.shape, dtype=np.float32), affine).to_filename('ras.nii')
+        np.savetxt('ras.par', self.params)
+        result = HarmonizeMotion(in_files=['ras.par'], convention='native',
+                                 reference='ras.nii').run()
+        self.assertTrue(np.allclose(load_parameters(result.outputs.par_file), self.params,
+                                    atol=1e-5))
+
+
+class TestChunks(unittest.TestCase):
+    ''' Testing class for the temporal chunking of head-motion correction '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.data = np.random.RandomState(0).rand(6, 5, 4, 23).astype(np.float32)
+        nb.Nifti1Image(self.data, np.eye(4)).to_filename('epi.nii.gz')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_bounds(self):
+        self.assertEqual(chunk_bounds(23, 10), [(0, 10), (10, 23)])
+        self.assertEqual(chunk_bounds(26, 10), [(0, 10), (10, 20), (20, 26)])
+        self.assertEqual(chunk_bounds(4, 10), [(0, 4)])
+
+    def test_split_merge(self):
+        chunks = SplitChunks(in_file='epi.nii.gz', chunk_size=10).run().outputs.out_files
+        self.assertEqual([nb.load(chunk).shape[-1] for chunk in chunks], [10, 13])
+
+        par_files = []
+        for i, chunk in enumerate(chunks):
+            par_files.append('chunk{}.csv'.format(i))
+            with open(par_files[-1], 'w') as fobj:
+                fobj.write('MetricPre,MOCOparam0\n')
+                fobj.writelines('{},{}\n'.format(i, vol)
+                                for vol in range(nb.load(chunk).shape[-1]))
+
+        result = MergeChunks(in_files=chunks, in_params=par_files).run()
+        self.assertTrue(np.allclose(np.asanyarray(nb.load(result.outputs.out_file).dataobj),
+                                    self.data))
+        with open(result.outputs.par_file) as fobj:
+            lines = fobj.readlines()
+        self.assertEqual(len(lines), 24)
+        self.assertEqual(lines[0], 'MetricPre,MOCOparam0\n')
+        self.assertEqual(lines[11], '1,0\n')
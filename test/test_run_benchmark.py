@@ -0,0 +1,118 @@
+''' Testing module for fmriprep.run_benchmark '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nibabel as nb
+import numpy as np
+
+from fmriprep.interfaces.hmc import HarmonizeMotion
+from fmriprep.run_benchmark import benchmark_run, construction_benchmark, resampling_benchmark
+from fmriprep.utils.motion import (rigid_matrix, load_parameters, native_world_matrices,
+                                   fsl_scaling)
+from fmriprep.utils.phantom import make_phantom_dataset
+
+
+class TestConstructionBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_scaling(self):
+        rows = construction_benchmark(self.work_dir, [1, 3], [1, 2], nthreads=2)
+        self.assertEqual([(row['n_subjects'], row['n_runs']) for row in rows],
+                         [(1, 1), (3, 1), (1, 2), (3, 2)])
+        # one subgraph per run and subject
+        nodes = {(row['n_subjects'], row['n_runs']): row['n_nodes'] for row in rows}
+        self.assertEqual(nodes[(3, 1)], 3 * nodes[(1, 1)])
+        self.assertEqual(nodes[(1, 2)], 2 * nodes[(1, 1)])
+
+
+class TestMotionBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_fsl_accuracy(self):
+        bids_dir = os.path.join(self.work_dir, 'bids')
+        epi = make_phantom_dataset(bids_dir, size='small', n_vols=6)[0]
+        fname = os.path.basename(epi)[:-len('.nii.gz')]
+        truth_file = os.path.join(bids_dir, 'derivatives', 'phantom', 'sub-01', 'func',
+                                  fname + '_motion.par')
+        truth = load_parameters(truth_file)
+
+        # the same voxels on an oblique grid: the native truth no longer
+        # matches the world parameters of the run
+        epi_nii = nb.load(epi)
+        affine = rigid_matrix([0.2, 0.1, -0.3, 20., 10., -5.]).dot(epi_nii.affine)
+        nb.Nifti1Image(np.asanyarray(epi_nii.dataobj), affine,
+                       epi_nii.header).to_filename(epi)
+        epi_nii = nb.load(epi)
+
+        # the MCFLIRT matrices an exact FSL run would save
+        world = native_world_matrices(truth, affine, epi_nii.shape[:3],
+                                      epi_nii.header.get_zooms()[:3])
+        scaling = fsl_scaling(epi_nii.header)
+        mat_files = []
+        for i, matrix in enumerate(world):
+            vox_matrix = np.linalg.inv(affine).dot(matrix).dot(affine)
+            mat_files.append(os.path.join(self.work_dir, 'MAT_{:04d}'.format(i)))
+            np.savetxt(mat_files[-1], scaling.dot(np.linalg.inv(vox_matrix)).dot(
+                np.linalg.inv(scaling)))
+        world_par = HarmonizeMotion(in_files=mat_files, convention='fsl',
+                                    reference=epi).run().outputs.par_file
+        self.assertFalse(np.allclose(load_parameters(world_par), truth, atol=1e-3))
+
+        outputs = {'epi_file': epi, 'ref_epi': epi, 'epi_mask': epi, 'world_par': world_par}
+        settings = {'work_dir': self.work_dir, 'output_dir': os.path.join(self.work_dir, 'out')}
+        with mock.patch('fmriprep.workflows.base.epi_reference'), \
+                mock.patch('fmriprep.workflows.base.test_fsl'), \
+                mock.patch('fmriprep.run_benchmark._workflow_output',
+                           side_effect=lambda workflow, execgraph, field: outputs[field]):
+            rows = benchmark_run(epi, ['fsl'], settings, ground_truth={fname: truth_file})
+
+        self.assertEqual([row['engine'] for row in rows], ['reference', 'fsl'])
+        self.assertLess(rows[1]['rot_max_deg'], 1e-3)
+        self.assertLess(rows[1]['trans_max_mm'], 1e-3)
+
+
+class TestResamplingBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_agreement(self):
+        shape = (20, 20, 20)
+        tpms = []
+        for i in range(3):
+            data = np.zeros(shape, dtype=np.float32)
+            data[4 + i:14 + i, 5:15, 5:15] = 1.
+            tpms.append(os.path.join(self.work_dir, 'tpm{}.nii.gz'.format(i)))
+            nb.Nifti1Image(data, np.eye(4)).to_filename(tpms[-1])
+        np.savetxt(os.path.join(self.work_dir, 'xfm.mat'), np.eye(4))
+
+        rows = resampling_benchmark(self.work_dir, tpms, tpms[0],
+                                    os.path.join(self.work_dir, 'xfm.mat'), flirt=False)
+        self.assertEqual([(row['interp'], row['map']) for row in rows],
+                         [('sinc', 0), ('sinc', 2), ('cubic', 0), ('cubic', 2),
+                          ('linear', 0), ('linear', 2)])
+        # the identity only resamples the grid points
+        for row in rows:
+            self.assertAlmostEqual(row['roi_dice'], 1.)
+            self.assertEqual(row['roi_voxels'], 1000)
+        self.assertTrue(os.path.isfile(os.path.join(self.work_dir,
+                                                    'resampling_benchmark.tsv')))
@@ -0,0 +1,44 @@
+''' Testing module for fmriprep.utils.benchmark '''
+import unittest
+
+import mock
+import numpy as np
+
+from fmriprep.utils.benchmark import NodeResourceMonitor, parameter_errors
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_parameter_errors(self):
+        truth = np.zeros((3, 6))
+        estimated = truth.copy()
+        estimated[1, 0] = np.radians(1.)
+        estimated[2, 3] = -2.
+
+        errors = parameter_errors(estimated, truth)
+
+        self.assertAlmostEqual(errors['rot_max_deg'], 1.)
+        self.assertAlmostEqual(errors['trans_max_mm'], 2.)
+        self.assertAlmostEqual(errors['trans_rmse_mm'], np.sqrt(4. / 9))
+
+    def test_parameter_errors_shape(self):
+        with self.assertRaises(ValueError):
+            parameter_errors(np.zeros((3, 6)), np.zeros((4, 6)))
+
+    def test_node_monitor(self):
+        node = mock.MagicMock()
+        node.fullname = 'test_mcflirt.fslEPI_hmc'
+
+        monitor = NodeResourceMonitor(engine='fsl')
+        monitor(node, 'start')
+        monitor(node, 'end')
+
+        self.assertEqual(len(monitor.records), 1)
+        record = monitor.records[0]
+        self.assertEqual(record['node'], node.fullname)
+        self.assertGreaterEqual(record['wall_time_s'], 0)
+        self.assertGreater(record['peak_rss_gb'], 0)
+
+        summary = monitor.summary()
+        self.assertEqual(summary['n_nodes'], 1)
+        self.assertEqual(summary['failed_nodes'], 0)
@@ -0,0 +1,55 @@
+''' Testing module for fmriprep.utils.confounds '''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+import numpy as np
+import pandas as pd
+
+from fmriprep.utils import confounds
+
+
+class TestConfoundsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tsv = os.path.join(self.tmpdir, 'confounds.tsv')
+        self.data = pd.DataFrame({'FramewiseDisplacement': [np.nan, 0.1234567890123],
+                                  'aCompCor00': [1. / 3, -2.5]},
+                                 columns=['FramewiseDisplacement', 'aCompCor00'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        sidecar = confounds.write_confounds(self.data, self.tsv, sources=['fd', 'acompcor'])
+        self.assertEqual(sidecar, os.path.join(self.tmpdir, 'confounds.npz'))
+        self.assertEqual(confounds.confounds_metadata(self.tsv),
+                         [('FramewiseDisplacement', 'fd'), ('aCompCor00', 'acompcor')])
+
+        # the TSV is not parsed when the sidecar is up to date
+        with mock.patch('pandas.read_csv') as mock_csv_reader:
+            loaded = confounds.load_confounds(self.tsv)
+        mock_csv_reader.assert_not_called()
+        pd.testing.assert_frame_equal(loaded, self.data)
+
+        selected = confounds.load_confounds(sidecar, columns=['aCompCor00'])
+        self.assertEqual(selected.columns.tolist(), ['aCompCor00'])
+        self.assertEqual(selected['aCompCor00'].tolist(), [1. / 3, -2.5])
+        with self.assertRaises(KeyError):
+            confounds.load_confounds(sidecar, columns=['GlobalSignal'])
+
+    def test_stale_sidecar(self):
+        confounds.write_confounds(self.data, self.tsv)
+        past = time.time() - 100
+        os.utime(os.path.join(self.tmpdir, 'confounds.npz'), (past, past))
+
+        loaded = confounds.load_confounds(self.tsv, columns=['aCompCor00',
+                                                             'FramewiseDisplacement'])
+        self.assertEqual(loaded.columns.tolist(), ['aCompCor00', 'FramewiseDisplacement'])
+        self.assertTrue(np.isnan(loaded['FramewiseDisplacement'][0]))
+        with self.assertRaises(IOError):
+            confounds.confounds_metadata(self.tsv)
@@ -0,0 +1,67 @@
+''' Testing module for fmriprep.utils.crash '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+
+from fmriprep.utils import crash
+
+
+def _fail(in_value):
+    raise ValueError('failed on purpose')
+
+
+class TestCrashSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.crash_dir = os.path.join(self.tmpdir, 'log', '01', '20170101-000000')
+
+        workflow = pe.Workflow(name='crashing', base_dir=self.tmpdir)
+        workflow.config['execution']['crashdump_dir'] = self.crash_dir
+        node = pe.Node(niu.Function(function=_fail, input_names=['in_value'],
+                                    output_names=['out']), name='failing')
+        node.inputs.in_value = 3
+        workflow.add_nodes([node])
+        callback = mock.Mock(side_effect=crash.crash_callback)
+        self.assertRaises(RuntimeError, workflow.run,
+                          plugin_args={'status_callback': callback})
+        self.assertIn('exception', [call[0][1] for call in callback.call_args_list])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_summary(self):
+        crash_files = [fname for fname in os.listdir(self.crash_dir) if fname.endswith('.pklz')]
+        self.assertEqual(len(crash_files), 1)
+        crash_file = os.path.join(self.crash_dir, crash_files[0])
+        # written by the status callback, when the node failed
+        self.assertTrue(os.path.isfile(crash.summary_file(crash_file)))
+        self.assertEqual(crash.summarize_crashes(self.crash_dir), [])
+
+        with mock.patch('nipype.utils.filemanip.loadcrash') as mock_loadcrash:
+            error = crash.load_crash_summary(crash_file)
+        mock_loadcrash.assert_not_called()
+        self.assertEqual(error['node'], 'crashing.failing')
+        self.assertIn(['in_value', '3'], error['inputs'])
+        self.assertIn('failed on purpose', ''.join(error['traceback']))
+        self.assertEqual(error['crash_file'], crash_file)
+
+        # crash files without a summary are only named after their node
+        os.remove(crash.summary_file(crash_file))
+        error = crash.load_crash_summary(crash_file)
+        self.assertEqual(error['node'], 'failing')
+        self.assertEqual(error['traceback'], [])
+
+    def test_unreadable(self):
+        bad_file = os.path.join(self.crash_dir, 'crash-20170101-000001-user-broken.pklz')
+        with open(bad_file, 'w') as fobj:
+            fobj.write('not a pickle')
+        with mock.patch.object(crash.LOGGER, 'warning') as mock_warning:
+            self.assertEqual(crash.summarize_crashes(self.crash_dir), [])
+        mock_warning.assert_called_once()
+        self.assertEqual(mock_warning.call_args[0][1], bad_file)
@@ -0,0 +1,139 @@
+''' Testing module for fmriprep.utils.layout '''
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from fmriprep.utils import layout as bids_layout
+from fmriprep.utils.misc import collect_bids_data
+
+FILES = [
+    'sub-01/anat/sub-01_T1w.nii.gz',
+    'sub-01/func/sub-01_task-rest_run-01_bold.nii.gz',
+    'sub-01/func/sub-01_task-rest_run-01_bold.json',
+    'sub-01/func/sub-01_task-rest_run-01_sbref.nii.gz',
+    'sub-01/func/sub-01_task-nback_run-02_bold.nii',
+    'sub-01/fmap/sub-01_dir-1_run-1_epi.nii.gz',
+    'sub-02/ses-a/anat/sub-02_ses-a_T1w.nii.gz',
+    'sub-02/ses-a/func/sub-02_ses-a_task-rest_bold.nii.gz',
+    'sub-02/ses-b/func/sub-02_ses-b_task-rest_bold.nii.gz',
+]
+
+
+class TestBIDSIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for relpath in FILES:
+            self.touch(relpath)
+        self.cache_file = os.path.join(self.root, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, relpath):
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def test_collect(self):
+        data = collect_bids_data(self.root, 'sub-01', layout=bids_layout.BIDSIndex(self.root))
+        self.assertEqual(data['t1w'], [os.path.join(self.root, FILES[0])])
+        self.assertEqual(sorted(data['func']), sorted(
+            [os.path.join(self.root, FILES[1]), os.path.join(self.root, FILES[4])]))
+        self.assertEqual(data['sbref'], [os.path.join(self.root, FILES[3])])
+        self.assertEqual(data['fmap'], [os.path.join(self.root, FILES[5])])
+
+    def test_filters(self):
+        layout = bids_layout.BIDSIndex(self.root, subjects=['02'])
+        self.assertEqual(collect_bids_data(self.root, '02', session='b', layout=layout)['func'],
+                         [os.path.join(self.root, FILES[8])])
+        self.assertEqual(collect_bids_data(self.root, '01', task='rest', run=1,
+                                           layout=layout)['func'],
+                         [os.path.join(self.root, FILES[1])])
+
+    def test_pushdown(self):
+        with mock.patch('os.walk', side_effect=os.walk) as mock_walk:
+            bids_layout.BIDSIndex(self.root, subjects=['01'])
+        self.assertEqual(
+            set(os.path.basename(call[0][0]) for call in mock_walk.call_args_list),
+            {'sub-01'})
+
+    def test_persistence(self):
+        bids_layout.BIDSIndex(self.root, cache_file=self.cache_file)
+        with mock.patch('os.walk') as mock_walk:
+            layout = bids_layout.BIDSIndex(self.root, cache_file=self.cache_file)
+        mock_walk.assert_not_called()
+        self.assertEqual(len(layout.get(subject='02', modality='func')), 2)
+
+        # adding a file invalidates the folder it lives in
+        time.sleep(0.01)
+        self.touch('sub-02/ses-b/func/sub-02_ses-b_task-nback_bold.nii.gz')
+        os.utime(os.path.join(self.root, 'sub-02', 'ses-b', 'func'), None)
+        layout = bids_layout.BIDSIndex(self.root, cache_file=self.cache_file)
+        self.assertEqual(len(layout.get(subject='02', modality='func')), 3)
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('task-rest_bold.json', {'RepetitionTime': 2.0, 'TaskName': 'rest'})
+        self.write('sub-02/sub-02_task-rest_bold.json', {'EchoTime': 0.03})
+        self.write('sub-02/ses-a/sub-02_ses-a_task-rest_bold.json', {'RepetitionTime': 1.5})
+        self.write('sub-02/ses-a/func/sub-02_ses-a_task-rest_run-1_bold.json',
+                   {'SliceTiming': [0, 0.5]})
+        self.epis = [os.path.join(self.root, 'sub-02', ses, 'func',
+                                  'sub-02_{}_task-rest_run-1_bold.nii.gz'.format(ses))
+                     for ses in ['ses-a', 'ses-b']]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, relpath, contents):
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fobj:
+            json.dump(contents, fobj)
+
+    def test_inheritance(self):
+        self.assertEqual(bids_layout.get_metadata(self.epis[0]),
+                         {'RepetitionTime': 1.5, 'TaskName': 'rest', 'EchoTime': 0.03,
+                          'SliceTiming': [0, 0.5]})
+        self.assertEqual(bids_layout.get_metadata(self.epis[1]),
+                         {'RepetitionTime': 2.0, 'TaskName': 'rest', 'EchoTime': 0.03})
+
+    def test_parsed_once(self):
+        with mock.patch('json.load', side_effect=json.load) as mock_load:
+            metadata = bids_layout.prefetch_metadata(self.epis)
+            bids_layout.get_metadata(self.epis[0])
+        self.assertEqual(metadata[self.epis[1]]['RepetitionTime'], 2.0)
+        # each of the 4 JSON files is read once, though the top ones are shared
+        self.assertLessEqual(mock_load.call_count, 4)
+
+        # the returned metadata is a copy
+        metadata[self.epis[0]]['SliceTiming'].append(1.0)
+        self.assertEqual(bids_layout.get_metadata(self.epis[0])['SliceTiming'], [0, 0.5])
+
+    def test_chain_cache_bounded(self):
+        with mock.patch.object(bids_layout, 'CHAIN_CACHE_SIZE', 1):
+            for epi in self.epis:
+                bids_layout.sidecar_chain(epi)
+            self.assertEqual(list(bids_layout._CHAIN_CACHE), [self.epis[1]])
+        self.assertEqual(bids_layout.sidecar_chain(self.epis[0])[-1],
+                         self.epis[0][:-len('.nii.gz')] + '.json')
+
+    def test_invalidation(self):
+        self.assertEqual(bids_layout.get_metadata(self.epis[1])['RepetitionTime'], 2.0)
+        self.write('task-rest_bold.json', {'RepetitionTime': 2.5})
+        stat = os.stat(os.path.join(self.root, 'task-rest_bold.json'))
+        os.utime(os.path.join(self.root, 'task-rest_bold.json'),
+                 (stat.st_atime, stat.st_mtime + 1))
+        self.assertEqual(bids_layout.get_metadata(self.epis[1]),
+                         {'RepetitionTime': 2.5, 'EchoTime': 0.03})
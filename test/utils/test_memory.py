@@ -0,0 +1,66 @@
+''' Testing module for fmriprep.utils.memory '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nibabel as nb
+import numpy as np
+
+from fmriprep.utils import memory
+from fmriprep.utils.misc import get_biggest_epi_file_size_gb
+
+
+class TestMemoryModel(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.epi = os.path.join(self.tmpdir, 'epi.nii.gz')
+        nb.Nifti1Image(np.zeros((10, 10, 8, 50), dtype=np.int16),
+                       np.eye(4)).to_filename(self.epi)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_header_only(self):
+        with mock.patch('nibabel.arrayproxy.ArrayProxy.__array__') as mock_array:
+            self.assertEqual(memory.epi_dims(self.epi), (800, 50))
+            size = get_biggest_epi_file_size_gb([self.epi])
+        mock_array.assert_not_called()
+        self.assertAlmostEqual(size, 800 * 50 * 4 / memory.GB)
+
+    def test_estimates(self):
+        settings = {'epi_dims': (800, 50)}
+        self.assertAlmostEqual(memory.memory_gb('ComputeDVARS', settings),
+                               memory.BASE_GB + 3 * 8 * 800 * 50 / memory.GB)
+        self.assertAlmostEqual(memory.memory_gb('MotionConfounds', settings),
+                               memory.BASE_GB + (800 * 50 + 8 * 800 + 2 * 800 * 50) * 4 /
+                               memory.GB)
+        # chunks only hold their own volumes
+        self.assertLess(memory.memory_gb('MCFLIRT', settings, nvols=10),
+                        memory.memory_gb('MCFLIRT', settings))
+        # without a run description, the largest run of the subject is used
+        self.assertAlmostEqual(
+            memory.memory_gb('ComputeDVARS', {'biggest_epi_file_size_gb': 1}),
+            memory.BASE_GB + 6)
+
+    def test_chunks(self):
+        # streaming_dvars holds chunks of the time courses of all the volumes
+        from fmriprep.interfaces.confounds import streaming_dvars
+        chunk_voxels, chunks = memory.CHUNK_FACTORS['MotionConfounds']
+        self.assertEqual(chunk_voxels, streaming_dvars.__defaults__[-1])
+
+        small = memory.memory_gb('MotionConfounds', {'epi_dims': (100000, 1000)})
+        large = memory.memory_gb('MotionConfounds', {'epi_dims': (200000, 1000)})
+        self.assertAlmostEqual(small - memory.BASE_GB,
+                               4 * (100000 * 1008 + chunks * chunk_voxels * 1000) / memory.GB)
+        # the chunks do not grow with the number of voxels, only the buffer does
+        self.assertAlmostEqual(large - small, 4 * 100000 * 1008 / memory.GB)
+
+    def test_set_memory(self):
+        node = mock.Mock()
+        node.interface = mock.Mock(spec=[])
+        memory.set_memory(node, {'epi_dims': (800, 50)}, interface='MCFLIRT')
+        self.assertAlmostEqual(node.interface.estimated_memory_gb,
+                               memory.memory_gb('MCFLIRT', {'epi_dims': (800, 50)}))
@@ -0,0 +1,147 @@
+''' Testing module for fmriprep.utils.nifti '''
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import nibabel as nb
+import numpy as np
+
+from fmriprep.utils import nifti
+
+
+class TestParallelGzip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.img = nb.Nifti1Image(rng.rand(10, 12, 8, 20).astype(np.float32), np.eye(4))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save(self):
+        out_file = os.path.join(self.tmpdir, 'out.nii.gz')
+        reference = os.path.join(self.tmpdir, 'ref.nii.gz')
+        self.img.to_filename(reference)
+        nifti.save_nifti(self.img, out_file, level=6, nthreads=3)
+
+        with gzip.open(out_file) as fobj, gzip.open(reference) as ref:
+            self.assertEqual(fobj.read(), ref.read())
+        self.assertTrue(np.array_equal(np.asanyarray(nb.load(out_file).dataobj),
+                                       self.img.get_fdata(dtype=np.float32)))
+
+    def test_members(self):
+        data = np.arange(100000, dtype=np.int32).tobytes()
+        out_file = os.path.join(self.tmpdir, 'out.gz')
+        # small blocks: many gzip members compressed by several threads
+        with nifti.ParallelGzipFile(out_file, nthreads=3, block_size=4096) as fobj:
+            fobj.write(data[:1000])
+            fobj.write(data[1000:])
+            fobj.seek(len(data) + 10)
+            self.assertEqual(fobj.tell(), len(data) + 10)
+            self.assertRaises(IOError, fobj.seek, 0)
+
+        with open(out_file, 'rb') as fobj:
+            self.assertGreater(fobj.read().count(b'\x1f\x8b\x08'), len(data) // 4096)
+        with gzip.open(out_file) as fobj:
+            self.assertEqual(fobj.read(), data + b'\x00' * 10)
+
+    def test_gzip_file(self):
+        in_file = os.path.join(self.tmpdir, 'in.nii')
+        nifti.save_nifti(self.img, in_file)
+        out_file = nifti.gzip_file(in_file, os.path.join(self.tmpdir, 'in.nii.gz'),
+                                   nthreads=2)
+        with open(in_file, 'rb') as fobj, gzip.open(out_file) as gzobj:
+            self.assertEqual(fobj.read(), gzobj.read())
+
+
+class TestWorkPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_work_file(self):
+        with mock.patch.dict(os.environ, {'FMRIPREP_WORK_COMPRESS': ''}):
+            self.assertEqual(nifti.work_file('roi.nii.gz'), 'roi.nii')
+            self.assertEqual(nifti.fsl_output_type(), 'NIFTI')
+        with mock.patch.dict(os.environ, {'FMRIPREP_WORK_COMPRESS': '1'}):
+            self.assertEqual(nifti.work_file('roi.nii.gz'), 'roi.nii.gz')
+            self.assertEqual(nifti.fsl_output_type(), 'NIFTI_GZ')
+        self.assertEqual(nifti.work_file('motion.par'), 'motion.par')
+
+    def test_load_data(self):
+        in_file = os.path.join(self.tmpdir, 'roi.nii')
+        nifti.save_nifti(nb.Nifti1Image(np.ones((4, 4, 4), dtype=np.float32), np.eye(4)),
+                         in_file)
+        data = nifti.load_data(in_file)
+        self.assertIsInstance(data, np.memmap)
+        # copy-on-write: the file is left intact
+        data[data > 0] = 0
+        self.assertEqual(nifti.load_data(in_file).sum(), 64)
+
+    def test_iter_mapped(self):
+        in_file = os.path.join(self.tmpdir, 'epi.nii')
+        data = np.random.RandomState(0).rand(4, 5, 3, 6).astype(np.float32)
+        nifti.save_nifti(nb.Nifti1Image(data, np.eye(4)), in_file)
+        # uncompressed volumes are sliced from the memory map, not read
+        with mock.patch('fmriprep.utils.nifti.ImageOpener') as mock_opener:
+            volumes = list(nifti.iter_volumes(in_file, dtype=np.float64))
+        mock_opener.assert_not_called()
+        self.assertEqual(len(volumes), 6)
+        self.assertEqual(volumes[0].dtype, np.float64)
+        self.assertTrue(np.allclose(np.stack(volumes, axis=-1), data))
+
+
+class TestHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.epi = os.path.join(self.tmpdir, 'epi.nii.gz')
+        affine = np.diag([2., 2., 3., 1.])
+        affine[:3, 3] = [-20, -30, 10]
+        data = np.random.RandomState(0).randint(0, 1000, (10, 12, 8, 20)).astype(np.int16)
+        nb.Nifti1Image(data, affine).to_filename(self.epi)
+
+        # a reference whose voxel data cannot be decompressed: the gzip
+        # stream is truncated after the header
+        self.header_only = os.path.join(self.tmpdir, 'header_only.nii.gz')
+        with open(self.epi, 'rb') as src, open(self.header_only, 'wb') as fobj:
+            contents = src.read()
+            fobj.write(contents[:len(contents) // 2])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_header_only(self):
+        with self.assertRaises(Exception):
+            np.asanyarray(nb.load(self.header_only).dataobj)
+
+        header = nifti.load_header(self.header_only)
+        self.assertEqual(header.get_data_shape(), (10, 12, 8, 20))
+        img = nifti.image_like(np.zeros((10, 12, 8), dtype=np.uint8), self.header_only)
+        self.assertTrue(np.array_equal(img.affine, nb.load(self.epi).affine))
+        self.assertEqual(img.shape, (10, 12, 8))
+
+        out_file = os.path.join(self.tmpdir, 'roi.nii.gz')
+        nifti.save_nifti(img, out_file)
+        self.assertTrue(np.array_equal(nb.load(out_file).affine, img.affine))
+
+    def test_cache(self):
+        header = nifti.load_header(self.epi)
+        with mock.patch('nibabel.load') as mock_load:
+            cached = nifti.load_header(self.epi)
+        mock_load.assert_not_called()
+        self.assertEqual(cached, header)
+        # callers get copies
+        self.assertIsNot(cached, header)
+
+        # a rewritten file is parsed again
+        nb.Nifti1Image(np.ones((4, 4, 4), dtype=np.int16), np.eye(4)).to_filename(self.epi)
+        os.utime(self.epi, (0, 0))
+        self.assertEqual(nifti.load_header(self.epi).get_data_shape(), (4, 4, 4))
@@ -0,0 +1,53 @@
+''' Testing module for fmriprep.utils.phantom '''
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel as nb
+import numpy as np
+
+import fmriprep.utils.misc as misc
+from fmriprep.utils.phantom import make_phantom_dataset
+
+
+class TestPhantom(unittest.TestCase):
+    n_vols = 6
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.bold_files = make_phantom_dataset(
+            os.path.join(self.out_dir, 'ds'), n_runs=2, size='small', n_vols=self.n_vols)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_layout(self):
+        self.assertEqual(len(self.bold_files), 2)
+        subject_data = misc.collect_bids_data(os.path.join(self.out_dir, 'ds'), '01')
+
+        self.assertEqual(sorted(subject_data['func']), sorted(self.bold_files))
+        self.assertEqual(len(subject_data['t1w']), 1)
+        self.assertEqual(len(subject_data['sbref']), 2)
+        # the sidecar metadata of every run is resolved when collecting the data
+        self.assertEqual(sorted(subject_data['metadata']), sorted(self.bold_files))
+        for metadata in subject_data['metadata'].values():
+            self.assertEqual(metadata['TaskName'], 'phantom')
+
+    def test_ground_truth(self):
+        bold_nii = nb.load(self.bold_files[0])
+        self.assertEqual(bold_nii.shape, (32, 32, 20, self.n_vols))
+
+        truth = os.path.join(
+            self.out_dir, 'ds', 'derivatives', 'phantom', 'sub-01', 'func',
+            'sub-01_task-phantom_run-01_bold_motion.par')
+        params = np.loadtxt(truth)
+        self.assertEqual(params.shape, (self.n_vols, 6))
+        self.assertTrue(np.allclose(params[0], 0))
+
+    def test_deterministic(self):
+        other = make_phantom_dataset(os.path.join(self.out_dir, 'ds2'), n_runs=2,
+                                     size='small', n_vols=self.n_vols)
+        for first, second in zip(self.bold_files, other):
+            self.assertTrue(np.array_equal(np.asanyarray(nb.load(first).dataobj),
+                                           np.asanyarray(nb.load(second).dataobj)))
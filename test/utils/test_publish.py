@@ -0,0 +1,72 @@
+''' Testing module for fmriprep.utils.publish '''
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from fmriprep.utils import publish
+
+
+class TestPublish(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.in_file = os.path.join(self.tmpdir, 'in.nii')
+        self.out_file = os.path.join(self.tmpdir, 'out.nii')
+        with open(self.in_file, 'wb') as fobj:
+            fobj.write(os.urandom(1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, fname):
+        with open(fname, 'rb') as fobj:
+            return fobj.read()
+
+    def test_hardlink(self):
+        self.assertEqual(publish.publish_file(self.in_file, self.out_file), 'hardlink')
+        self.assertTrue(os.path.samefile(self.in_file, self.out_file))
+        self.assertEqual(publish.publish_file(self.in_file, self.out_file), 'skipped')
+
+    def test_fallback(self):
+        with mock.patch('os.link', side_effect=OSError(18, 'Invalid cross-device link')):
+            method = publish.publish_file(self.in_file, self.out_file)
+        self.assertIn(method, ['reflink', 'copy'])
+        self.assertFalse(os.path.samefile(self.in_file, self.out_file))
+        self.assertEqual(self.read(self.out_file), self.read(self.in_file))
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['in.nii', 'out.nii'])
+
+        # same size and mtime: nothing is written
+        with mock.patch('fmriprep.utils.publish._copy') as mock_copy:
+            self.assertEqual(publish.publish_file(self.in_file, self.out_file, mode='copy'),
+                             'skipped')
+        mock_copy.assert_not_called()
+
+    def test_changed(self):
+        publish.publish_file(self.in_file, self.out_file, mode='copy')
+        # touched but identical: hashed and skipped
+        os.utime(self.out_file, (0, 0))
+        self.assertEqual(publish.publish_file(self.in_file, self.out_file, mode='copy'),
+                         'skipped')
+
+        # new contents replace the target, and never write through a link
+        link = os.path.join(self.tmpdir, 'link.nii')
+        publish.publish_file(self.in_file, link, mode='hardlink')
+        original = self.read(self.in_file)
+        new_file = os.path.join(self.tmpdir, 'new.nii')
+        with open(new_file, 'wb') as fobj:
+            fobj.write(os.urandom(1000))
+        self.assertEqual(publish.publish_file(new_file, link, mode='copy'), 'copy')
+        self.assertEqual(self.read(link), self.read(new_file))
+        self.assertEqual(self.read(self.in_file), original)
+
+    def test_compress(self):
+        out_file = os.path.join(self.tmpdir, 'out.nii.gz')
+        self.assertEqual(publish.publish_file(self.in_file, out_file), 'gzip')
+        with gzip.open(out_file) as fobj:
+            self.assertEqual(fobj.read(), self.read(self.in_file))
+        self.assertEqual(publish.publish_file(self.in_file, out_file), 'skipped')
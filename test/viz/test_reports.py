@@ -0,0 +1,124 @@
+''' Testing module for fmriprep.viz.reports '''
+import base64
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import numpy as np
+from matplotlib import image as mimage
+
+from fmriprep.viz import reports
+
+REPORTLETS = {
+    'sub-01/func/sub-01_task-rest_run-1_bold_acompcor.svg': 'acompcor',
+    'sub-01/func/sub-01_task-rest_run-1_bold_tcompcor.svg': 'tcompcor',
+    'sub-01/func/sub-01_task-rest_run-1_bold_tcompcor.txt': 'not a reportlet',
+    'sub-02/anat/sub-02_T1w_t1_seg.svg': 't1 segmentation',
+}
+
+
+class TestRunReports(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        for relpath, contents in REPORTLETS.items():
+            path = os.path.join(self.out_dir, 'reports', relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fp:
+                fp.write('<?xml version="1.0" ?>\n<svg>{}</svg>'.format(contents))
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_element_index(self):
+        elements = [reports.Element('a', 'func/.*_bold', '', ''),
+                    reports.Element('b', 'tcompcor$', '', ''),
+                    reports.Element('c', 'anat/', '', '')]
+        pattern = reports.element_index(elements)
+        for fname in ['sub-01/func/sub-01_bold_tcompcor', 'sub-01/anat/sub-01_T1w']:
+            matches = pattern.match(fname)
+            self.assertEqual([matches.group('e%d' % i) is not None for i in range(3)],
+                             [bool(element.file_pattern.search(fname))
+                              for element in elements])
+
+    def test_reports(self):
+        out_files = reports.run_reports(self.out_dir, nprocs=1)
+        self.assertEqual(out_files, [os.path.join(self.out_dir, 'sub-01.html'),
+                                     os.path.join(self.out_dir, 'sub-02.html')])
+        with open(out_files[0]) as fp:
+            report = fp.read()
+        self.assertIn('<svg>acompcor</svg>', report)
+        self.assertIn('<svg>tcompcor</svg>', report)
+        self.assertNotIn('not a reportlet', report)
+        self.assertNotIn('<?xml version="1.0" ?>\n<svg>', report)
+
+        # unchanged subjects are skipped
+        with mock.patch('fmriprep.viz.reports.Report') as mock_report:
+            self.assertEqual(reports.run_reports(self.out_dir, nprocs=1), [])
+        mock_report.assert_not_called()
+
+        path = os.path.join(self.out_dir, 'reports', 'sub-02', 'anat', 'sub-02_T1w_t1_seg.svg')
+        with open(path, 'w') as fp:
+            fp.write('<?xml version="1.0" ?>\n<svg>new segmentation</svg>')
+        self.assertEqual(reports.run_reports(self.out_dir, nprocs=1),
+                         [os.path.join(self.out_dir, 'sub-02.html')])
+
+    def test_external(self):
+        # a matplotlib-like reportlet, with an embedded raster image
+        png = io.BytesIO()
+        mimage.imsave(png, np.random.rand(100, 400))
+        path = os.path.join(self.out_dir, 'reports', 'sub-02', 'anat', 'sub-02_T1w_t1_seg.svg')
+        with open(path, 'w') as fp:
+            fp.write('<?xml version="1.0" ?>\n<!-- made by matplotlib -->\n<svg>\n  <image '
+                     'xlink:href="data:image/png;base64,{}"/>\n</svg>'.format(
+                         base64.b64encode(png.getvalue()).decode('ascii')))
+
+        out_files = reports.run_reports(self.out_dir, nprocs=1, external=True, compress=True)
+        with open(out_files[1]) as fp:
+            report = fp.read()
+        self.assertNotIn('<svg>', report)
+        self.assertIn('data-src="sub-02_files/anat/sub-02_T1w_t1_seg.svg.gz"', report)
+        self.assertIn('src="sub-02_files/anat/sub-02_T1w_t1_seg_thumb.png"', report)
+
+        with gzip.open(os.path.join(self.out_dir, 'sub-02_files', 'anat',
+                                    'sub-02_T1w_t1_seg.svg.gz')) as fp:
+            minified = fp.read().decode('utf-8')
+        self.assertTrue(minified.startswith('<svg><image '))
+        thumbnail = mimage.imread(os.path.join(self.out_dir, 'sub-02_files', 'anat',
+                                               'sub-02_T1w_t1_seg_thumb.png'))
+        self.assertEqual(thumbnail.shape[1], reports.THUMBNAIL_WIDTH)
+        # reportlets without raster images have no thumbnail
+        with open(out_files[0]) as fp:
+            self.assertNotIn('_thumb.png', fp.read())
+
+        # the external files are made once
+        os.remove(os.path.join(self.out_dir, 'sub-02.html'))
+        with mock.patch('fmriprep.viz.reports.make_thumbnail') as mock_thumbnail:
+            reports.run_reports(self.out_dir, nprocs=1, external=True, compress=True)
+        mock_thumbnail.assert_not_called()
+
+    def test_crash_summaries(self):
+        crash_dir = os.path.join(self.out_dir, 'log', '01', '20170101-000000')
+        os.makedirs(crash_dir)
+        crash_file = os.path.join(crash_dir, 'crash-20170101-000000-user-failing.pklz')
+        # not a pickle: the report only reads the summary
+        with open(crash_file, 'w') as fp:
+            fp.write('not a pickle')
+        with open(crash_file.replace('.pklz', '.json'), 'w') as fp:
+            json.dump({'file': os.path.basename(crash_file), 'node': 'wf.failing',
+                       'node_dir': '/work/wf/failing', 'inputs': [['in_value', '3']],
+                       'traceback': ['Traceback:\n', 'ValueError\n']}, fp)
+
+        out_files = reports.run_reports(self.out_dir, nprocs=1)
+        with open(out_files[0]) as fp:
+            report = fp.read()
+        self.assertIn('wf.failing', report)
+        self.assertIn('in_value: 3', report)
+        self.assertIn('<a href="log/01/20170101-000000/{}">'.format(
+            os.path.basename(crash_file)), report)
@@ -34,14 +34,15 @@ class TestConfounds(TestWorkflow):
                                           'ConcatConfounds': ['signals', 'dvars', 'frame_displace',
                                                               #'acompcor', See confounds.py
                                                               'tcompcor'],
-                                          'tCompCor': ['components_file']})
+                                          'CompCor': ['acompcor_file', 'tcompcor_file']})
                                           # 'aCompCor': ['components_file', 'mask_file'], }) see ^^
 
+    @mock.patch('numpy.savez')
     @mock.patch('pandas.read_csv')
     @mock.patch.object(pd.DataFrame, 'to_csv', autospec=True)
     @mock.patch.object(pd.DataFrame, '__eq__', autospec=True,
                        side_effect=lambda me, them: me.equals(them))
-    def test_gather_confounds(self, df_equality, mock_df, mock_csv_reader):
+    def test_gather_confounds(self, df_equality, mock_df, mock_csv_reader, mock_savez):
         ''' asserts that the function for node ConcatConfounds reads and writes
         the confounds properly '''
 
@@ -62,3 +63,10 @@ class TestConfounds(TestWorkflow):
 
         mock_df.assert_called_once_with(confounds, os.path.abspath("confounds.tsv"),
                                         na_rep='n/a', index=False, sep="\t")
+
+        # the sidecar holds one array per column
+        sidecar = mock_savez.call_args[0][0]
+        arrays = mock_savez.call_args[1]
+        self.assertEqual(sidecar, os.path.abspath("confounds.npz"))
+        self.assertEqual(arrays['columns'].tolist(), ['a', 'b'])
+        self.assertEqual(arrays['sources'].tolist(), ['signals', 'dvars'])